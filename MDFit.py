@@ -9,6 +9,7 @@
 import logging
 import sys
 import os
+import signal
 
 #Get MDFit installation path
 MDFit_path = os.path.dirname(__file__)
@@ -23,6 +24,17 @@ import mdfit_initiate
 import mdfit_ffbuilder
 import mdfit_desmond_md
 import mdfit_desmond_analysis
+import mdfit_job_monitor
+import mdfit_state
+import mdfit_fingerprint
+import mdfit_warm_pool
+import mdfit_runtime
+import mdfit_retry
+import mdfit_watchdog
+import mdfit_work_queue
+import mdfit_backends
+import mdfit_daemon
+import mdfit_exec
 
 #Generate path to template directory
 template_dir = os.path.join(MDFit_path, 'templates')
@@ -131,8 +143,13 @@ def run_md(args, master_dir, ligfileprefix, SCHRODINGER, ligpath, template_dir,
         logger.info("Skipping Desmond MD")
 
 def run_analysis(args, master_dir, SCHRODINGER, inst_params):
+    #Check if analysis already ran alongside Desmond MD
+    if args.pipeline_analysis == True:
+        #If it did, document current step
+        logger.info("MD analysis was pipelined with Desmond MD (--pipeline_analysis provided by user)")
+
     #Check if user wants Desmond MD analysis
-    if args.skip_analysis == False:
+    elif args.skip_analysis == False:
         #If they do, document current step
         logger.info("Initiating MD analysis...")
 
@@ -147,7 +164,51 @@ def run_analysis(args, master_dir, SCHRODINGER, inst_params):
         #Document current step
         logger.info("Skipping MD analysis")
 
+def terminate(signum, frame):
+    #Ignore further requests to stop; the shutdown below must not be interrupted
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    #Capture error
+    logger.error("MDFit received signal %s; killing every job of this campaign"%signum)
+
+    #Kill local jobs and start no new ones
+    mdfit_exec.terminate()
+
+    #Kill jobs running through jobcontrol -WAIT or on Slurm
+    mdfit_backends.terminate()
+
+    #Kill jobs the job monitor is waiting on
+    mdfit_job_monitor.terminate()
+
+    #Kill warm workers and the calls they are running
+    mdfit_warm_pool.terminate()
+
+    #Exit through main's finally, which releases leases, databases and the daemon budget
+    raise SystemExit(1)
+
 def main():
+    #Check if user only wants the state of the campaign in this directory
+    if sys.argv[1:2] == ["status"]:
+        #If so, print stage counts and unfinished stages from the state database
+        mdfit_state.report(master_dir)
+
+        #Print recorded wall times per stage and host
+        mdfit_runtime.report(mdfit_runtime.history_path(master_dir, read_json(MDFit_path) if os.path.isfile(os.path.join(MDFit_path, "parameters.json")) else {}))
+
+        #Print work items by stage, if the campaign has a work queue
+        mdfit_work_queue.report(master_dir)
+
+        #Nothing else to do
+        return
+
+    #Check if user wants the MDFit daemon: start it, submit a campaign to it, list its campaigns, or cancel one
+    if sys.argv[1:2] in (["daemon"], ["submit"], ["campaigns"], ["cancel"]):
+        #Calls mdfit_daemon.py
+        mdfit_daemon.command(sys.argv[1:], MDFit_path, master_dir, read_json(MDFit_path))
+
+        #Nothing else to do
+        return
+
     #Get institution parameters from json file (hostnames, max number of ligs, etc.)
     inst_params = read_json(MDFit_path)
     
@@ -156,25 +217,91 @@ def main():
     
     #Get maximum number of ligands from json file
     maxliglimit = inst_params["parameters"]["MAXLIGS"]
-    
-    #Check file viability, flag compatibility, etc.
-    ligfiletype, ligfileprefix, protfiletype, nlig = initiate_mdfit(SCHRODINGER, args, master_dir, maxliglimit)
-
-    #Generate path to ligand library
-    if args.liglib and not args.precomplex:
-        ligpath = os.path.join(master_dir, "%s.sdf"%ligfileprefix)
-    elif args.precomplex:
-        ligpath = os.path.join(master_dir, args.precomplex)
-
-    #Run FFBuilder, if requested
-    run_ffbuilder(args, master_dir, SCHRODINGER, ligpath, \
-        ligfileprefix, schrodinger_version, inst_params, homepath)
-    
-    #Run Desmond MD, if requested
-    run_md(args, master_dir, ligfileprefix, SCHRODINGER, ligpath, template_dir, inst_params)
 
-    #Analyze Desmond trajectories, if requested
-    run_analysis(args, master_dir, SCHRODINGER, inst_params)
+    #Get wall-clock limit of each host class; jobs past their limit are killed and requeued
+    mdfit_watchdog.configure(inst_params)
+
+    #Get execution backend of each host class (local, jobcontrol, or slurm)
+    mdfit_backends.configure(inst_params)
+
+    #Kill every job of this campaign if MDFit is told to stop (e.g., cancelled on the MDFit daemon)
+    signal.signal(signal.SIGTERM, terminate)
+
+    #Release shared resources (daemon budget, work item leases, warm workers, job monitor, databases) however the run ends
+    try:
+        #Share host class slots and license tokens with every other campaign on the MDFit daemon, if requested
+        if args.daemon == True:
+            mdfit_daemon.open_client(os.getenv("MDFIT_DAEMON", mdfit_daemon.socket_path(inst_params)), master_dir, args.priority)
+
+        #Open shared work queue, if requested. The first MDFit process prepares the campaign (FFBuilder, queued ligands); the others wait here until it is ready
+        if args.work_queue == True:
+            mdfit_work_queue.open_queue(master_dir, args.lease_time).initialize()
+
+        #Check file viability, flag compatibility, etc.
+        ligfiletype, ligfileprefix, protfiletype, nlig = initiate_mdfit(SCHRODINGER, args, master_dir, maxliglimit)
+
+        #Start warm Schrodinger workers for short utility calls, if requested
+        if args.warm_pool > 0:
+            mdfit_warm_pool.start(SCHRODINGER, args.warm_pool)
+
+        #Generate path to ligand library
+        if args.liglib and not args.precomplex:
+            ligpath = os.path.join(master_dir, "%s.sdf"%ligfileprefix)
+        elif args.precomplex:
+            ligpath = os.path.join(master_dir, args.precomplex)
+
+        #Get name of this MDFit process, if it shares a work queue with others
+        owner = mdfit_work_queue.current().owner if args.work_queue == True else None
+
+        #Open campaign state database; records every stage and plans restarts. Processes draining a work queue each write their own and read the others'
+        mdfit_state.open_state(master_dir, owner)
+
+        #Open runtime history; every stage finished by this run is added to it
+        mdfit_runtime.open_history(master_dir, args, inst_params, owner)
+        mdfit_state.finish_callbacks.append(mdfit_runtime.record)
+
+        #Hash structure input from the working directory; every setup fingerprint reuses it
+        mdfit_fingerprint.structure_digest(args)
+
+        #Run FFBuilder, if requested. With a work queue, only the process that prepares the campaign runs it
+        if args.work_queue == False or mdfit_work_queue.current().first == True:
+            run_ffbuilder(args, master_dir, SCHRODINGER, ligpath, \
+                ligfileprefix, schrodinger_version, inst_params, homepath)
+
+        #Start job monitor, if requested
+        if args.monitor_jobs == True:
+            mdfit_job_monitor.start(SCHRODINGER, args.poll_interval)
+
+        #Run Desmond MD, if requested
+        run_md(args, master_dir, ligfileprefix, SCHRODINGER, ligpath, template_dir, inst_params)
+
+        #Analyze Desmond trajectories, if requested
+        run_analysis(args, master_dir, SCHRODINGER, inst_params)
+
+        #Generate failure summary filename. Every process draining a work queue writes its own
+        failures_name = mdfit_retry.FAILURES_NAME if args.work_queue == False else "MDFit_failures_%s.csv"%mdfit_work_queue.current().owner
+
+    finally:
+        #Stop job monitor, if running
+        mdfit_job_monitor.stop()
+
+        #Stop warm workers and report their latency, if running
+        mdfit_warm_pool.stop()
+
+        #Close campaign state database and runtime history
+        mdfit_state.close()
+        mdfit_runtime.close()
+
+        #Stop renewing work item leases, if a work queue is open
+        mdfit_work_queue.close()
+
+        #Leave the MDFit daemon's budget, if joined
+        mdfit_daemon.close()
+
+    #Summarize stages skipped by --keep_going
+    if mdfit_retry.summary(master_dir, failures_name) > 0:
+        #Exit with an error so wrappers know the campaign is incomplete
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,574 @@
+#!/ap/rhel7/bin/python3.6
+
+####################################################################
+# Corresponding Authors : Alexander Brueckner, Kaushik Lakkaraju ###
+# Contact : alexander.brueckner@bms.com, kaushik.lakkaraju@bms.com #
+####################################################################
+
+#Import Python modules
+import logging
+import os
+import re
+import sys
+import glob
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+#Import MDFit modules
+import mdfit_exec
+import mdfit_job_monitor
+import mdfit_state
+
+###Initiate logger###
+logger = logging.getLogger(__name__)
+
+#Backend of each host class unless the "backends" block of parameters.json names another. Clustering has always run locally
+DEFAULT_BACKENDS = {"FFBUILDER": "jobcontrol", "BMIN": "jobcontrol", "MULTISIM": "jobcontrol", "DESMOND": "jobcontrol", "ANALYSIS": "jobcontrol", "CLUSTER": "local"}
+
+#Slurm job states (sacct/squeue). Timeouts are stalls; everything else that is not completed is a failure
+SLURM_RUNNING = ("PENDING", "RUNNING", "CONFIGURING", "COMPLETING", "REQUEUED", "RESIZING", "SUSPENDED", "SIGNALING", "STAGE_OUT")
+SLURM_TIMEOUT = ("TIMEOUT", "DEADLINE")
+
+#Pattern for the job ID printed by sbatch --parsable: <jobid>[;<cluster>]
+slurm_jobid = re.compile(r'^(\d+)')
+
+#Polls without an accounting record before a job that left squeue is taken as finished (sacct can lag)
+SACCT_RETRIES = 5
+
+#Backend of each host class, filled by configure()
+backends = {}
+
+#Remote jobs still running: job ID > backend that submitted it
+live = {}
+live_lock = threading.Lock()
+
+def local_command(command):
+    #Run Schrodinger jobs on the node the backend runs them on; -HOST <hostname> becomes -HOST localhost
+    if "-HOST" in command[:-1]:
+        index = command.index("-HOST")
+        return command[:index+1] + ["localhost"] + command[index+2:]
+    return list(command)
+
+class LocalBackend:
+    #Runs each command as a subprocess of this MDFit process
+    name = "local"
+
+    def run(self, command, joblogger, limit, cwd=None, name=None, members=None, outputs=None):
+        #Run job here, killing it if it runs past its limit
+        result = mdfit_exec.run_job(local_command(command), joblogger, cwd, timeout=limit)
+
+        #Check if job ran past its limit
+        if result.timed_out == True:
+            #If so, mark job as stalled
+            raise mdfit_job_monitor.JobStalled(name, "local", "%g"%(limit/3600), result.returncode)
+
+        #Return exit status and timing
+        return result
+
+class JobcontrolBackend:
+    #Submits through the Schrodinger job server (-HOST); the command waits on the job (-WAIT)
+    name = "jobcontrol"
+
+    def __init__(self):
+        #Prepare Schrodinger's jobcontrol command ($SCHRODINGER/jobcontrol)
+        self.jobcontrol = os.path.join(os.getenv('SCHRODINGER', ''), "jobcontrol")
+
+    def cancel(self, jobid):
+        #Killing the -WAIT process does not stop the remote job. Kill it through jobcontrol
+        mdfit_job_monitor.kill(self.jobcontrol, jobid)
+
+    def run(self, command, joblogger, limit, cwd=None, name=None, members=None, outputs=None):
+        #Generate key the job's ID is recorded under in the state database
+        key = mdfit_job_monitor.job_key(command, name, members)
+
+        #Check if an earlier MDFit process submitted this job
+        jobid, status = mdfit_job_monitor.recorded(self.jobcontrol, key)
+
+        #Check if that job already finished
+        if status == "finished":
+            #Nothing is left to re-attach to
+            mdfit_state.forget_job(key)
+
+            #Check if its outputs are back
+            if mdfit_job_monitor.download(self.jobcontrol, jobid, outputs, cwd) == True:
+                #If so, nothing to run
+                return mdfit_exec.JobResult(command, 0, 0.0, False, False)
+
+            #Outputs were never downloaded; run the job again
+            logger.warning("%s (%s) finished but its outputs are missing: %s; submitting again"%(key, jobid, ', '.join(mdfit_job_monitor.missing_outputs(outputs, cwd))))
+            jobid, status = None, None
+
+        #Collect job IDs printed while the job runs with -WAIT
+        jobids = [jobid] if jobid != None else []
+
+        #Look for the job ID in each line of output
+        def find_jobid(line):
+            theMatch = mdfit_job_monitor.jobid_finder.search(line)
+
+            #If found, keep it, and record it at once so a restarted MDFit can re-attach
+            if theMatch:
+                jobids.append(theMatch.group(1))
+                mdfit_state.record_job(key, theMatch.group(1))
+                register(theMatch.group(1), self)
+
+        #Run job, always unregistering its job IDs
+        try:
+            #Check if that job is still running
+            if status == "running":
+                #If so, wait on it instead of submitting again
+                register(jobid, self)
+                result = mdfit_exec.run_job([self.jobcontrol, "-wait", jobid], joblogger, cwd, timeout=limit)
+
+            #Nothing to re-attach to
+            else:
+                #Run job, killing it if it runs past the host class limit
+                result = mdfit_exec.run_job(command, joblogger, cwd, timeout=limit, on_line=find_jobid)
+        finally:
+            unregister(jobids)
+
+        #Check if job ran past its limit
+        if result.timed_out == True:
+            #If so, kill the remote jobs too
+            for each_jobid in jobids:
+                self.cancel(each_jobid)
+
+            #Forget job; the stage is requeued
+            mdfit_state.forget_job(key)
+
+            #Mark job as stalled
+            raise mdfit_job_monitor.JobStalled(name, jobids[-1] if jobids != [] else "no JobId", "%g"%(limit/3600), result.returncode)
+
+        #Job is done; nothing is left to re-attach to
+        mdfit_state.forget_job(key)
+
+        #Check if a re-attached job failed
+        if status == "running" and mdfit_job_monitor.job_status(self.jobcontrol, jobid) == "failed":
+            #If so, raise like the job monitor does
+            raise mdfit_job_monitor.JobFailed(name, jobid, "failed", result.returncode)
+
+        #Return exit status and timing
+        return result
+
+class SlurmBackend:
+    #Submits a batch script with sbatch and polls squeue, then sacct, until the job leaves the queue
+    name = "slurm"
+
+    def __init__(self, settings):
+        #Get batch commands; full paths can be given for clusters (or tests) without them on PATH
+        self.sbatch = settings.get("SBATCH", "sbatch")
+        self.squeue = settings.get("SQUEUE", "squeue")
+        self.sacct = settings.get("SACCT", "sacct")
+        self.scancel = settings.get("SCANCEL", "scancel")
+
+        #Get seconds between polls
+        self.poll = float(settings.get("POLL", 30))
+
+        #Generate #SBATCH options shared by every job: partition, account, CPUs and memory per job, and any site-specific lines
+        self.options = []
+        for option, setting in (("--partition", "PARTITION"), ("--account", "ACCOUNT"), ("--cpus-per-task", "CPUS"), ("--mem", "MEM")):
+            if settings.get(setting, "") != "":
+                self.options.append("%s=%s"%(option, settings[setting]))
+        self.options.extend(settings.get("OPTIONS", []))
+
+    def script(self, command, name, limit, cwd):
+        #Generate batch script and log paths <jobname>.slurm.sh and <jobname>.slurm.log in the job's directory
+        script_path = os.path.join(cwd, "%s.slurm.sh"%name)
+        log_path = os.path.join(cwd, "%s.slurm.log"%name)
+
+        #Generate #SBATCH lines. Slurm's own time limit matches the host class limit (minutes)
+        options = ["--job-name=%s"%name, "--output=%s"%log_path] + self.options
+        if limit != None:
+            options.append("--time=%s"%max(1, int((limit + 59)//60)))
+
+        #Write script: run the command on the allocated node, in the job's directory
+        with open(script_path, 'w') as fp:
+            fp.write("#!/bin/bash\n")
+            fp.writelines("#SBATCH %s\n"%option for option in options)
+            fp.write("cd %s\n"%shlex.quote(cwd))
+            fp.write("%s\n"%' '.join(shlex.quote(word) for word in local_command(command)))
+
+        #Return script and log paths
+        return script_path, log_path
+
+    def submit(self, script_path, cwd):
+        #Submit batch script; --parsable prints only the job ID
+        process = subprocess.run([self.sbatch, "--parsable", script_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, cwd=cwd, timeout=300)
+
+        #Get job ID
+        theMatch = slurm_jobid.match(process.stdout.strip())
+
+        #Check if job was accepted
+        if process.returncode != 0 or not theMatch:
+            #If not, there is nothing to wait on
+            raise RuntimeError("sbatch did not accept %s: %s"%(script_path, process.stdout.strip()))
+
+        #Return job ID
+        return theMatch.group(1)
+
+    def status(self, jobid):
+        #Ask squeue for the state of a job still in the queue
+        try:
+            process = subprocess.run([self.squeue, "-h", "-j", jobid, "-o", "%T"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=300)
+        except Exception as exc:
+            logger.warning("Could not get squeue status of %s: %s"%(jobid, exc))
+            return "UNKNOWN"
+
+        #Check if job is queued or running
+        states = process.stdout.split()
+        if process.returncode == 0 and states != [] and states[0] in SLURM_RUNNING:
+            return states[0]
+
+        #Job left the queue; ask accounting how it ended
+        try:
+            process = subprocess.run([self.sacct, "-n", "-X", "-P", "-j", jobid, "-o", "State"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=300)
+        except Exception as exc:
+            logger.warning("Could not get sacct status of %s: %s"%(jobid, exc))
+            return "UNKNOWN"
+
+        #Return first word of the job's state (e.g., "CANCELLED by 1234" > CANCELLED), or None without a record yet
+        states = process.stdout.split()
+        return states[0].rstrip('+') if process.returncode == 0 and states != [] else None
+
+    def cancel(self, jobid):
+        #Capture error
+        logger.error("Cancelling Slurm job %s"%jobid)
+
+        #Ask Slurm to cancel the job. Never let a failed cancel stop the caller
+        try:
+            subprocess.run([self.scancel, jobid], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=300)
+        except Exception as exc:
+            logger.warning("Could not cancel %s: %s"%(jobid, exc))
+
+    def wait(self, jobid, key, name, limit):
+        #Start timer
+        start = time.time()
+
+        #Initiate number of polls without an accounting record
+        missing = 0
+
+        #Poll until the job leaves the queue
+        while True:
+            #Get job state
+            state = self.status(jobid)
+
+            #Check if job is done
+            if state not in SLURM_RUNNING and state != "UNKNOWN":
+                #Check if accounting has no record of it yet
+                if state == None and missing < SACCT_RETRIES:
+                    #If so, ask again next poll
+                    missing += 1
+                else:
+                    break
+
+            #Check if job ran past its limit. Slurm's own --time should stop it first
+            if limit != None and time.time() - start > limit:
+                #If so, cancel job and forget it; the stage is requeued
+                self.cancel(jobid)
+                mdfit_state.forget_job(key)
+
+                #Mark job as stalled
+                raise mdfit_job_monitor.JobStalled(name, jobid, "%g"%(limit/3600))
+
+            #Wait for next poll; stop at once if MDFit is stopping
+            if mdfit_exec.stopping.wait(self.poll) == True:
+                raise RuntimeError("MDFit is stopping; no longer waiting on Slurm job %s"%jobid)
+
+        #Return final state and start time
+        return state, start
+
+    def run(self, command, joblogger, limit, cwd=None, name=None, members=None, outputs=None):
+        #Run in the caller's directory by default
+        cwd = cwd if cwd != None else os.getcwd()
+
+        #Generate key the job's ID is recorded under in the state database
+        key = mdfit_job_monitor.job_key(command, name, members)
+
+        #Check if an earlier MDFit process submitted this job
+        recorded = mdfit_state.recorded_job(key)
+        jobid = recorded[len("slurm:"):] if recorded != None and recorded.startswith("slurm:") else None
+
+        #Get what Slurm knows of that job
+        state = self.status(jobid) if jobid != None else None
+
+        #Check if it is still queued or running, or completed with its outputs in place (the job directory is shared)
+        if state in SLURM_RUNNING or (state == "COMPLETED" and mdfit_job_monitor.missing_outputs(outputs, cwd) == []):
+            #If so, wait on it instead of submitting again
+            logger.info("Re-attaching to %s (Slurm job %s)"%(key, jobid))
+            log_path = os.path.join(cwd, "%s.slurm.log"%name)
+
+        #Nothing to re-attach to
+        else:
+            #Check if a completed job lost its outputs
+            if state == "COMPLETED":
+                logger.warning("Slurm job %s (%s) completed but its outputs are missing: %s; submitting again"%(jobid, key, ', '.join(mdfit_job_monitor.missing_outputs(outputs, cwd))))
+
+            #Write batch script
+            script_path, log_path = self.script(command, name, limit, cwd)
+
+            #Capture current step
+            logger.info("Submitting %s to Slurm: %s"%(name, script_path))
+
+            #Submit job, and record its ID at once so a restarted MDFit can re-attach
+            jobid = self.submit(script_path, cwd)
+            mdfit_state.record_job(key, "slurm:%s"%jobid)
+
+            #Capture current step
+            logger.info("Slurm job %s: %s"%(jobid, name))
+
+        #Wait on job, always unregistering it
+        register(jobid, self)
+        try:
+            state, start = self.wait(jobid, key, name, limit)
+        finally:
+            unregister([jobid])
+
+        #Job is done; nothing is left to re-attach to
+        mdfit_state.forget_job(key)
+
+        #Write job output to log file for debugging
+        if os.path.isfile(log_path) == True:
+            with open(log_path, 'r', errors="replace") as fp:
+                for line in fp:
+                    if line.strip() != "":
+                        joblogger.debug(line.rstrip())
+
+        #Check if Slurm stopped the job at its time limit
+        if state in SLURM_TIMEOUT:
+            #If so, mark job as stalled
+            raise mdfit_job_monitor.JobStalled(name, jobid, "%g"%(limit/3600 if limit != None else 0))
+
+        #Check if job failed (e.g., FAILED, CANCELLED, NODE_FAIL, OUT_OF_MEMORY)
+        if state not in ("COMPLETED", None):
+            #If so, raise like the job monitor does
+            raise mdfit_job_monitor.JobFailed(name, jobid, state.lower())
+
+        #Check if accounting never recorded the job
+        if state == None:
+            #If so, the job counts as finished only if its outputs are in place
+            missing = mdfit_job_monitor.missing_outputs(outputs, cwd)
+            if missing != []:
+                raise mdfit_job_monitor.JobFailed(name, jobid, "unrecorded, missing %s"%', '.join(missing))
+
+            #Capture warning
+            logger.warning("No accounting record for Slurm job %s (%s); outputs are in place, taking it as finished"%(jobid, name))
+
+        #Return exit status and timing
+        return mdfit_exec.JobResult(command, 0, time.time() - start, False, False)
+
+def configure(inst_params):
+    #Get backend of every host class from json file, or the default
+    for hostclass, default in DEFAULT_BACKENDS.items():
+        choice = inst_params.get("backends", {}).get(hostclass, default)
+
+        #Generate backend
+        if choice == "local":
+            backends[hostclass] = LocalBackend()
+        elif choice == "jobcontrol":
+            backends[hostclass] = JobcontrolBackend()
+        elif choice == "slurm":
+            backends[hostclass] = SlurmBackend(inst_params.get("slurm", {}))
+
+        #Backend is not known
+        else:
+            #Capture error
+            logger.critical("Unknown backend for %s in parameters.json: %s (local, jobcontrol, or slurm); cannot proceed"%(hostclass, choice))
+
+            #Exit
+            sys.exit(1)
+
+    #Capture current step
+    logger.info("Execution backend per host class: %s"%{hostclass: each_backend.name for hostclass, each_backend in backends.items()})
+
+def backend(hostclass):
+    #Return backend of a host class; jobcontrol if not configured
+    if hostclass not in backends:
+        backends[hostclass] = JobcontrolBackend() if DEFAULT_BACKENDS.get(hostclass, "jobcontrol") == "jobcontrol" else LocalBackend()
+    return backends[hostclass]
+
+def monitor(hostclass):
+    #Return shared job monitor if it tracks this host class's jobs; only jobcontrol jobs can be monitored
+    return mdfit_job_monitor.current() if backend(hostclass).name == "jobcontrol" else None
+
+def register(jobid, each_backend):
+    #Add remote job to the live jobs
+    with live_lock:
+        live[jobid] = each_backend
+
+    #Stop a job submitted after MDFit started stopping at once
+    if mdfit_exec.stopping.is_set():
+        each_backend.cancel(jobid)
+
+def unregister(jobids):
+    #Remove finished remote jobs from the live jobs
+    with live_lock:
+        for jobid in jobids:
+            live.pop(jobid, None)
+
+def terminate():
+    #Get snapshot of live remote jobs
+    with live_lock:
+        jobs = list(live.items())
+
+    #Kill each through the backend that submitted it (jobcontrol -kill or scancel)
+    for jobid, each_backend in jobs:
+        each_backend.cancel(jobid)
+
+    #Return number of jobs killed
+    return len(jobs)
+
+def group_alive(pgid):
+    #Check /proc for a live (not zombie) process in a process group
+    for pid in os.listdir("/proc"):
+        try:
+            with open("/proc/%s/stat"%pid) as fp:
+                fields = fp.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if fields[0] != "Z" and int(fields[2]) == pgid:
+            return True
+    return False
+
+def stub_check():
+    #Local check of the Slurm and jobcontrol backends against stub commands: python mdfit_backends.py test
+    stub_dir = tempfile.mkdtemp(prefix="mdfit_backends_")
+
+    #Write stub command
+    def stub(name, body):
+        with open(os.path.join(stub_dir, name), "w") as fp:
+            fp.write("#!/bin/sh\n%s\nexit 0\n"%body.replace("DIR", stub_dir))
+        os.chmod(os.path.join(stub_dir, name), 0o755)
+        return os.path.join(stub_dir, name)
+
+    #Write stub file
+    def write(name, text):
+        with open(os.path.join(stub_dir, name), "w") as fp:
+            fp.write(text)
+
+    #sbatch runs the batch script at once and hands out job IDs 101, 102, ...; squeue shows a job RUNNING for the number of polls in polls_<jobid>; sacct prints sacct_<jobid>, if any
+    write("next", "101")
+    stub("sbatch", 'n=$(cat DIR/next); echo $((n+1)) > DIR/next; sh $2 > /dev/null; echo "$n;cluster"')
+    stub("squeue", 'f=DIR/polls_$3; n=$(cat $f 2>/dev/null || echo 0); if [ "$n" -gt 0 ]; then echo RUNNING; echo $((n-1)) > $f; fi')
+    stub("sacct", '[ -f DIR/sacct_$5 ] && cat DIR/sacct_$5')
+    stub("scancel", 'touch DIR/cancelled_$1')
+
+    #jobcontrol lists every job with a status file, -download writes <jobid>.out if download_<jobid> exists, and -kill touches killed_<jobid>
+    stub("jobcontrol", 'if [ "$1" = "-download" ]; then [ -f DIR/download_$2 ] && touch DIR/$2.out; elif [ "$1" = "-kill" ]; then touch DIR/killed_$2; else [ -f DIR/$2 ] && echo "$2 $(cat DIR/$2)"; fi')
+
+    #Long job prints its JobId, records its process group and waits like jobcontrol -WAIT
+    waiter = stub("waiter", 'echo $$ > DIR/pid_$1; echo "JobId: $1"; sleep 60')
+
+    #Job touches ran_<jobname> when it runs
+    job = stub("job", 'touch DIR/ran_$1')
+
+    #Open state database in the stub directory, so job IDs can be recorded
+    mdfit_state.open_state(stub_dir)
+
+    #Start Slurm backend against stubs, polling fast
+    slurm = SlurmBackend({"SBATCH": os.path.join(stub_dir, "sbatch"), "SQUEUE": os.path.join(stub_dir, "squeue"), "SACCT": os.path.join(stub_dir, "sacct"), "SCANCEL": os.path.join(stub_dir, "scancel"), "POLL": 0.05, "PARTITION": "cpu"})
+
+    #Run a job on a backend and get its result or error
+    def outcome(backend, name, sacct=None, polls=0, limit=60, outputs=None):
+        jobid = open(os.path.join(stub_dir, "next")).read().strip()
+        write("polls_%s"%jobid, str(polls))
+        if sacct != None:
+            write("sacct_%s"%jobid, sacct)
+        try:
+            return backend.run([job, name, "-HOST", "gpu01"], logger, limit, stub_dir, name, outputs=outputs)
+        except Exception as exc:
+            return exc
+
+    #Slurm: completed after a few polls, failed, cancelled, killed at Slurm's time limit, no accounting record, and past MDFit's own limit
+    outcomes = {}
+    outcomes["completed"] = outcome(slurm, "completed", "COMPLETED", 3)
+    outcomes["failed"] = outcome(slurm, "failed", "FAILED")
+    outcomes["cancelled"] = outcome(slurm, "cancelled", "CANCELLED by 1234")
+    outcomes["timeout"] = outcome(slurm, "timeout", "TIMEOUT", 1)
+    outcomes["no record"] = outcome(slurm, "no_record")
+    outcomes["no record, no output"] = outcome(slurm, "no_output", outputs=["no_output.out"])
+    outcomes["stalled"] = outcome(slurm, "stalled", None, 1000, 0.3)
+
+    #Check that the batch script carries the #SBATCH options and runs on the allocated node
+    script = open(os.path.join(stub_dir, "completed.slurm.sh")).read()
+    script_ok = "#SBATCH --partition=cpu" in script and "#SBATCH --time=1" in script and "-HOST localhost" in script
+
+    #Slurm re-attach: a completed job with its outputs is not run again; one without them is
+    jobid = open(os.path.join(stub_dir, "next")).read().strip()
+    write("sacct_%s"%jobid, "COMPLETED")
+    write("%s.out"%jobid, "")
+    mdfit_state.record_job(mdfit_job_monitor.job_key([job], "reattach"), "slurm:%s"%jobid)
+    outcomes["slurm re-attach"] = outcome(slurm, "reattach", outputs=["%s.out"%jobid])
+    mdfit_state.record_job(mdfit_job_monitor.job_key([job], "lost"), "slurm:%s"%jobid)
+    outcomes["slurm lost"] = outcome(slurm, "lost", "COMPLETED", outputs=["missing.out"])
+
+    #Jobcontrol re-attach: finished job whose outputs download, and one whose outputs are gone
+    jobcontrol = JobcontrolBackend()
+    jobcontrol.jobcontrol = os.path.join(stub_dir, "jobcontrol")
+    for jobid, name in (("jc1", "downloaded"), ("jc2", "gone")):
+        write(jobid, "completed")
+        mdfit_state.record_job(mdfit_job_monitor.job_key([job], name), jobid)
+    write("download_jc1", "")
+    outcomes["jobcontrol downloaded"] = outcome(jobcontrol, "downloaded", outputs=["jc1.out"])
+    outcomes["jobcontrol gone"] = outcome(jobcontrol, "gone", outputs=["jc2.out"])
+
+    #Shutdown: a jobcontrol job and a Slurm job still running are killed, and no new job starts. Runs last; MDFit stays stopping
+    def shutdown_run(backend, command, name):
+        try:
+            outcomes[name] = backend.run(command, logger, 60, stub_dir, name)
+        except Exception as exc:
+            outcomes[name] = exc
+    slurm_jobid = open(os.path.join(stub_dir, "next")).read().strip()
+    write("polls_%s"%slurm_jobid, "1000")
+    threads = [threading.Thread(target=shutdown_run, args=(jobcontrol, [waiter, "jc9"], "shutdown_jobcontrol")), \
+        threading.Thread(target=shutdown_run, args=(slurm, [job, "shutdown_slurm"], "shutdown_slurm"))]
+    for thread in threads:
+        thread.start()
+
+    #Wait until both jobs are live, then stop everything
+    deadline = time.time() + 10
+    while len(live) < 2 and time.time() < deadline:
+        time.sleep(0.05)
+    started = time.time()
+    mdfit_exec.terminate()
+    terminate()
+    for thread in threads:
+        thread.join(30)
+    stopped = time.time() - started < 10 and all(isinstance(outcomes[name], (mdfit_exec.JobResult, RuntimeError)) for name in ("shutdown_jobcontrol", "shutdown_slurm"))
+
+    #Check that jobcontrol and Slurm were asked to kill the jobs, that the local -WAIT process group is gone and that nothing new starts
+    outcomes["after shutdown"] = outcome(LocalBackend(), "after_shutdown")
+    shutdown = {"jobcontrol -kill": os.path.isfile(os.path.join(stub_dir, "killed_jc9")), "scancel": os.path.isfile(os.path.join(stub_dir, "cancelled_%s"%slurm_jobid)), \
+        "process group gone": group_alive(int(open(os.path.join(stub_dir, "pid_jc9")).read())) == False, "stopped": stopped}
+
+    #Check which jobs ran
+    ran = {name: os.path.isfile(os.path.join(stub_dir, "ran_%s"%name)) for name in ("reattach", "lost", "downloaded", "gone")}
+    cancelled = glob.glob(os.path.join(stub_dir, "cancelled_*")) != []
+
+    #Close state database and remove stubs
+    mdfit_state.close()
+    shutil.rmtree(stub_dir)
+
+    #Print outcomes
+    for case, result in outcomes.items():
+        print("%-22s %s"%(case, "returncode %s"%result.returncode if isinstance(result, mdfit_exec.JobResult) else "%s: %s"%(type(result).__name__, result)))
+    print("%-22s %s"%("batch script", script_ok))
+    print("%-22s %s"%("ran", ran))
+    print("%-22s %s"%("scancel", cancelled))
+    print("%-22s %s"%("shutdown", shutdown))
+
+    #Check outcomes
+    return isinstance(outcomes["completed"], mdfit_exec.JobResult) and isinstance(outcomes["failed"], mdfit_job_monitor.JobFailed) and \
+        isinstance(outcomes["cancelled"], mdfit_job_monitor.JobFailed) and outcomes["cancelled"].status == "cancelled" and \
+        isinstance(outcomes["timeout"], mdfit_job_monitor.JobStalled) and isinstance(outcomes["no record"], mdfit_exec.JobResult) and \
+        isinstance(outcomes["no record, no output"], mdfit_job_monitor.JobFailed) and \
+        isinstance(outcomes["stalled"], mdfit_job_monitor.JobStalled) and cancelled == True and script_ok == True and \
+        ran == {"reattach": False, "lost": True, "downloaded": False, "gone": True} and \
+        isinstance(outcomes["after shutdown"], RuntimeError) and all(shutdown.values())
+
+if __name__ == '__main__':
+    #Local check of the backends without Slurm or Schrodinger: python mdfit_backends.py test
+    if sys.argv[1:2] == ["test"]:
+        sys.exit(0 if stub_check() else 1)
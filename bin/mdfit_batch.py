@@ -0,0 +1,105 @@
+#!/ap/rhel7/bin/python3.6
+
+####################################################################
+# Corresponding Authors : Alexander Brueckner, Kaushik Lakkaraju ###
+# Contact : alexander.brueckner@bms.com, kaushik.lakkaraju@bms.com #
+####################################################################
+
+#Import Python modules
+import logging
+import itertools
+import threading
+import time
+
+#Import MDFit modules
+import mdfit_work_queue
+
+###Initiate logger###
+logger = logging.getLogger(__name__)
+
+#Seconds a partly filled batch waits for more ligands before it is submitted anyway
+BATCH_WAIT = 60
+
+#Batchers shared by every setup thread: key (e.g., "BMIN") > batcher
+batchers = {}
+batchers_lock = threading.Lock()
+
+class JobBatch:
+    #Collects ligands from setup threads and runs each group of them as one job
+    def __init__(self, size, wait):
+        #Number of ligands in a full batch
+        self.size = size
+
+        #Seconds to wait for a batch to fill
+        self.wait = wait
+
+        #Ligands waiting for a batch, and the result (None or error) of each submitted ligand
+        self.pending = []
+        self.results = {}
+        self.condition = threading.Condition()
+
+        #Batch numbers for job names
+        self.numbers = itertools.count(1)
+
+    def run(self, ligname, run_batch):
+        #Add ligand to the next batch
+        with self.condition:
+            self.pending.append(ligname)
+
+            #Wait until the batch is full, another thread takes it, or it has waited long enough
+            deadline = time.time() + self.wait
+            while ligname in self.pending and len(self.pending) < self.size and time.time() < deadline:
+                self.condition.wait(max(0, deadline - time.time()))
+
+            #Check if the ligand is still waiting
+            if ligname in self.pending:
+                #If so, this thread submits the batch
+                batch = self.pending
+                self.pending = []
+                number = next(self.numbers)
+
+                #Coordinators sharing a work queue run in the same directory; tag the batch with this one's owner so job names don't collide
+                queue = mdfit_work_queue.current()
+                if queue != None:
+                    number = "%s_%s"%(queue.owner.replace(".", "_"), number)
+
+                #Let the other threads in the batch stop waiting to fill it
+                self.condition.notify_all()
+
+            #Another thread submitted the ligand
+            else:
+                batch = None
+
+        #Check if this thread submits the batch
+        if batch != None:
+            #Run batch and keep its error, if any, for every ligand in it
+            try:
+                run_batch(batch, number)
+                error = None
+            except Exception as exc:
+                error = exc
+
+            #Hand result to every ligand in the batch
+            with self.condition:
+                for each_lig in batch:
+                    self.results[each_lig] = error
+                self.condition.notify_all()
+
+        #Wait for the ligand's batch to finish
+        with self.condition:
+            while ligname not in self.results:
+                self.condition.wait()
+            error = self.results.pop(ligname)
+
+        #Raise the batch's error in every ligand's thread
+        if error != None:
+            raise error
+
+def batcher(key, size, wait=BATCH_WAIT):
+    #Get shared batcher for a job type, starting it on first use
+    with batchers_lock:
+        if key not in batchers:
+            batchers[key] = JobBatch(size, wait)
+
+    #Return batcher
+    return batchers[key]
@@ -9,24 +9,139 @@
 import logging
 import sys
 import os
-import subprocess
+import glob
+
+#Import Schrodinger modules
+from schrodinger import structure
+
+#Import MDFit modules
+import mdfit_batch
+import mdfit_job_monitor
+import mdfit_watchdog
+import mdfit_backends
 
 ###Initiate logger###
 logger = logging.getLogger(__name__)
 
-def run_job(command):
-    #Run provided command, joining list with space. Pipe stdout and sdterror to log file
-    process = subprocess.run(' '.join(command), stdout=subprocess.PIPE, \
-        stderr=subprocess.STDOUT, shell=True, text=True)
+#Structure property used to match simulation boxes back to their ligands
+LIGAND_PROPERTY = "s_mdfit_ligand"
+
+def charge_class(charge):
+    #Check system charge
+    if charge > 0:
+        #If positive, use positive template
+        return "positive"
+
+    elif charge == 0:
+        #If neutral, use neutral template
+        return "neutral"
+
+    #Must be negative
+    else:
+        #If negative, use negative template
+        return "negative"
+
+def write_msj(template_dir, chargeclass, args, inputfile):
+    #Read in template file (positive_template.msj, neutral_template.msj, or negative_template.msj)
+    with open(os.path.join(template_dir, "%s_template.msj"%chargeclass), "r") as template:
+        #Put lines in a variable
+        lines = template.readlines()
     
-    #Iterate over sdtout and sdterror
-    for line in process.stdout.split('\n'):
-        #Ignore blank lines
-        if line != "":
-            #Ignore ExitStatus
-            if "ExitStatus" not in line:
-                #Write to log file for debugging
-                logger.debug(line)
+    #Open setup filename for writing
+    with open(inputfile, "w") as ligoutput:
+        #Iterate through all the template lines
+        for line in lines:
+            #Write line to out file, replacing solvent keyword with desired solvent
+            ligoutput.write(line.replace("<solvent>",args.solvent))
+
+def submit(command, jobname, members=None, outputs=None):
+    #Get shared job monitor, if the user asked for one and this host class runs on jobcontrol. Calls mdfit_backends.py
+    monitor = mdfit_backends.monitor("MULTISIM")
+
+    #Check if jobs are tracked by the monitor
+    if monitor != None:
+        #If so, submit without -WAIT and wait on the monitor
+        return monitor.run(mdfit_job_monitor.detach(command), jobname, limit=mdfit_watchdog.limit("MULTISIM"), members=members, outputs=outputs)
+
+    #Jobs are run with -WAIT, or on another backend
+    else:
+        #Run command, killing it at the MULTISIM limit. Calls mdfit_watchdog.py
+        return mdfit_watchdog.run_job(command, logger, "MULTISIM", members=members, outputs=outputs)
+
+def run_batch(ligands, number, chargeclass, SCHRODINGER, args, multisim_host, template_dir, slot):
+    #Prepare Schrodinger multisim command ($SCHRODINGER/utilities/multisim)
+    run_cmd = os.path.join(SCHRODINGER, "utilities", "multisim")
+
+    #Generate batch job name and setup filename
+    jobname = "mdfit_%s_setup_batch%s"%(chargeclass, number)
+    inputfile = "%s.msj"%jobname
+
+    #Write setup file once for the whole charge class
+    write_msj(template_dir, chargeclass, args, inputfile)
+
+    #Write each minimized complex to its own input file, tagged with its ligand name
+    infiles = []
+    for ligname in ligands:
+        complex_st = structure.StructureReader.read("%s_out_complex_min.mae"%ligname)
+        complex_st.property[LIGAND_PROPERTY] = ligname
+        complex_st.write("%s_%s_in.mae"%(jobname, ligname))
+        infiles.append("%s_%s_in.mae"%(jobname, ligname))
+
+    #Get number of systems built at once
+    maxjob = args.multisim_maxjob if args.multisim_maxjob > 0 else len(ligands)
+
+    #Generate command for building every box in the batch
+    command = [run_cmd, "-maxjob", str(maxjob), "-JOBNAME", jobname, "-m", inputfile] + infiles + ["-OPLSDIR", args.oplsdir, "-HOST", multisim_host, "-WAIT"]
+
+    #Document current step
+    logger.info("Building %s %s simulation boxes in one multisim run (%s): %s"%(len(ligands), chargeclass, jobname, ', '.join(ligands)))
+
+    #Wait for a free MULTISIM slot, then run multisim
+    with slot:
+        submit(command, jobname, ligands, ["%s*-out.cms"%jobname])
+
+    #Iterate over systems written by the batch
+    for outfile in glob.glob("%s*-out.cms"%jobname):
+        #Get ligand from the tag carried through system building
+        ligname = structure.StructureReader.read(outfile).property.get(LIGAND_PROPERTY)
+
+        #Check if output is the only one, for a batch of one ligand that lost its tag
+        if ligname == None and len(ligands) == 1:
+            ligname = ligands[0]
+
+        #Move system to the per-ligand filename a single multisim job would write
+        if ligname in ligands:
+            os.rename(outfile, "%s_md_setup_out.cms"%ligname)
+
+def batched(master_dir, SCHRODINGER, args, charge, ligname, multisim_host, bmincomplex, template_dir, slot):
+    #Generate output filename
+    simbox = "%s_md_setup_out.cms"%ligname
+
+    #Check that simulation box does not exist
+    if os.path.isfile(os.path.join(master_dir, "desmond_md", ligname, "md_setup", simbox)) == False:
+        #If not, get template for the system charge
+        chargeclass = charge_class(charge)
+
+        #Get shared batcher for this charge class
+        batcher = mdfit_batch.batcher("MULTISIM_%s"%chargeclass, args.multisim_batch)
+
+        #Wait for the ligand's batch to be built
+        batcher.run(ligname, lambda ligands, number: run_batch(ligands, number, chargeclass, SCHRODINGER, args, multisim_host, template_dir, slot))
+
+        #Check if the batch wrote this ligand's system
+        if os.path.isfile(simbox) == False:
+            #If not, build it on its own
+            logger.warning("No simulation box for %s in its multisim batch; building it on its own"%ligname)
+            with slot:
+                return main(master_dir, SCHRODINGER, args, charge, ligname, multisim_host, bmincomplex, template_dir)
+
+    #Simulation box exists
+    else:
+        #Document current step
+        logger.info("Simulation box found: %s"%simbox)
+
+    #Return output filename
+    return simbox
 
 def main(master_dir, SCHRODINGER, args, charge, ligname, multisim_host, bmincomplex, template_dir):
     #Prepare Schrodinger multisim command ($SCHRODINGER/utilities/multisim)
@@ -43,32 +158,8 @@ def main(master_dir, SCHRODINGER, args, charge, ligname, multisim_host, bmincomp
 
     #Check that simulation box does not exist
     if os.path.isfile(os.path.join(master_dir, "desmond_md", ligname, "md_setup", simbox)) == False:
-        #If not, check system charge
-        if charge > 0:
-            #If positive, set template filename to positive
-            filename = os.path.join(template_dir, "positive_template.msj")
-
-        elif charge == 0:
-            #If neutral, set template filename to netural
-            filename = os.path.join(template_dir, "neutral_template.msj")
-        
-        #Must be negative
-        else:
-            #If negative, set template filename to negative
-            filename = os.path.join(template_dir, "negative_template.msj")
-        
-        #Read in template file
-        with open(filename, "r") as template:
-            #Put lines in a variable
-            lines = template.readlines()
-        
-        #Open setup filename for writing
-        with open(inputfile, "w") as ligoutput:
-            #Iterate through all the template lines
-            
-            for line in lines:
-                #Write line to out file, replacing solvent keyword with desired solvent
-                ligoutput.write(line.replace("<solvent>",args.solvent))
+        #If not, write setup file from the template for the system charge
+        write_msj(template_dir, charge_class(charge), args, inputfile)
         
         #Generate command for building the box
         command = [run_cmd, "-maxjob", "1", "-JOBNAME", jobname, "-m", inputfile, bmincomplex, "-o", simbox, "-OPLSDIR", args.oplsdir, "-HOST", multisim_host, "-WAIT"]
@@ -76,8 +167,8 @@ def main(master_dir, SCHRODINGER, args, charge, ligname, multisim_host, bmincomp
         #Document current step
         logger.info("Building simulation box: %s"%simbox)
 
-        #Run command
-        run_job(command)
+        #Run multisim
+        submit(command, jobname, outputs=[simbox])
 
     #Simulation box exists
     else:
@@ -9,39 +9,27 @@
 import logging
 import sys
 import os
-import subprocess
 import glob
 
 #Import Schrodinger modules
 from schrodinger import structure
 from schrodinger.structutils import analyze
 
+#Import MDFit modules
+import mdfit_watchdog
+
 ###Initiate logger###
 logger = logging.getLogger(__name__)
 
-def run_job(command):
-    #Run provided command, joining list with space. Pipe stdout and sdterror to log file
-    process = subprocess.run(' '.join(command), stdout=subprocess.PIPE, \
-        stderr=subprocess.STDOUT, shell=True, text=True)
-    
-    #Iterate over sdtout and sdterror
-    for line in process.stdout.split('\n'):
-        #Ignore blank lines
-        if line != "":
-            #Ignore ExitStatus
-            if "ExitStatus" not in line:
-                #Write to log file for debugging
-                logger.debug(line)
-
-def center_traj(SCHRODINGER, cms_path, trj_path, run_cmd, basename, args):
+def center_traj(SCHRODINGER, cms_path, trj_path, run_cmd, basename, args, scratch_dir):
     #Prepare centering command
-    command = [run_cmd, "trj_center.py", "-t", trj_path, "-asl", args.centering_ASL, cms_path, "%s_centered"%basename]
+    command = [run_cmd, "trj_center.py", "-t", trj_path, "-asl", args.centering_ASL.strip('"'), cms_path, "%s_centered"%basename]
 
     #Capture current step
     logger.info("Centering trajectory: %s"%' '.join(command))
 
-    #Run centering command
-    run_job(command)
+    #Run centering command on the CLUSTER backend (local unless parameters.json names another), killed at the CLUSTER limit. Calls mdfit_watchdog.py
+    mdfit_watchdog.run_job(command, logger, "CLUSTER", scratch_dir, "%s_centered"%basename, outputs=["%s_centered-out.cms"%basename, "%s_centered_trj"%basename])
 
 def lig_identifier(args, ref_path):
     #Read in reference structure
@@ -71,46 +59,59 @@ def lig_identifier(args, ref_path):
     #Return ligand ASL
     return ligand
 
-def parch_traj(SCHRODINGER, ligbase, basename, args, run_cmd, center_cms, center_trj, master_dir, ref_path):
+def parch_traj(SCHRODINGER, ligbase, basename, args, run_cmd, center_cms, center_trj, master_dir, ref_path, scratch_dir):
     #Check if parch ASL is set to default
     if args.parch_solv_ASL == '"auto"':
         #If it is, identify ligand ASL using Schrodinger's utilities
         ligand = lig_identifier(args, ref_path)
 
-        #Set argument to identified ligand ASL
-        args.parch_solv_ASL = "%s"%ligand.ligand_asl
+        #Set to identified ligand ASL. Kept local; each ligand has its own ASL
+        parch_solv_ASL = "%s"%ligand.ligand_asl
+
+    #User provided ASL
+    else:
+        #Assign to variable
+        parch_solv_ASL = args.parch_solv_ASL
 
     #Prepare trajectory parching command
-    command = [run_cmd, "trj_parch.py", "-output-trajectory-format", "auto", "-ref-mae", ref_path, "-align-asl", args.parch_align_ASL, "-dew-asl", '"%s"'%args.parch_solv_ASL, "-n", str(args.n_solv), center_cms, center_trj, "%s_parched"%basename]
+    command = [run_cmd, "trj_parch.py", "-output-trajectory-format", "auto", "-ref-mae", ref_path, "-align-asl", args.parch_align_ASL.strip('"'), "-dew-asl", parch_solv_ASL.strip('"'), "-n", str(args.n_solv), center_cms, center_trj, "%s_parched"%basename]
     
     #Capture current step
     logger.info("Parching trajectory: %s"%' '.join(command))
 
-    #Run parching command
-    run_job(command)
+    #Run parching command on the CLUSTER backend (local unless parameters.json names another), killed at the CLUSTER limit. Calls mdfit_watchdog.py
+    mdfit_watchdog.run_job(command, logger, "CLUSTER", scratch_dir, "%s_parched"%basename, outputs=["%s_parched-out.cms"%basename, "%s_parched_trj"%basename])
 
-def cluster_traj(SCHRODINGER, basename, args, run_cmd, ref_path, parch_cms, parch_trj):
+def cluster_traj(SCHRODINGER, basename, args, run_cmd, ref_path, parch_cms, parch_trj, scratch_dir):
     #Check if rmsd ASL is set to default
     if args.rmsd_ASL == '"auto"':
         #If it is, identify ligand ASL using Schrodinger's utilities
         ligand = lig_identifier(args, ref_path)
 
-        #Set argument to identified ligand ASL
-        args.rmsd_ASL = "%s"%ligand.ligand_asl
+        #Set to identified ligand ASL. Kept local; each ligand has its own ASL
+        rmsd_ASL = "%s"%ligand.ligand_asl
+
+    #User provided ASL
+    else:
+        #Assign to variable
+        rmsd_ASL = args.rmsd_ASL
 
     #Prepare trajectory clustering command
-    command = [run_cmd, "trj_cluster.py", parch_cms, parch_trj, "%s_cluster"%basename, "-rmsd-asl", '"%s"'%args.rmsd_ASL, "-n", str(args.n_clusters)]
+    command = [run_cmd, "trj_cluster.py", parch_cms, parch_trj, "%s_cluster"%basename, "-rmsd-asl", rmsd_ASL.strip('"'), "-n", str(args.n_clusters)]
     
     #Capture current step
     logger.info("Clustering trajectory: %s"%' '.join(command))
 
-    #Run clustering command
-    run_job(command)
+    #Run clustering command on the CLUSTER backend (local unless parameters.json names another), killed at the CLUSTER limit. Calls mdfit_watchdog.py
+    mdfit_watchdog.run_job(command, logger, "CLUSTER", scratch_dir, "%s_cluster"%basename, outputs=["%s_cluster_*.cms"%basename])
 
 def main(SCHRODINGER, rep, master_dir, args):
     #Prepare Schrodinger run command ($SCHRODINGER/run)
     run_cmd = os.path.join(SCHRODINGER, 'run')
 
+    #Generate path to analysis scratch space, where trajectory tools write their output
+    scratch_dir = os.path.join(master_dir, "desmond_md_analysis", "scratch")
+
     #Generate basename <ligand>-repetition<#>
     basename = os.path.basename(rep)
 
@@ -149,7 +150,7 @@ def main(SCHRODINGER, rep, master_dir, args):
     #Check if centered trajectory exists
     if os.path.isfile(os.path.join(master_dir, "desmond_md_analysis", ligbase, basename, "%s_centered-out.cms"%basename)) == False:
         #Center trajectory
-        center_traj(SCHRODINGER, cms_path, trj_path, run_cmd, basename, args)
+        center_traj(SCHRODINGER, cms_path, trj_path, run_cmd, basename, args, scratch_dir)
 
         #Generate path to centered trajectory file
         center_cms = os.path.join(master_dir, "desmond_md_analysis", "scratch", "%s_centered-out.cms"%basename)
@@ -171,7 +172,7 @@ def main(SCHRODINGER, rep, master_dir, args):
     #Check if parched trajectory exists
     if os.path.isfile(os.path.join(master_dir, "desmond_md_analysis", ligbase, basename, "%s_parched-out.cms"%basename)) == False:
         #Parch trajectory (remove excess waters)
-        parch_traj(SCHRODINGER, ligbase, basename, args, run_cmd, center_cms, center_trj, master_dir, ref_path)
+        parch_traj(SCHRODINGER, ligbase, basename, args, run_cmd, center_cms, center_trj, master_dir, ref_path, scratch_dir)
 
         #Generate path to parched trajectory file
         parch_cms = os.path.join(master_dir, "desmond_md_analysis", "scratch", "%s_parched-out.cms"%basename)
@@ -196,7 +197,7 @@ def main(SCHRODINGER, rep, master_dir, args):
     #Check if cluster files exist
     if cluster_files == []:
         #Cluster trajectory
-        cluster_traj(SCHRODINGER, basename, args, run_cmd, ref_path, parch_cms, parch_trj)
+        cluster_traj(SCHRODINGER, basename, args, run_cmd, ref_path, parch_cms, parch_trj, scratch_dir)
     
     #Cluster files exist
     else:
@@ -0,0 +1,552 @@
+#!/ap/rhel7/bin/python3.6
+
+####################################################################
+# Corresponding Authors : Alexander Brueckner, Kaushik Lakkaraju ###
+# Contact : alexander.brueckner@bms.com, kaushik.lakkaraju@bms.com #
+####################################################################
+
+#Import Python modules
+import logging
+import sys
+import os
+import json
+import time
+import signal
+import socket
+import struct
+import pwd
+import itertools
+import threading
+import subprocess
+import socketserver
+import tempfile
+import contextlib
+
+#Import MDFit modules
+import mdfit_resources
+
+###Initiate logger###
+logger = logging.getLogger(__name__)
+
+#Default socket of the MDFit daemon. Overridden by "DAEMON" in the "parameters" block of parameters.json
+SOCKET_NAME = "mdfit_daemon.sock"
+
+#Output of a campaign started by the daemon, written to its campaign (master) directory
+OUTPUT_NAME = "MDFit_daemon.out"
+
+#Seconds between checks on campaigns started by the daemon
+POLL = 5
+
+#Client connected to the daemon by this MDFit process. None unless the campaign shares the daemon's budget
+client = None
+
+def socket_path(inst_params):
+    #Get socket from json file, or the default in the temporary directory
+    return inst_params.get("parameters", {}).get("DAEMON", os.path.join(tempfile.gettempdir(), SOCKET_NAME))
+
+def budget(inst_params):
+    #Initiate budget shared by every campaign: concurrent jobs per host class and tokens per license feature
+    shared = {}
+
+    #Get per-host-class limits from json file, or the coordinator default. Calls mdfit_resources.py
+    limits = inst_params.get("workers", {})
+    for hostclass in mdfit_resources.HOST_CLASSES:
+        shared[hostclass] = int(limits.get(hostclass, min(32, os.cpu_count() + 4)))
+
+    #Get license pools from json file; features without a pool size are not shared
+    for feature, settings in inst_params.get("licenses", {}).items():
+        if settings.get("TOKENS") != None:
+            shared[feature] = int(settings["TOKENS"])
+
+    #Return budget
+    return shared
+
+def send(connection, message):
+    #Write one JSON message per line
+    connection.sendall((json.dumps(message) + "\n").encode())
+
+def receive(reader):
+    #Read one JSON message; None if the other side hung up
+    line = reader.readline()
+    if not line:
+        return None
+    return json.loads(line.decode())
+
+def peer(connection):
+    #Get process and user ID on the other end of a Unix socket from the kernel (Linux); None, None if unknown
+    try:
+        pid, uid, gid = struct.unpack("3i", connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+        return pid, uid
+    except (OSError, AttributeError):
+        return None, None
+
+def user_name(uid):
+    #Get user name of a user ID
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+class Campaign:
+    #One MDFit run scheduled by the daemon
+    def __init__(self, number, uid, master_dir, priority, pid, process=None):
+        #Campaign identifier handed back to the user
+        self.number = number
+
+        #User that submitted or registered the campaign; only they may cancel it or draw from the budget for it
+        self.uid = uid
+        self.user = user_name(uid)
+
+        #Campaign (master) directory
+        self.master_dir = master_dir
+
+        #Weight of the campaign's fair share; priority 2 gets twice the share of priority 1
+        self.priority = max(float(priority), 0.01)
+
+        #Process running the campaign, and the Popen handle if the daemon started it
+        self.pid = pid
+        self.process = process
+
+        #running, finished, failed, or cancelled
+        self.state = "running"
+
+        #Resources currently granted (resource > amount)
+        self.held = {}
+
+        #Time campaign was submitted
+        self.start = time.time()
+
+    def share(self, resource):
+        #Amount held per unit of priority; the smallest share is served first
+        return self.held.get(resource, 0)/self.priority
+
+class Request:
+    #One acquire waiting for, or holding, a grant
+    def __init__(self, campaign, resource, amount, sequence):
+        self.campaign = campaign
+        self.resource = resource
+        self.amount = amount
+        self.sequence = sequence
+
+        #None while waiting, True when granted, False when refused
+        self.granted = None
+
+class Scheduler:
+    #Global scheduler: every campaign's jobs draw from one budget, by weighted fair share
+    def __init__(self, budget):
+        #Capacity of every shared resource
+        self.budget = budget
+
+        #Amount of every resource granted
+        self.used = {resource: 0 for resource in budget}
+
+        #Campaigns by identifier
+        self.campaigns = {}
+
+        #Acquires waiting for their resource
+        self.pending = []
+
+        #Guards the scheduler; acquires sleep here until granted
+        self.condition = threading.Condition()
+
+        #Campaign identifiers and arrival order of acquires
+        self.numbers = itertools.count(1)
+        self.sequence = itertools.count()
+
+    def add(self, uid, master_dir, priority, pid, process=None):
+        #Add campaign and return it
+        with self.condition:
+            campaign = Campaign(next(self.numbers), uid, master_dir, priority, pid, process)
+            self.campaigns[campaign.number] = campaign
+
+        #Capture current step
+        logger.info("Campaign %s (%s, priority %s) in %s"%(campaign.number, campaign.user, campaign.priority, master_dir))
+
+        #Return campaign
+        return campaign
+
+    def schedule(self):
+        #Grant waiting acquires while their resource has room. Called with the condition held
+        for resource in self.budget:
+            while True:
+                #Get acquires waiting on this resource
+                waiting = [request for request in self.pending if request.resource == resource]
+                if waiting == []:
+                    break
+
+                #Serve the campaign with the smallest weighted share first; ties go to the oldest acquire
+                request = min(waiting, key=lambda request: (request.campaign.share(resource), request.sequence))
+
+                #Check if it fits. If not, hold the resource for it so large acquires are not starved by small ones
+                if self.used[resource] + request.amount > self.budget[resource]:
+                    break
+
+                #Grant
+                self.pending.remove(request)
+                self.used[resource] += request.amount
+                request.campaign.held[resource] = request.campaign.held.get(resource, 0) + request.amount
+                request.granted = True
+
+        #Wake waiting acquires
+        self.condition.notify_all()
+
+    def owns(self, number, uid):
+        #Check if a user owns a campaign; unknown campaigns are left to the command itself
+        with self.condition:
+            campaign = self.campaigns.get(number)
+            return campaign == None or campaign.uid == uid
+
+    def acquire(self, number, resource, amount):
+        #Wait until a campaign's acquire is granted; return the request, or None if refused
+        with self.condition:
+            #Check campaign is still running
+            campaign = self.campaigns.get(number)
+            if campaign == None or campaign.state != "running":
+                return None
+
+            #Resources outside the budget are not shared; grant right away
+            if resource not in self.budget:
+                request = Request(campaign, resource, 0, next(self.sequence))
+                request.granted = True
+                return request
+
+            #Never ask for more than the budget holds
+            request = Request(campaign, resource, min(int(amount), self.budget[resource]), next(self.sequence))
+
+            #Queue acquire and wait for a grant
+            self.pending.append(request)
+            self.schedule()
+            while request.granted == None:
+                self.condition.wait()
+
+            #Return request if granted
+            return request if request.granted == True else None
+
+    def release(self, request):
+        #Return a grant and serve waiting acquires
+        with self.condition:
+            self.used[request.resource] = self.used.get(request.resource, 0) - request.amount
+            request.campaign.held[request.resource] = request.campaign.held.get(request.resource, 0) - request.amount
+            self.schedule()
+
+    def cancel(self, number):
+        #Stop a campaign: refuse its acquires and terminate its process
+        with self.condition:
+            #Check campaign is running
+            campaign = self.campaigns.get(number)
+            if campaign == None or campaign.state != "running":
+                return False
+
+            #Refuse every acquire still waiting
+            campaign.state = "cancelled"
+            for request in [request for request in self.pending if request.campaign == campaign]:
+                self.pending.remove(request)
+                request.granted = False
+
+            #Serve other campaigns
+            self.schedule()
+
+        #Terminate campaign; a campaign started by the daemon runs in its own process group
+        try:
+            if campaign.process != None:
+                os.killpg(campaign.pid, signal.SIGTERM)
+            else:
+                os.kill(campaign.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+        #Capture current step
+        logger.info("Campaign %s cancelled"%number)
+
+        #Campaign cancelled
+        return True
+
+    def reap(self):
+        #Record campaigns that ended on their own
+        with self.condition:
+            for campaign in self.campaigns.values():
+                #Check campaigns started by the daemon; cancelled ones are collected too
+                if campaign.process != None:
+                    code = campaign.process.poll()
+                    if code != None and campaign.state == "running":
+                        campaign.state = "finished" if code == 0 else "failed"
+
+                #Check running campaigns that registered themselves
+                elif campaign.state == "running":
+                    try:
+                        os.kill(campaign.pid, 0)
+                    except ProcessLookupError:
+                        campaign.state = "finished"
+                    except OSError:
+                        pass
+
+    def status(self):
+        #Return snapshot of campaigns and budget use
+        with self.condition:
+            campaigns = []
+            for campaign in self.campaigns.values():
+                campaigns.append({"campaign": campaign.number, "user": campaign.user, "priority": campaign.priority, "state": campaign.state, "pid": campaign.pid, \
+                    "held": {resource: amount for resource, amount in campaign.held.items() if amount > 0}, \
+                    "waiting": len([request for request in self.pending if request.campaign == campaign]), \
+                    "minutes": (time.time() - campaign.start)/60, "dir": campaign.master_dir})
+            return {"budget": self.budget, "used": dict(self.used), "campaigns": campaigns}
+
+class Handler(socketserver.StreamRequestHandler):
+    #One connection to the daemon: a single command, or an acquire held open until the grant is returned
+    def handle(self):
+        #Get scheduler
+        scheduler = self.server.scheduler
+
+        #Read command
+        message = receive(self.rfile)
+        if message == None:
+            return
+        command = message.get("command")
+
+        #Get process and user on the other end from the kernel; what the client claims is never trusted
+        pid, uid = peer(self.connection)
+
+        #Check if the caller could be identified
+        if uid == None and command != "status":
+            #If not, only the status may be read
+            send(self.connection, {"error": "cannot identify the user on %s"%self.server.server_address})
+
+        #Submit: start MDFit in the user's directory as its own campaign. Campaigns run as the daemon's user, so only that user may submit
+        elif command == "submit":
+            if uid != os.getuid():
+                send(self.connection, {"error": "only %s, who runs the MDFit daemon, may submit campaigns; run MDFit with --daemon instead"%user_name(os.getuid())})
+            else:
+                send(self.connection, {"campaign": self.server.submit(uid, message)})
+
+        #Register: a campaign started by the user joins the budget. Its process is the one connected
+        elif command == "register":
+            campaign = scheduler.add(uid, message["dir"], message.get("priority", 1), pid)
+            send(self.connection, {"campaign": campaign.number})
+
+        #Acquire: hold a grant until the connection is closed, so a campaign that dies returns its resources. Only the campaign's user may draw for it
+        elif command == "acquire":
+            if scheduler.owns(int(message["campaign"]), uid) == False:
+                send(self.connection, {"granted": False, "error": "campaign %s belongs to another user"%message["campaign"]})
+                return
+            request = scheduler.acquire(int(message["campaign"]), message["resource"], message.get("amount", 1))
+            if request == None:
+                send(self.connection, {"granted": False, "error": "campaign %s is not running"%message["campaign"]})
+                return
+            try:
+                send(self.connection, {"granted": True})
+                self.rfile.read()
+            except OSError:
+                pass
+            finally:
+                scheduler.release(request)
+
+        #Status: campaigns and budget use
+        elif command == "status":
+            scheduler.reap()
+            send(self.connection, scheduler.status())
+
+        #Cancel: stop a campaign. Only its user (or root) may
+        elif command == "cancel":
+            if uid != 0 and scheduler.owns(int(message["campaign"]), uid) == False:
+                send(self.connection, {"cancelled": False, "error": "campaign %s belongs to another user"%message["campaign"]})
+            else:
+                send(self.connection, {"cancelled": scheduler.cancel(int(message["campaign"]))})
+
+        #Unknown command
+        else:
+            send(self.connection, {"error": "unknown command %s"%command})
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    #Long-running MDFit service; one thread per connection
+    daemon_threads = True
+
+    def __init__(self, path, MDFit_path, budget):
+        #Remove socket left by a daemon that died
+        if os.path.exists(path) == True:
+            os.remove(path)
+
+        #Bind socket; every user on the host may register campaigns and cancel their own
+        socketserver.UnixStreamServer.__init__(self, path, Handler)
+        os.chmod(path, 0o666)
+
+        #Path to MDFit.py
+        self.MDFit_path = MDFit_path
+
+        #Global scheduler
+        self.scheduler = Scheduler(budget)
+
+    def submit(self, uid, message):
+        #Open output file in campaign directory
+        output = open(os.path.join(message["dir"], OUTPUT_NAME), "a")
+
+        #Launch campaign in its own process group, joined to the daemon's budget. It runs in the daemon's own environment (e.g., $SCHRODINGER)
+        env = dict(os.environ)
+        with self.scheduler.condition:
+            number = next(self.scheduler.numbers)
+            env["MDFIT_CAMPAIGN"] = str(number)
+            env["MDFIT_DAEMON"] = self.server_address
+            process = subprocess.Popen([sys.executable, os.path.join(self.MDFit_path, "MDFit.py")] + message["argv"] + ["--priority", str(message.get("priority", 1))], \
+                cwd=message["dir"], env=env, stdout=output, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+            campaign = Campaign(number, uid, message["dir"], message.get("priority", 1), process.pid, process)
+            self.scheduler.campaigns[number] = campaign
+        output.close()
+
+        #Capture current step
+        logger.info("Campaign %s (%s, priority %s) started in %s: %s"%(number, campaign.user, campaign.priority, message["dir"], " ".join(message["argv"])))
+
+        #Return campaign identifier
+        return number
+
+def reaper(scheduler):
+    #Check campaigns started by the daemon until the daemon stops
+    while True:
+        time.sleep(POLL)
+        scheduler.reap()
+
+def serve(path, MDFit_path, inst_params):
+    #Start daemon
+    server = Server(path, MDFit_path, budget(inst_params))
+
+    #Capture current step
+    logger.info("MDFit daemon listening on %s with budget %s"%(path, server.scheduler.budget))
+    print("MDFit daemon listening on %s with budget %s"%(path, server.scheduler.budget))
+
+    #Track campaigns in the background
+    threading.Thread(target=reaper, args=(server.scheduler,), daemon=True).start()
+
+    #Serve until interrupted
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+def request(path, message):
+    #Send one command to the daemon and return its reply
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except OSError as exc:
+        raise RuntimeError("MDFit daemon is not running on %s: %s"%(path, exc))
+    with connection, connection.makefile("rb") as reader:
+        send(connection, message)
+        return receive(reader)
+
+class Client:
+    #Connection of one campaign to the daemon's budget
+    def __init__(self, path, number):
+        #Daemon socket
+        self.path = path
+
+        #Campaign identifier
+        self.number = number
+
+    def acquire(self, resource, amount=1):
+        #Wait for a grant of resource; return the open connection that holds it
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(self.path)
+        send(connection, {"command": "acquire", "campaign": self.number, "resource": resource, "amount": amount})
+        with connection.makefile("rb") as reader:
+            reply = receive(reader)
+
+        #Check if granted
+        if reply == None or reply.get("granted") != True:
+            connection.close()
+            raise RuntimeError("MDFit daemon refused %s: %s"%(resource, "daemon stopped" if reply == None else reply.get("error")))
+
+        #Return grant
+        return connection
+
+def open_client(path, master_dir, priority):
+    #Check if the daemon started this campaign
+    global client
+    number = os.getenv("MDFIT_CAMPAIGN")
+    if number == None:
+        #If not, register campaign with the daemon; it takes this process from the socket
+        reply = request(path, {"command": "register", "dir": master_dir, "priority": priority})
+
+        #Check if the daemon took the campaign
+        if "campaign" not in reply:
+            raise RuntimeError("MDFit daemon refused the campaign: %s"%reply.get("error"))
+        number = reply["campaign"]
+
+    #Connect campaign to daemon's budget
+    client = Client(path, int(number))
+
+    #Capture current step
+    logger.info("Campaign %s shares the MDFit daemon's budget on %s (priority %s)"%(number, path, priority))
+
+    #Return client
+    return client
+
+def current():
+    #Return client, or None if the campaign does not share the daemon's budget
+    return client
+
+def close():
+    #Leave the daemon's budget
+    global client
+    client = None
+
+def acquire(resource, amount=1):
+    #Wait for resource from the daemon's budget; no-op unless connected
+    if client == None:
+        return None
+    return client.acquire(resource, amount)
+
+def release(grant):
+    #Return grant to the daemon's budget
+    if grant != None:
+        grant.close()
+
+@contextlib.contextmanager
+def slot(resource, amount=1):
+    #Hold resource from the daemon's budget while the block runs
+    grant = acquire(resource, amount)
+    try:
+        yield
+    finally:
+        release(grant)
+
+def report(status):
+    #Print budget use
+    print("Budget (used/total): %s"%", ".join("%s %s/%s"%(resource, status["used"].get(resource, 0), total) for resource, total in status["budget"].items()))
+
+    #Print campaigns
+    print("%-9s %-12s %-9s %-10s %-8s %-8s %s"%("Campaign", "User", "Priority", "State", "Waiting", "Minutes", "Held / directory"))
+    for campaign in status["campaigns"]:
+        print("%-9s %-12s %-9s %-10s %-8s %-8.0f %s"%(campaign["campaign"], campaign["user"], campaign["priority"], campaign["state"], campaign["waiting"], campaign["minutes"], \
+            " ".join("%s=%s"%(resource, amount) for resource, amount in campaign["held"].items())))
+        print("%-9s %s"%("", campaign["dir"]))
+
+def priority(argv):
+    #Get --priority from a submitted command line, and the command line without it
+    if "--priority" in argv[:-1]:
+        index = argv.index("--priority")
+        return float(argv[index + 1]), argv[:index] + argv[index + 2:]
+    return 1, argv
+
+def command(argv, MDFit_path, master_dir, inst_params):
+    #Get daemon socket
+    path = socket_path(inst_params)
+
+    #Start daemon
+    if argv[0] == "daemon":
+        serve(path, MDFit_path, inst_params)
+
+    #Submit the rest of the command line as a campaign in this directory
+    elif argv[0] == "submit":
+        weight, rest = priority(argv[1:])
+        reply = request(path, {"command": "submit", "dir": master_dir, "argv": rest, "priority": weight})
+        print("Submitted campaign %s"%reply["campaign"] if "campaign" in reply else "Not submitted: %s"%reply.get("error"))
+
+    #List campaigns
+    elif argv[0] == "campaigns":
+        report(request(path, {"command": "status"}))
+
+    #Cancel a campaign
+    elif argv[0] == "cancel":
+        reply = request(path, {"command": "cancel", "campaign": int(argv[1])})
+        print("Campaign %s cancelled"%argv[1] if reply["cancelled"] == True else "Campaign %s not cancelled: %s"%(argv[1], reply.get("error", "not running")))
@@ -10,32 +10,28 @@ import logging
 import sys
 import os
 import shutil
-import subprocess
 import glob
+import fnmatch
+import threading
 import concurrent.futures
 
 #Import MDFit modules
+import mdfit_warm_pool
 import mdfit_event_analysis
 import mdfit_extract_dat
 import mdfit_combine_csvs
 import mdfit_cluster_traj
+import mdfit_resources
+import mdfit_state
+import mdfit_fingerprint
+import mdfit_retry
+import mdfit_work_queue
 
 ###Initiate logger###
 logger = logging.getLogger(__name__)
 
-def run_job(command):
-    #Run provided command, joining list with space. Pipe stdout and sdterror to log file
-    process = subprocess.run(' '.join(command), stdout=subprocess.PIPE, \
-        stderr=subprocess.STDOUT, shell=True, text=True)
-    
-    #Iterate over sdtout and sdterror
-    for line in process.stdout.split('\n'):
-        #Ignore blank lines
-        if line != "":
-            #Ignore ExitStatus
-            if "ExitStatus" not in line:
-                #Write to log file for debugging
-                logger.debug(line)
+#Event analysis reports cannot control their output filenames; only one may run at a time
+report_lock = threading.Lock()
 
 def dircheck(master_dir):
     #Generate scratch directory name
@@ -64,8 +60,17 @@ def dircheck(master_dir):
     return newdir
 
 def ligfile_check(master_dir, args):
+    #Get repetitions that finished production from the state database
+    state = mdfit_state.current()
+    completed = state.completed("production") if state != None else []
+
+    #Check if user wants to analyze all ligands and the state database knows the repetitions
+    if args.analysis_lig == "all" and completed != []:
+        #If so, generate list with paths to all repetition directories without searching the filesystem
+        reppaths = [os.path.join(master_dir, "desmond_md", ligbase, basename) for ligbase, basename in completed]
+
     #Check if user wants to analyze all ligands
-    if args.analysis_lig == "all":
+    elif args.analysis_lig == "all":
         #If they do, generate list with paths to all repetition directories
         reppaths = glob.glob(os.path.join(master_dir, "desmond_md", "*", "*repetition*"))
     
@@ -95,32 +100,140 @@ def prep_workers(args):
     #Return number of workers
     return workers
 
+def rep_names(rep):
+    #Generate repetition name <ligname>_repetition<#>
+    basename = os.path.basename(rep)
+
+    #Return ligand name <ligname> and repetition name
+    return basename.split("_repetition")[0], basename
+
 def run_analysis(SCHRODINGER, rep, master_dir, args, inst_params):
+    #Get ligand and repetition names
+    ligbase, basename = rep_names(rep)
+
+    #Generate fingerprints of every stage from the current inputs and arguments
+    fps = mdfit_fingerprint.fingerprints(args, ligbase)
+
+    #Check if event analysis finished in a previous run with the same arguments (state database)
+    if mdfit_state.done(ligbase, basename, "event_analysis", fps["event_analysis"]) == True:
+        #If it did, capture current step
+        logger.info("Event analysis already complete: %s"%basename)
+
+        #Return repetition and empty command - nothing to extract
+        return rep, []
+
+    #Check if event analysis finished with different arguments or trajectory
+    if mdfit_state.stale(ligbase, basename, "event_analysis", fps["event_analysis"]) == True:
+        #If it did, remove old eaf, pdf, and dat files
+        invalidate(master_dir, basename, ["%s-in.eaf"%basename, "%s-out.eaf"%basename, "%s_analysis.pdf"%basename, basename])
+
+    #Record event analysis start in the state database
+    mdfit_state.start(ligbase, basename, "event_analysis", [rep], fps["event_analysis"])
+
     #Analyze given trajectory. Call mdfit_event_analysis.py
-    event_analysis_command2 = mdfit_event_analysis.main(SCHRODINGER, rep, master_dir, args, inst_params)
+    try:
+        event_analysis_command2 = mdfit_event_analysis.main(SCHRODINGER, rep, master_dir, args, inst_params)
+
+    #Record failure before passing it on
+    except Exception as exc:
+        mdfit_state.fail(ligbase, basename, "event_analysis", exc)
+        raise
+
+    #Return repetition and command for serial job
+    return rep, event_analysis_command2
+
+def invalidate(master_dir, basename, patterns):
+    #Get ligand name <ligname>
+    ligbase = basename.split("_repetition")[0]
+
+    #Capture current step
+    logger.warning("Inputs changed for %s; removing out-of-date analysis files: %s"%(basename, ' '.join(patterns)))
+
+    #Remove matching files from scratch and permanent analysis directories
+    mdfit_fingerprint.remove_matching([os.path.join(master_dir, "desmond_md_analysis", "scratch"), os.path.join(master_dir, "desmond_md_analysis", ligbase, basename)], patterns)
 
-    #Return command for serial job
-    return event_analysis_command2
+def dat_extract(pdf_commands, scratch_dir):
+    #Initiate list of repetitions whose report failed, with the error: (repetition, exception)
+    failures = []
+
+    #Iterate over all repetitions and dat extract commands
+    for rep, command in pdf_commands:
+        #Get ligand and repetition names
+        ligbase, basename = rep_names(rep)
+
+        #Check if event analysis finished in a previous run (state database)
+        if mdfit_state.done(ligbase, basename, "event_analysis") == True:
+            #If it did, nothing to record
+            continue
+
+        #Initiate exit status; no report needed if previous eaf and pdf files are found
+        exit_code = 0
 
-def dat_extract(pdf_commands):
-    #Iterate over all dat extract commands
-    for command in pdf_commands:
         #Check if commands were generated. Can be empty if previous eaf files are found
         if command != []:
             #Capture current step
             logger.info("Generating data files: %s"%' '.join(command))
 
-            #Run each job serially
-            run_job(command)
+            #Run each job serially, never alongside a pipelined report (of this or another MDFit process sharing the work queue)
+            #Killed at the ANALYSIS limit. Calls mdfit_warm_pool.py
+            try:
+                with report_lock, mdfit_work_queue.mutex("event_report"):
+                    exit_code = mdfit_warm_pool.run_job(command, logger, scratch_dir, "ANALYSIS").returncode
+
+            #Report ran past its limit
+            except Exception as exc:
+                #Capture error and record stall, so the report is generated again on restart
+                logger.error("Event analysis report for %s: %s"%(basename, exc))
+                mdfit_state.fail(ligbase, basename, "event_analysis", exc)
+
+                #Hand failure to the caller and continue with next repetition
+                failures.append((rep, exc))
+                continue
+
+        #Check if report generation failed
+        if exit_code != 0:
+            #If so, capture error and record failure, so the report is generated again on restart
+            exc = RuntimeError("event analysis report exited with status %s"%exit_code)
+            logger.error("Event analysis report for %s exited with status %s"%(basename, exit_code))
+            mdfit_state.fail(ligbase, basename, "event_analysis", exc, exit_code)
+
+            #Hand failure to the caller and continue with next repetition
+            failures.append((rep, exc))
+            continue
+
+        #Record finished event analysis
+        mdfit_state.finish(ligbase, basename, "event_analysis", ["%s-out.eaf"%basename, "%s_analysis.pdf"%basename], exit_code)
+
+    #Return repetitions that have no report; they must not be tabulated or clustered
+    return failures
 
 def tabulate_simfp(SCHRODINGER, rep, master_dir, args):
-    #Tabulate SimFP and compatibility data. Calls mdfit_extract_dat.py
-    mdfit_extract_dat.main(SCHRODINGER, rep, master_dir, args)
+    #Get ligand and repetition names
+    ligbase, basename = rep_names(rep)
 
-    #Check if clustering will happen
-    if args.skip_cluster == True:
-        #If skipping, do cleanup now
-        cleanup(rep, master_dir, args)
+    #Generate fingerprints of every stage from the current inputs and arguments
+    fps = mdfit_fingerprint.fingerprints(args, ligbase)
+
+    #Check if tabulation finished in a previous run with the same arguments (state database)
+    if mdfit_state.done(ligbase, basename, "tabulate", fps["tabulate"]) == True:
+        #If it did, capture current step
+        logger.info("SimFP tabulation already complete: %s"%basename)
+        return
+
+    #Check if tabulation finished with different arguments (e.g., cutoff) or event analysis
+    if mdfit_state.stale(ligbase, basename, "tabulate", fps["tabulate"]) == True:
+        #If it did, remove old SimFP and compatibility files
+        invalidate(master_dir, basename, ["%s_SimFP.csv"%basename, "%s_compatibility.csv"%basename])
+
+    #Record tabulation in the state database
+    with mdfit_state.track(ligbase, basename, "tabulate", ["%s-out.eaf"%basename], fps["tabulate"]):
+        #Tabulate SimFP and compatibility data. Calls mdfit_extract_dat.py
+        mdfit_extract_dat.main(SCHRODINGER, rep, master_dir, args)
+
+        #Check if clustering will happen
+        if args.skip_cluster == True:
+            #If skipping, do cleanup now
+            cleanup(rep, master_dir, args)
 
 def combine_csvs(master_dir):
     #Combine all tabulated ligand-specific SimFPs and compatibility files into master file (serial)
@@ -162,11 +275,75 @@ def cleanup(rep, master_dir, args):
         shutil.move(file, os.path.join(repdir, os.path.basename(file)))
 
 def cluster_traj(SCHRODINGER, rep, master_dir, args):
-    #Cluster trajectories. Calls mdfit_cluster_traj.py
-    mdfit_cluster_traj.main(SCHRODINGER, rep, master_dir, args)
+    #Get ligand and repetition names
+    ligbase, basename = rep_names(rep)
+
+    #Generate fingerprints of every stage from the current inputs and arguments
+    fps = mdfit_fingerprint.fingerprints(args, ligbase)
+
+    #Check if clustering finished in a previous run with the same arguments (state database)
+    if mdfit_state.done(ligbase, basename, "cluster", fps["cluster"]) == True:
+        #If it did, capture current step
+        logger.info("Clustering already complete: %s"%basename)
+        return
+
+    #Check if clustering finished with different arguments or trajectory
+    if mdfit_state.stale(ligbase, basename, "cluster", fps["cluster"]) == True:
+        #If it did, remove old centered, parched, and clustered trajectories
+        invalidate(master_dir, basename, ["%s_centered*"%basename, "%s_parched*"%basename, "%s_cluster*"%basename])
+
+    #Record clustering in the state database
+    with mdfit_state.track(ligbase, basename, "cluster", [rep], fps["cluster"]):
+        #Cluster trajectories. Calls mdfit_cluster_traj.py
+        mdfit_cluster_traj.main(SCHRODINGER, rep, master_dir, args)
+
+        #Move files from scratch to repetition directories
+        cleanup(rep, master_dir, args)
+
+def pipeline_wanted(rep, args):
+    #Check if user wants to analyze all ligands
+    if args.analysis_lig == "all":
+        #If they do, every repetition is analyzed
+        return True
+
+    #Otherwise, match repetition name the same way ligfile_check does
+    return fnmatch.fnmatch(os.path.basename(rep), "*%s*"%args.analysis_lig)
+
+def pipeline_rep(SCHRODINGER, rep, master_dir, args, inst_params):
+    #Generate scratch directory name without changing directory; Desmond MD still owns the current directory
+    scratch_dir = os.path.join(master_dir, "desmond_md_analysis", "scratch")
+
+    #Make scratch directory if needed. Several repetitions may get here at once
+    os.makedirs(scratch_dir, exist_ok=True)
+
+    #Analyze given trajectory
+    pdf_command = run_analysis(SCHRODINGER, rep, master_dir, args, inst_params)
 
-    #Move files from scratch to repetition directories
-    cleanup(rep, master_dir, args)
+    #Extract dat and png files. Serialized with every other report
+    failures = dat_extract([pdf_command], scratch_dir)
+
+    #Check if the report failed
+    if failures != []:
+        #If so, fail the repetition before tabulation; the caller retries or skips it
+        raise failures[0][1]
+
+    #Tabulate SimFP and compatibility data. Cleans up if clustering is skipped
+    tabulate_simfp(SCHRODINGER, rep, master_dir, args)
+
+    #Check if the user wants to cluster the trajectories
+    if args.skip_cluster == False:
+        #If they do, cluster trajectory and clean up
+        cluster_traj(SCHRODINGER, rep, master_dir, args)
+
+    #Return repetition path
+    return rep
+
+def finish_pipeline(master_dir):
+    #Capture current step
+    logger.info("All pipelined analyses finished. Combining SimFP and compatibility files.")
+
+    #Combine all SimFP and compatibility CSV files into a master file. Must be serial
+    combine_csvs(master_dir)
 
 def main(args, master_dir, SCHRODINGER, inst_params):
     #Generate scratch directory
@@ -180,13 +357,16 @@ def main(args, master_dir, SCHRODINGER, inst_params):
         #Prepare number of workers based on ThreadPoolExecutor suggestion
         workers = prep_workers(args)
 
+        #Prepare number of concurrent event analysis jobs for the ANALYSIS host
+        analysis_workers = mdfit_resources.host_workers(args, inst_params)["ANALYSIS"]
+
         #Initiate empty list for final dat and png file extraction. Has to be run serially
         pdf_commands = []
 
-        #Start parallel task controller
-        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-            #Run MD analysis asynchronously
-            analysis_jobs = {executor.submit(run_analysis, SCHRODINGER, rep, master_dir, args, inst_params): rep for rep in reppaths}
+        #Start parallel task controller. Sized to the analysis queue
+        with concurrent.futures.ThreadPoolExecutor(max_workers=analysis_workers) as executor:
+            #Run MD analysis asynchronously, retrying transient job server and license errors. Calls mdfit_retry.py
+            analysis_jobs = {executor.submit(mdfit_retry.call, args, "event analysis", rep, run_analysis, SCHRODINGER, rep, master_dir, args, inst_params): rep for rep in reppaths}
 
             #For each asynchronous job
             for future in concurrent.futures.as_completed(analysis_jobs):
@@ -199,11 +379,8 @@ def main(args, master_dir, SCHRODINGER, inst_params):
 
                 #If a step in MD analysis fails
                 except Exception as exc:
-                    #Capture error
-                    logger.critical("%s generated an exception during event analysis: %s"%(lig, exc))
-
-                    #Exit
-                    sys.exit()
+                    #Exit, or skip this repetition with --keep_going. Calls mdfit_retry.py
+                    mdfit_retry.handle(args, "event analysis", lig, exc)
 
                 #Otherwise, MD analysis was successful
                 else:
@@ -214,12 +391,17 @@ def main(args, master_dir, SCHRODINGER, inst_params):
         logger.info("Extracting dat and png files serially")
 
         #Limitation of Schrodinger's utility. Cannot control output filenames. Forced to run dat extraction serially.
-        dat_extract(pdf_commands)
+        for rep, exc in dat_extract(pdf_commands, scratch_dir):
+            #Exit, or skip this repetition with --keep_going. Calls mdfit_retry.py
+            mdfit_retry.handle(args, "event analysis", rep, exc)
+
+        #Keep going with repetitions that were analyzed. Calls mdfit_retry.py
+        reppaths = [rep for rep in reppaths if rep not in mdfit_retry.failed("event analysis")]
 
         #Start parallel task controller
         with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
             #Run MD analysis tabulation asynchronously
-            tabulate_jobs = {executor.submit(tabulate_simfp, SCHRODINGER, rep, master_dir, args): rep for rep in reppaths}
+            tabulate_jobs = {executor.submit(mdfit_retry.call, args, "tabulation", rep, tabulate_simfp, SCHRODINGER, rep, master_dir, args): rep for rep in reppaths}
             
             #For each asynchronous job
             for future in concurrent.futures.as_completed(tabulate_jobs):
@@ -232,11 +414,8 @@ def main(args, master_dir, SCHRODINGER, inst_params):
 
                 #If a step in MD analysis tabulation fails
                 except Exception as exc:
-                    #Capture error
-                    logger.critical("%s generated an exception during tabulation: %s"%(lig, exc))
-
-                    #Exit
-                    sys.exit()
+                    #Exit, or skip this repetition with --keep_going. Calls mdfit_retry.py
+                    mdfit_retry.handle(args, "tabulation", lig, exc)
                 
                 #Otherwise, MD analysis tabulation was successful
                 else:
@@ -246,6 +425,9 @@ def main(args, master_dir, SCHRODINGER, inst_params):
         #Combine all SimFP and compatibility CSV files into a master file. Must be serial
         combine_csvs(master_dir)
 
+        #Keep going with repetitions that were tabulated. Calls mdfit_retry.py
+        reppaths = [rep for rep in reppaths if rep not in mdfit_retry.failed("tabulation")]
+
         #Check if the user wants to cluster the trajectories
         if args.skip_cluster == True:
             #If true, document current step
@@ -256,7 +438,7 @@ def main(args, master_dir, SCHRODINGER, inst_params):
             #If they do, start parallel task controller
             with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
                 #Run MD trajectory clustering asynchronously
-                cluster_jobs = {executor.submit(cluster_traj, SCHRODINGER, rep, master_dir, args): rep for rep in reppaths}
+                cluster_jobs = {executor.submit(mdfit_retry.call, args, "clustering", rep, cluster_traj, SCHRODINGER, rep, master_dir, args): rep for rep in reppaths}
 
                 #For each asynchronous job
                 for future in concurrent.futures.as_completed(cluster_jobs):
@@ -269,11 +451,8 @@ def main(args, master_dir, SCHRODINGER, inst_params):
 
                     #If a step in MD trajectory clustering fails
                     except Exception as exc:
-                        #Capture the error
-                        logger.critical("%s generated an exception during clustering: %s"%(lig, exc))
-
-                        #Exit
-                        sys.exit()
+                        #Exit, or skip this repetition with --keep_going. Calls mdfit_retry.py
+                        mdfit_retry.handle(args, "clustering", lig, exc)
                     
                     #Otherwise, MD trajectory clustering was successful
                     else:
@@ -10,37 +10,35 @@ import logging
 import sys
 import os
 import shutil
-import subprocess
 import threading
 import concurrent.futures
 import glob
 import random
+import time
 
 #Import MDFit modules
+import mdfit_exec
+import mdfit_ligand_library
 import mdfit_prep_complex
 import mdfit_run_minimization
 import mdfit_get_charge
 import mdfit_build_box
 import mdfit_run_md
 import mdfit_slicetrj
+import mdfit_desmond_analysis
+import mdfit_resources
+import mdfit_job_monitor
+import mdfit_state
+import mdfit_fingerprint
+import mdfit_schedule
+import mdfit_runtime
+import mdfit_retry
+import mdfit_work_queue
+import mdfit_backends
 
 ###Initiate logger###
 logger = logging.getLogger(__name__)
 
-def run_job(command):
-    #Run provided command, joining list with space. Pipe stdout and sdterror to log file
-    process = subprocess.run(' '.join(command), stdout=subprocess.PIPE, \
-        stderr=subprocess.STDOUT, shell=True, text=True)
-    
-    #Iterate over sdtout and sdterror
-    for line in process.stdout.split('\n'):
-        #Ignore blank lines
-        if line != "":
-            #Ignore ExitStatus
-            if "ExitStatus" not in line:
-                #Write to log file for debugging
-                logger.debug(line)
-
 def random_seed():
     #Initialize random number generator 
     random.seed()
@@ -54,8 +52,8 @@ def dircheck(master_dir):
 
     #Check if scratch directory exists
     if os.path.isdir(newdir) == False:
-        #If not, make scratch directory
-        os.makedirs(newdir)
+        #If not, make scratch directory. Another MDFit process sharing the campaign may get here at once
+        os.makedirs(newdir, exist_ok=True)
 
         #Capture current step
         logger.info("Created directory: %s"%newdir)
@@ -68,26 +66,20 @@ def dircheck(master_dir):
     #Return scratch directory name
     return newdir
 
-def countligs(ligpath, SCHRODINGER):
-    #Check if ligand name file already exists
-    if os.path.isfile("lignames.csv") == False:
-        #If not, set up Schrodinger proplister variable ($SCHRODINGER/utilities/proplister)
-        run_cmd = os.path.join(SCHRODINGER, 'utilities', 'proplister')
-
-        #Set up full command
-        command = [run_cmd, '-p', 'title', '-noheader', ligpath, '-c', '-o', 'lignames.csv']
+def countligs(ligpath, master_dir):
+    #Get shared ligand manifest, built when MDFit was initiated. Calls mdfit_ligand_library.py
+    entries = mdfit_ligand_library.current()
 
-        #Document current step
-        logger.info("Getting lignames: %s"%' '.join(command))
-
-        #Run job
-        run_job(command)
+    #Check if manifest was built
+    if entries == None:
+        #If not, build or read it now
+        entries = mdfit_ligand_library.build(ligpath, master_dir)
 
-    #Read in ligand name file
-    with open("lignames.csv", 'r') as fp:
+    #Write per-ligand files to scratch space by byte offset. Writes lignames.csv
+    mdfit_ligand_library.write_ligands(ligpath, os.getcwd())
 
-        #Get the number of ligands but counting length of file
-        numligs = len(fp.readlines())
+    #Get the number of ligands from the manifest
+    numligs = len(entries)
 
     #Document current step
     logger.info("Number of ligands: %s"%numligs)
@@ -107,31 +99,9 @@ def gen_list(num_ligs):
     #Return list with explicit ligand numbers
     return lignum
 
-def prep_workers(args):
-    #Check if user provided a number of workers
-    if args.max_workers == 0:
-        #If not, return either 32 or (number of cpu+4)
-        workers = min(32, os.cpu_count() + 4)
-    
-    #User provided number of workers
-    else:
-        #Assign to variable
-        workers = args.max_workers
-    
-    #Capture current step
-    logger.info("Using %s workers for executing calls asynchronously"%workers)
-
-    #Return number of workers
-    return workers
-
 def lig_extract(master_dir, i):
-    #Read in ligand name file
-    with open("lignames.csv", 'r') as infile:
-        #Put all ligand names in a variable
-        all_lines = infile.readlines()
-    
-    #Get ligand name for a given ligand number (i). Remove any trailing spaces/new line character
-    ligname_base = all_lines[i].strip()
+    #Get ligand name for a given ligand number (i) from the shared ligand manifest
+    ligname_base = mdfit_ligand_library.title(i)
 
     #Return desired ligand name
     return ligname_base
@@ -243,32 +213,121 @@ def move_copy_files(master_dir, ligname_base, setup_dir, md_names, args, templat
                     #Write to output msj, replacing CONFIG_NAME (repetition-specific cfg filename)
                     ligoutput.write(msjline.replace("CONFIG_NAME","%s_md.cfg"%rep))
 
-def rep_one_setup(SCHRODINGER, ligpath, i, master_dir, args, bmin_host, multisim_host, all_md_names, template_dir):
+def rep_one_setup(SCHRODINGER, ligpath, i, master_dir, args, bmin_host, multisim_host, all_md_names, template_dir, limits):
     #Extract specific ligand from ligand library and get ligand base name
     ligname_base = lig_extract(master_dir, i)
 
-    #Complex protein and ligand. Calls mdfit_prep_complex.py
-    pvcomplex = mdfit_prep_complex.main(SCHRODINGER, ligpath, ligname_base, i, master_dir, args)
+    #Generate fingerprints of every stage from the current inputs and arguments
+    fps = mdfit_fingerprint.fingerprints(args, ligname_base)
+
+    #Check if MD setup finished in a previous run with the same inputs (state database)
+    if mdfit_state.done(ligname_base, "", "setup", fps["setup"]) == True:
+        #If it did, resume without repeating setup
+        return resume_setup(master_dir, ligname_base, args, all_md_names, template_dir, fps)
+
+    #Check if MD setup finished with different inputs
+    if mdfit_state.stale(ligname_base, "", "setup", fps["setup"]) == True:
+        #If it did, remove old setup and everything built on it
+        invalidate_setup(master_dir, ligname_base)
+
+    #Record MD setup in the state database
+    with mdfit_state.track(ligname_base, "", "setup", [ligpath], fps["setup"]) as record:
+        #Complex protein and ligand. Calls mdfit_prep_complex.py
+        pvcomplex = mdfit_prep_complex.main(SCHRODINGER, ligpath, ligname_base, i, master_dir, args)
+
+        #Check if user wants complexes minimized in batches
+        if args.bmin_batch > 1:
+            #If so, minimize with other ligands in one bmin job; the batch takes a BMIN slot. Calls mdfit_run_minimization.py
+            bmincomplex = mdfit_run_minimization.batched(ligname_base, pvcomplex, args, bmin_host, SCHRODINGER, master_dir, template_dir, limits["BMIN"])
+
+        #One bmin job per ligand
+        else:
+            #Wait for a free BMIN slot
+            with limits["BMIN"]:
+                #Minimize prepared complex. Calls mdfit_run_minimization.py
+                bmincomplex = mdfit_run_minimization.main(ligname_base, pvcomplex, args, bmin_host, SCHRODINGER, master_dir, template_dir)
+
+        #Calculate the total charge of the system. Calls mdfit_get_charge.py
+        charge = mdfit_get_charge.main(SCHRODINGER, ligname_base, master_dir, args)
+
+        #Check if user wants simulation boxes built in batches
+        if args.multisim_batch > 1:
+            #If so, build with other ligands of the same charge class in one multisim run; the batch takes a MULTISIM slot. Calls mdfit_build_box.py
+            simbox = mdfit_build_box.batched(master_dir, SCHRODINGER, args, charge, ligname_base, multisim_host, bmincomplex, template_dir, limits["MULTISIM"])
+
+        #One multisim job per ligand
+        else:
+            #Wait for a free MULTISIM slot
+            with limits["MULTISIM"]:
+                #Neutralizes and solvates the minimized protein and ligand complex. Calls mdfit_build_box.py
+                simbox = mdfit_build_box.main(master_dir, SCHRODINGER, args, charge, ligname_base, multisim_host, bmincomplex, template_dir)
+
+        #Blocks multiple threads writing to file at the same time
+        with threading.Lock():
+            #Move MD setup files to permanent directory. Generate permanent directory name and get all repetition names
+            setup_dir, md_names = cleanup_dirs(master_dir, ligname_base, args, all_md_names)
+
+        #Prepares repetition-specfic input files for MD (cfg/msj files)
+        move_copy_files(master_dir, ligname_base, setup_dir, md_names, args, template_dir)
 
-    #Minimize prepared complex. Calls mdfit_run_minimization.py
-    bmincomplex = mdfit_run_minimization.main(ligname_base, pvcomplex, args, bmin_host, SCHRODINGER, master_dir, template_dir)
+        #Record prepared system
+        record.outputs = [os.path.join(setup_dir, "%s_md_setup_out.cms"%ligname_base)]
 
-    #Calculate the total charge of the system. Calls mdfit_get_charge.py
-    charge = mdfit_get_charge.main(SCHRODINGER, ligname_base, master_dir, args)
+    #Return ligand base name and its repetition names
+    return ligname_base, md_names
+
+def resume_setup(master_dir, ligname_base, args, all_md_names, template_dir, fps):
+    #Generate repetition names without touching the filesystem
+    md_names = ["%s_repetition%s"%(ligname_base, j+1) for j in range(args.md_repetitions)]
+
+    #Iterate over repetitions
+    for rep in md_names:
+        #Check if production finished with different arguments (e.g., simulation time)
+        if mdfit_state.stale(ligname_base, rep, "production", fps["production"]) == True:
+            #If it did, remove old trajectory before new inputs are written
+            invalidate_production(master_dir, ligname_base, rep)
 
-    #Neutralizes and solvates the minimized protein and ligand complex. Calls mdfit_build_box.py
-    simbox = mdfit_build_box.main(master_dir, SCHRODINGER, args, charge, ligname_base, multisim_host, bmincomplex, template_dir)
+    #Find repetitions that still need production
+    missing = [rep for rep in md_names if mdfit_state.done(ligname_base, rep, "production", fps["production"]) == False]
 
-    #Blocks multiple threads writing to file at the same time
-    with threading.Lock():
-        #Move MD setup files to permanent directory. Generate permanent directory name and get all repetition names
+    #Capture current step
+    logger.info("MD setup already complete: %s (%s of %s repetitions still need production)"%(ligname_base, len(missing), len(md_names)))
+
+    #Check if every repetition finished production
+    if missing == []:
+        #If so, only record repetition names
+        all_md_names.extend(md_names)
+
+    #Some repetitions still need production
+    else:
+        #Make repetition directories and record repetition names
         setup_dir, md_names = cleanup_dirs(master_dir, ligname_base, args, all_md_names)
 
-    #Prepares repetition-specfic input files for MD (cfg/msj files)
-    move_copy_files(master_dir, ligname_base, setup_dir, md_names, args, template_dir)
+        #Prepare input files for the remaining repetitions only
+        move_copy_files(master_dir, ligname_base, setup_dir, missing, args, template_dir)
 
-    #Return ligand base name
-    return ligname_base
+    #Return ligand base name and its repetition names
+    return ligname_base, md_names
+
+def invalidate_setup(master_dir, ligname_base):
+    #Capture current step
+    logger.warning("MD setup inputs changed for %s; removing old setup and trajectories"%ligname_base)
+
+    #Remove setup and repetition directories desmond_md/<ligname>
+    mdfit_fingerprint.remove_outputs([os.path.join(master_dir, "desmond_md", ligname_base)])
+
+    #Remove leftover files in scratch space
+    mdfit_fingerprint.remove_matching([os.path.join(master_dir, "desmond_md", "scratch")], ["%s_*"%ligname_base, "%s.*"%ligname_base, "%s-*"%ligname_base])
+
+def invalidate_production(master_dir, ligname_base, rep):
+    #Capture current step
+    logger.warning("Production arguments changed for %s; removing old trajectory"%rep)
+
+    #Remove repetition directory desmond_md/<ligname>/<ligname>_repetition<#>
+    mdfit_fingerprint.remove_outputs([os.path.join(master_dir, "desmond_md", ligname_base, rep)])
+
+    #Remove leftover repetition files (including old cfg/msj files) in scratch space
+    mdfit_fingerprint.remove_matching([os.path.join(master_dir, "desmond_md", "scratch")], ["%s_*"%rep, "%s.*"%rep, "%s-*"%rep])
 
 def move_trj_files(master_dir, lig, lig_basename):
     #Get list of all files in desmond_md/scratch/<ligname>* to move
@@ -288,19 +347,562 @@ def move_trj_files(master_dir, lig, lig_basename):
             #Copy to permanent location
             shutil.move(file, os.path.join(master_dir, "desmond_md", lig_basename, lig, os.path.basename(file)))
 
-def md_production(SCHRODINGER, master_dir, args, desmond_host, lig):
-    #Run Desmond MD. Generate output trajectory filenames and ligand basename for future use. Calls mdfit_run_md.py
-    outcms, outtrj, lig_basename = mdfit_run_md.main(lig, args, desmond_host, SCHRODINGER, master_dir)
+def md_production(SCHRODINGER, master_dir, args, desmond_host, lig, licenses):
+    #Generate output trajectory filenames and ligand basename. Calls mdfit_run_md.py
+    outcms, outtrj, lig_basename = mdfit_run_md.trj_names(lig)
+
+    #Generate fingerprints of every stage from the current inputs and arguments
+    fps = mdfit_fingerprint.fingerprints(args, lig_basename)
+
+    #Check if production finished in a previous run with the same arguments (state database)
+    if mdfit_state.done(lig_basename, lig, "production", fps["production"]) == True:
+        #If it did, capture current step
+        logger.info("Production already complete: %s"%lig)
 
-    #Slice trajectory (remove frames). Calls mdfit_slicetrj.py
-    sliced_trj = mdfit_slicetrj.main(SCHRODINGER, lig, master_dir, args)
+        #Slice trajectory if the slice window changed. Return output trajectory filenames
+        return md_finish(SCHRODINGER, master_dir, args, lig)
 
-    #Move Desmond MD trajectory files to permanent directory
-    move_trj_files(master_dir, lig, lig_basename)
+    #Record production start in the state database
+    mdfit_state.start(lig_basename, lig, "production", ["%s_md.cms"%lig, "%s_md.cfg"%lig, "%s_md.msj"%lig], fps["production"])
+
+    #Run Desmond MD once license tokens are free. Calls mdfit_run_md.py
+    try:
+        #Check if user wants one relaxation per ligand
+        if args.shared_relax == True:
+            #If so, relax ligand (once) and start this repetition from the relaxed system
+            mdfit_run_md.shared_relax(lig, args, desmond_host, SCHRODINGER, master_dir, licenses)
+
+        #Check if user wants repetitions of a ligand packed into one submission
+        if args.rep_pack > 1:
+            #If so, run with the ligand's other repetitions
+            mdfit_run_md.pack_main(lig, args, desmond_host, SCHRODINGER, master_dir, licenses)
+
+        #One submission per repetition
+        else:
+            mdfit_run_md.main(lig, args, desmond_host, SCHRODINGER, master_dir, licenses)
+
+    #Record failure before passing it on
+    except Exception as exc:
+        mdfit_state.fail(lig_basename, lig, "production", exc)
+        raise
+
+    #Move and slice trajectory. Return output trajectory filenames
+    return md_finish(SCHRODINGER, master_dir, args, lig)
+
+def md_launch(SCHRODINGER, master_dir, args, desmond_host, lig, licenses, limits):
+    #Generate ligand basename. Calls mdfit_run_md.py
+    lig_basename = mdfit_run_md.trj_names(lig)[2]
+
+    #Generate fingerprints of every stage from the current inputs and arguments
+    fps = mdfit_fingerprint.fingerprints(args, lig_basename)
+
+    #Check if production finished in a previous run with the same arguments (state database)
+    if mdfit_state.done(lig_basename, lig, "production", fps["production"]) == True:
+        #If it did, nothing to wait on
+        return None
+
+    #Record production start in the state database
+    mdfit_state.start(lig_basename, lig, "production", ["%s_md.cms"%lig, "%s_md.cfg"%lig, "%s_md.msj"%lig], fps["production"])
+
+    #Submit Desmond MD to the job monitor once a Desmond slot and license tokens are free. Calls mdfit_run_md.py
+    #Returns a future for the running job, or None if the trajectory already exists
+    try:
+        #Check if user wants one relaxation per ligand
+        if args.shared_relax == True:
+            #If so, relax ligand (once) and start this repetition from the relaxed system
+            mdfit_run_md.shared_relax(lig, args, desmond_host, SCHRODINGER, master_dir, licenses)
+
+        return mdfit_run_md.submit(lig, args, desmond_host, SCHRODINGER, master_dir, licenses, limits["DESMOND"], mdfit_backends.monitor("DESMOND"))
+
+    #Record failure before passing it on
+    except Exception as exc:
+        mdfit_state.fail(lig_basename, lig, "production", exc)
+        raise
+
+def md_finish(SCHRODINGER, master_dir, args, lig):
+    #Generate output trajectory filenames and ligand basename. Calls mdfit_run_md.py
+    outcms, outtrj, lig_basename = mdfit_run_md.trj_names(lig)
+
+    #Generate fingerprints of every stage from the current inputs and arguments
+    fps = mdfit_fingerprint.fingerprints(args, lig_basename)
+
+    #Generate path to permanent repetition directory
+    repdir = os.path.join(master_dir, "desmond_md", lig_basename, lig)
+
+    #Check if production was already recorded (state database)
+    if mdfit_state.done(lig_basename, lig, "production", fps["production"]) == False:
+        #If not, check that Desmond wrote a trajectory and merge segments of restarted runs into one. Calls mdfit_run_md.py
+        try:
+            mdfit_run_md.check_trj(lig, master_dir)
+            mdfit_run_md.merge_segments(lig, SCHRODINGER)
+
+            #Move Desmond MD trajectory files to permanent directory
+            move_trj_files(master_dir, lig, lig_basename)
+
+        #Record failure before passing it on
+        except Exception as exc:
+            mdfit_state.fail(lig_basename, lig, "production", exc)
+            raise
+
+        #Record finished trajectory
+        mdfit_state.finish(lig_basename, lig, "production", [os.path.join(repdir, outcms), os.path.join(repdir, outtrj)], mdfit_run_md.exit_codes.pop(lig, 0), fps["production"], mdfit_run_md.run_times.pop(lig, None))
+
+    #Slice trajectory (remove frames), unless already sliced with the same window
+    md_slice(SCHRODINGER, master_dir, args, lig, fps)
 
     #Return output trajectory filenames
     return outcms, outtrj
 
+def md_slice(SCHRODINGER, master_dir, args, lig, fps):
+    #Get ligand basename
+    lig_basename = lig.split("_repetition")[0]
+
+    #Check if slice finished in a previous run with the same window (state database)
+    if mdfit_state.done(lig_basename, lig, "slice", fps["slice"]) == True:
+        #If it did, nothing to do
+        return
+
+    #Check if trajectory was sliced with a different window
+    if mdfit_state.stale(lig_basename, lig, "slice", fps["slice"]) == True:
+        #If it was, capture current step
+        logger.warning("Slice window changed for %s; removing old sliced trajectory"%lig)
+
+        #Remove old sliced trajectory from permanent and scratch space
+        mdfit_fingerprint.remove_matching([os.path.join(master_dir, "desmond_md", lig_basename, lig), os.path.join(master_dir, "desmond_md", "scratch")], ["%s_sliced*"%lig])
+
+    #Record slice in the state database
+    with mdfit_state.track(lig_basename, lig, "slice", ["%s-out.cms"%lig], fps["slice"]) as record:
+        #Slice trajectory (remove frames). Calls mdfit_slicetrj.py
+        sliced_trj = mdfit_slicetrj.main(SCHRODINGER, lig, master_dir, args)
+
+        #Move sliced trajectory files to permanent directory
+        move_trj_files(master_dir, lig, lig_basename)
+
+        #Record sliced trajectory, if one was made
+        record.outputs = glob.glob(os.path.join(master_dir, "desmond_md", lig_basename, lig, "%s_sliced*"%lig))
+
+def barrier_md(SCHRODINGER, ligpath, lignum, master_dir, args, bmin_host, multisim_host, desmond_host, all_md_names, template_dir, workers, licenses, inst_params):
+    #Generate one slot limit per host class
+    limits = mdfit_resources.host_limits(workers)
+
+    #Start parallel task controller. Sized so either setup host class can be filled
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers["BMIN"], workers["MULTISIM"])) as executor:
+        #Run MD setup asynchronously, retrying transient job server and license errors. Calls mdfit_retry.py
+        setup_jobs = {executor.submit(mdfit_retry.call, args, "MD setup", mdfit_ligand_library.title(lig), rep_one_setup, SCHRODINGER, ligpath, lig, master_dir, args, bmin_host, multisim_host, all_md_names, template_dir, limits): lig for lig in lignum}
+
+        #For each asynchronous job
+        for future in concurrent.futures.as_completed(setup_jobs):
+            #Capture the output
+            lig = setup_jobs[future]
+
+            #Try getting the ligname
+            try:
+                ligname_base, md_names = future.result()
+            
+            #If a step in MD setup fails
+            except Exception as exc:
+                #Exit, or skip this ligand with --keep_going. Calls mdfit_retry.py
+                mdfit_retry.handle(args, "MD setup", mdfit_ligand_library.title(lig), exc)
+            
+            #Otherwise, MD setup was successful
+            else:
+                #Capture current step
+                logger.info("Setup success: %s"%(ligname_base))
+    
+    #Capture current step
+    logger.info("MD setup complete. Launching %s production jobs."%len(all_md_names))
+
+    #Start parallel task controller. Sized to the Desmond queue
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers["DESMOND"]) as executor:
+        #Warn about jobs predicted to run past the Desmond limit and estimate production time. Calls mdfit_runtime.py
+        mdfit_runtime.check_budget(master_dir, all_md_names, workers["DESMOND"], mdfit_resources.runtime_limit(inst_params, "DESMOND"))
+
+        #Order production by estimated cost (runtime model, or size of each solvated system), if requested. Calls mdfit_schedule.py
+        prod_order = mdfit_schedule.order(all_md_names, lambda rep: mdfit_schedule.rep_cost(master_dir, rep), args.schedule, "Production")
+
+        #Run MD asynchronously, retrying transient job server and license errors. Calls mdfit_retry.py
+        prod_jobs = {executor.submit(mdfit_retry.call, args, "production MD", lig, md_production, SCHRODINGER, master_dir, args, desmond_host, lig, licenses): lig for lig in prod_order}
+
+        #For each asynchronous job
+        for future in concurrent.futures.as_completed(prod_jobs):
+            #Capture the output
+            lig = prod_jobs[future]
+
+            #Try getting the trajectory names
+            try:
+                outcms, outtrj = future.result()
+
+            #If a step in MD fails
+            except Exception as exc:
+                #Exit, or skip this repetition with --keep_going. Calls mdfit_retry.py
+                mdfit_retry.handle(args, "production MD", lig, exc)
+            
+            #Otherwise, MD was successful
+            else:
+                #Capture current step
+                logger.info("Production success: %s, %s"%(outcms, outtrj))
+
+def stream_md(SCHRODINGER, ligpath, lignum, master_dir, args, bmin_host, multisim_host, desmond_host, all_md_names, template_dir, workers, licenses, inst_params):
+    #Generate one slot limit per host class
+    limits = mdfit_resources.host_limits(workers)
+
+    #Start parallel task controllers for setup, production, and analysis. Each pool is sized to its own host class
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers["BMIN"], workers["MULTISIM"])) as setup_executor, concurrent.futures.ThreadPoolExecutor(max_workers=workers["DESMOND"]) as prod_executor, concurrent.futures.ThreadPoolExecutor(max_workers=workers["ANALYSIS"]) as analysis_executor:
+        #Run MD setup asynchronously, retrying transient job server and license errors. Calls mdfit_retry.py
+        setup_jobs = {setup_executor.submit(mdfit_retry.call, args, "MD setup", mdfit_ligand_library.title(lig), rep_one_setup, SCHRODINGER, ligpath, lig, master_dir, args, bmin_host, multisim_host, all_md_names, template_dir, limits): lig for lig in lignum}
+
+        #Initiate dictionaries for production and analysis jobs
+        #With the job monitor, production is launched (launch_jobs), runs remotely (running_jobs), then is sliced and moved (prod_jobs)
+        launch_jobs = {}
+        running_jobs = {}
+        prod_jobs = {}
+        analysis_jobs = {}
+
+        #Attempts made so far for each repetition whose remote job failed
+        attempts = {}
+
+        #Track every job that has not finished yet
+        pending = set(setup_jobs)
+
+        #Keep going until setup and production are both finished
+        while pending:
+            #Wait for any job to finish
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            #Iterate over finished jobs
+            for future in done:
+                #Check if a setup job finished
+                if future in setup_jobs:
+                    #Try getting the ligname and repetition names
+                    try:
+                        ligname_base, md_names = future.result()
+
+                    #If a step in MD setup fails
+                    except Exception as exc:
+                        #Exit, or skip this ligand with --keep_going. Calls mdfit_retry.py
+                        mdfit_retry.handle(args, "MD setup", mdfit_ligand_library.title(setup_jobs[future]), exc)
+                        continue
+
+                    #Capture current step
+                    logger.info("Setup success: %s. Launching %s production jobs."%(ligname_base, len(md_names)))
+
+                    #Warn about jobs predicted to run past the Desmond limit. Calls mdfit_runtime.py
+                    mdfit_runtime.check_budget(master_dir, md_names, workers["DESMOND"], mdfit_resources.runtime_limit(inst_params, "DESMOND"))
+
+                    #Send each repetition of this ligand straight to production
+                    for rep in md_names:
+                        #Check if jobs are tracked by the job monitor. Packed repetitions wait on their pack instead
+                        if mdfit_backends.monitor("DESMOND") != None and args.rep_pack <= 1:
+                            #If so, submit MD without holding a thread while it runs
+                            launch_future = prod_executor.submit(mdfit_retry.call, args, "production MD", rep, md_launch, SCHRODINGER, master_dir, args, desmond_host, rep, licenses, limits)
+
+                            #Remember which repetition the job belongs to
+                            launch_jobs[launch_future] = rep
+
+                            #Add to list of jobs to wait on
+                            pending.add(launch_future)
+
+                        #Jobs are run with -WAIT
+                        else:
+                            #Run MD asynchronously
+                            prod_future = prod_executor.submit(mdfit_retry.call, args, "production MD", rep, md_production, SCHRODINGER, master_dir, args, desmond_host, rep, licenses)
+
+                            #Remember which repetition the job belongs to
+                            prod_jobs[prod_future] = rep
+
+                            #Add to list of jobs to wait on
+                            pending.add(prod_future)
+
+                #Check if a production job was submitted or finished running
+                elif future in launch_jobs or future in running_jobs:
+                    #Capture the output
+                    lig = launch_jobs.get(future, running_jobs.get(future))
+
+                    #Try getting the submitted job
+                    try:
+                        job = future.result()
+
+                    #If submission or the remote job fails
+                    except Exception as exc:
+                        #Record failure in the state database
+                        mdfit_state.fail(lig.split("_repetition")[0], lig, "production", exc)
+
+                        #Check if the remote job hit a transient error and can be retried
+                        if future in running_jobs and mdfit_retry.should_retry(args, exc, attempts.get(lig, 0)):
+                            #If so, count attempt
+                            attempts[lig] = attempts.get(lig, 0) + 1
+
+                            #Capture error
+                            logger.warning("production MD %s failed with a transient error: %s"%(lig, exc))
+
+                            #Submit MD again after backing off
+                            launch_future = prod_executor.submit(mdfit_retry.retry, args, "production MD", lig, attempts[lig], md_launch, SCHRODINGER, master_dir, args, desmond_host, lig, licenses, limits)
+
+                            #Remember which repetition the job belongs to
+                            launch_jobs[launch_future] = lig
+
+                            #Add to list of jobs to wait on
+                            pending.add(launch_future)
+
+                        #Error is not worth retrying
+                        else:
+                            #Exit, or skip this repetition with --keep_going. Calls mdfit_retry.py
+                            mdfit_retry.handle(args, "production MD", lig, exc)
+
+                        #Nothing more to do for this job
+                        continue
+
+                    #Check if a remote job was just submitted
+                    if future in launch_jobs and job != None:
+                        #If so, wait on it with the rest of the jobs
+                        running_jobs[job] = lig
+                        pending.add(job)
+
+                    #Trajectory exists or the remote job finished
+                    else:
+                        #Slice and move trajectory asynchronously
+                        prod_future = prod_executor.submit(md_finish, SCHRODINGER, master_dir, args, lig)
+
+                        #Remember which repetition the job belongs to
+                        prod_jobs[prod_future] = lig
+
+                        #Add to list of jobs to wait on
+                        pending.add(prod_future)
+
+                #Check if a production job finished
+                elif future in prod_jobs:
+                    #Capture the output
+                    lig = prod_jobs[future]
+
+                    #Try getting the trajectory names
+                    try:
+                        outcms, outtrj = future.result()
+
+                    #If a step in MD fails
+                    except Exception as exc:
+                        #Check if a remote job tracked by the monitor stopped early and can resume from its checkpoint
+                        if mdfit_backends.monitor("DESMOND") != None and args.rep_pack <= 1 and mdfit_retry.should_retry(args, exc, attempts.get(lig, 0)):
+                            #If so, count attempt
+                            attempts[lig] = attempts.get(lig, 0) + 1
+
+                            #Capture error
+                            logger.warning("production MD %s stopped early: %s"%(lig, exc))
+
+                            #Submit MD again after backing off
+                            launch_future = prod_executor.submit(mdfit_retry.retry, args, "production MD", lig, attempts[lig], md_launch, SCHRODINGER, master_dir, args, desmond_host, lig, licenses, limits)
+
+                            #Remember which repetition the job belongs to
+                            launch_jobs[launch_future] = lig
+
+                            #Add to list of jobs to wait on
+                            pending.add(launch_future)
+
+                        #Error is not worth retrying
+                        else:
+                            #Exit, or skip this repetition with --keep_going. Calls mdfit_retry.py
+                            mdfit_retry.handle(args, "production MD", lig, exc)
+
+                        #Nothing more to do for this job
+                        continue
+
+                    #Capture current step
+                    logger.info("Production success: %s, %s"%(outcms, outtrj))
+
+                    #Generate path to permanent repetition directory desmond_md/<ligname>/<ligname>_repetition<#>
+                    rep = os.path.join(master_dir, "desmond_md", lig.split("_repetition")[0], lig)
+
+                    #Check if user wants this repetition analyzed right away
+                    if args.pipeline_analysis and mdfit_desmond_analysis.pipeline_wanted(rep, args):
+                        #If they do, run analysis asynchronously
+                        analysis_future = analysis_executor.submit(mdfit_retry.call, args, "pipelined analysis", lig, mdfit_desmond_analysis.pipeline_rep, SCHRODINGER, rep, master_dir, args, inst_params)
+
+                        #Remember which repetition the job belongs to
+                        analysis_jobs[analysis_future] = lig
+
+                        #Add to list of jobs to wait on
+                        pending.add(analysis_future)
+
+                #Otherwise, an analysis job finished
+                else:
+                    #Capture the output
+                    lig = analysis_jobs[future]
+
+                    #Try getting the analysis result
+                    try:
+                        future.result()
+
+                    #If a step in MD analysis fails
+                    except Exception as exc:
+                        #Exit, or skip this repetition with --keep_going. Calls mdfit_retry.py
+                        mdfit_retry.handle(args, "pipelined analysis", lig, exc)
+                        continue
+
+                    #Capture current step
+                    logger.info("Analysis success: %s"%(lig))
+
+    #Check if analysis was pipelined
+    if args.pipeline_analysis:
+        #If it was, combine per-repetition results now that every repetition is done
+        mdfit_desmond_analysis.finish_pipeline(master_dir)
+
+def run_item(SCHRODINGER, ligpath, master_dir, args, bmin_host, multisim_host, desmond_host, all_md_names, template_dir, licenses, inst_params, limits, item):
+    #Check if item is a ligand's MD setup
+    if item["stage"] == "setup":
+        #If so, set up ligand by its number in the library, retrying transient job server and license errors. Calls mdfit_retry.py
+        return mdfit_retry.call(args, "MD setup", item["ligand"], rep_one_setup, SCHRODINGER, ligpath, mdfit_ligand_library.entry(item["ligand"]).number, master_dir, args, bmin_host, multisim_host, all_md_names, template_dir, limits)
+
+    #Check if item is a repetition's production
+    if item["stage"] == "production":
+        #If so, run MD, retrying transient job server and license errors. Calls mdfit_retry.py
+        return mdfit_retry.call(args, "production MD", item["repetition"], md_production, SCHRODINGER, master_dir, args, desmond_host, item["repetition"], licenses)
+
+    #Otherwise, analyze repetition in desmond_md/<ligname>/<ligname>_repetition<#>
+    return mdfit_retry.call(args, "pipelined analysis", item["repetition"], mdfit_desmond_analysis.pipeline_rep, SCHRODINGER, os.path.join(master_dir, "desmond_md", item["ligand"], item["repetition"]), master_dir, args, inst_params)
+
+def queue_md(SCHRODINGER, ligpath, lignum, master_dir, args, bmin_host, multisim_host, desmond_host, all_md_names, template_dir, workers, licenses, inst_params):
+    #Generate one slot limit per host class
+    limits = mdfit_resources.host_limits(workers)
+
+    #Get shared work queue. Calls mdfit_work_queue.py
+    queue = mdfit_work_queue.current()
+
+    #Check if this process fills the queue
+    if queue.first == True:
+        #If so, add one setup item per ligand, in scheduled order, and the final combine
+        for position, lig in enumerate(lignum):
+            queue.add("setup", mdfit_ligand_library.title(lig), "", position)
+
+        #Combining per-repetition results runs once, after everything else
+        if args.pipeline_analysis:
+            queue.add("combine", "all")
+
+        #Let other MDFit processes start claiming
+        queue.ready()
+
+    #Get number of items of each stage run at once, sized to the host class that runs it
+    slots = {"setup": max(workers["BMIN"], workers["MULTISIM"]), "production": workers["DESMOND"], "analysis": workers["ANALYSIS"]}
+
+    #Get number of ligands this process may set up (MAXLIGS applies per process)
+    setup_budget = inst_params["parameters"]["MAXLIGS"]
+
+    #Start parallel task controllers for setup, production, and analysis. Each pool is sized to its own host class
+    with concurrent.futures.ThreadPoolExecutor(max_workers=slots["setup"]) as setup_executor, concurrent.futures.ThreadPoolExecutor(max_workers=slots["production"]) as prod_executor, concurrent.futures.ThreadPoolExecutor(max_workers=slots["analysis"]) as analysis_executor:
+        #Get pool of each stage
+        executors = {"setup": setup_executor, "production": prod_executor, "analysis": analysis_executor}
+
+        #Initiate dictionary for claimed items: future > item
+        running = {}
+
+        #Keep claiming until the queue is drained
+        while True:
+            #Fill free slots, later stages first so ligands already started finish before new ones begin
+            for stage in ("analysis", "production", "setup"):
+                while len([item for item in running.values() if item["stage"] == stage]) < slots[stage] and (stage != "setup" or setup_budget > 0):
+                    #Claim next item of the stage
+                    item = queue.claim(stage)
+
+                    #Check if anything was claimed
+                    if item == None:
+                        #If not, try the next stage
+                        break
+
+                    #Count ligand against this process's setup budget
+                    if stage == "setup":
+                        setup_budget -= 1
+
+                    #Run item asynchronously
+                    running[executors[stage].submit(run_item, SCHRODINGER, ligpath, master_dir, args, bmin_host, multisim_host, desmond_host, all_md_names, template_dir, licenses, inst_params, limits, item)] = item
+
+            #Check if anything is running
+            if running == {}:
+                #If not, check if every setup, production, and analysis item is finished
+                if all(queue.finished(stage) for stage in ("setup", "production", "analysis")):
+                    #If so, the queue is drained
+                    break
+
+                #Check if no other process holds an item that could add new work
+                if setup_budget == 0 and queue.active() == False:
+                    #If so, capture current step
+                    logger.warning("This MDFit process set up its limit of %s ligands (MAXLIGS); remaining ligands are left to other MDFit processes"%inst_params["parameters"]["MAXLIGS"])
+
+                    #Stop claiming
+                    break
+
+                #Wait for other processes to finish or add items
+                time.sleep(mdfit_work_queue.POLL)
+                continue
+
+            #Wait for any item to finish, looking at the queue again at least every poll
+            done, not_done = concurrent.futures.wait(running, timeout=mdfit_work_queue.POLL, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            #Iterate over finished items
+            for future in done:
+                #Get item
+                item = running.pop(future)
+
+                #Get name of ligand or repetition and name of stage
+                name = item["repetition"] if item["repetition"] != "" else item["ligand"]
+                stage = {"setup": "MD setup", "production": "production MD", "analysis": "pipelined analysis"}[item["stage"]]
+
+                #Try getting the result
+                try:
+                    result = future.result()
+
+                #If a step fails
+                except Exception as exc:
+                    #Mark item as failed so no other process repeats it
+                    queue.fail(item, exc)
+
+                    #Exit, or skip this ligand or repetition with --keep_going. Calls mdfit_retry.py
+                    mdfit_retry.handle(args, stage, name, exc)
+                    continue
+
+                #Check if setup finished
+                if item["stage"] == "setup":
+                    #Get ligname and repetition names
+                    ligname_base, md_names = result
+
+                    #Capture current step
+                    logger.info("Setup success: %s. Queuing %s production jobs."%(ligname_base, len(md_names)))
+
+                    #Warn about jobs predicted to run past the Desmond limit. Calls mdfit_runtime.py
+                    mdfit_runtime.check_budget(master_dir, md_names, workers["DESMOND"], mdfit_resources.runtime_limit(inst_params, "DESMOND"))
+
+                    #Queue each repetition's production, for any process to claim
+                    for rep in md_names:
+                        queue.add("production", ligname_base, rep, item["number"])
+
+                #Check if production finished
+                elif item["stage"] == "production":
+                    #Capture current step
+                    logger.info("Production success: %s, %s"%result)
+
+                    #Check if user wants this repetition analyzed
+                    if args.pipeline_analysis and mdfit_desmond_analysis.pipeline_wanted(os.path.join(master_dir, "desmond_md", item["ligand"], item["repetition"]), args):
+                        #If they do, queue analysis, for any process to claim
+                        queue.add("analysis", item["ligand"], item["repetition"], item["number"])
+
+                #Otherwise, analysis finished
+                else:
+                    #Capture current step
+                    logger.info("Analysis success: %s"%name)
+
+                #Mark item as done. New items are added first, so the queue never looks drained in between
+                queue.complete(item)
+
+    #Check if analysis was pipelined
+    if args.pipeline_analysis:
+        #If it was, try claiming the final combine; only one process gets it, once every other item is finished
+        item = queue.claim("combine")
+
+        #Check if this process got it
+        if item != None:
+            #If so, combine per-repetition results now that every repetition is done
+            mdfit_desmond_analysis.finish_pipeline(master_dir)
+
+            #Mark combine as done
+            queue.complete(item)
+
 def main(args, master_dir, ligfileprefix, SCHRODINGER, ligpath, template_dir, inst_params):
     ###TODO: check if lignames are unique
 
@@ -339,73 +941,56 @@ def main(args, master_dir, ligfileprefix, SCHRODINGER, ligpath, template_dir, in
         logger.debug("Desmond hostname is %s"%desmond_host)
 
         #Get number of ligs for parallelization
-        num_ligs = countligs(ligpath, SCHRODINGER)
+        num_ligs = countligs(ligpath, master_dir)
 
         #Generate a list with ligand numbers [0, 1, 2, ...]
         lignum = gen_list(num_ligs)
 
-        #Prepare number of workers based on ThreadPoolExecutor suggestion
-        workers = prep_workers(args)
+        #Order setup by estimated cost (atom count from the ligand manifest), if requested. Calls mdfit_schedule.py
+        lignum = mdfit_schedule.order(lignum, mdfit_schedule.ligand_cost, args.schedule, "Setup", mdfit_ligand_library.title)
 
-        #Initiate list to capture names for MD jobs
-        all_md_names = []
+        #Prepare number of concurrent jobs for each host class (parameters.json, or ThreadPoolExecutor suggestion)
+        workers = mdfit_resources.host_workers(args, inst_params)
 
-        #Start parallel task controller
-        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-            #Run MD setup asynchronously
-            setup_jobs = {executor.submit(rep_one_setup, SCHRODINGER, ligpath, lig, master_dir, args, bmin_host, multisim_host, all_md_names, template_dir): lig for lig in lignum}
+        #Prepare license pool for Desmond GPU jobs
+        licenses = mdfit_resources.license_pool(inst_params, "DESMOND_GPGPU")
 
-            #For each asynchronous job
-            for future in concurrent.futures.as_completed(setup_jobs):
-                #Capture the output
-                lig = setup_jobs[future]
+        #Check if the license pool runs fewer Desmond jobs at once than the DESMOND limit
+        if licenses.capacity() != None and licenses.capacity() < workers["DESMOND"]:
+            #If so, document warning; more slots would only queue on tokens
+            logger.warning("DESMOND_GPGPU pool runs %s jobs at once; lowering DESMOND workers from %s to %s"%(licenses.capacity(), workers["DESMOND"], licenses.capacity()))
 
-                #Try getting the ligname
-                try:
-                    ligname_base = future.result()
-                
-                #If a step in MD setup fails
-                except Exception as exc:
-                    #Capture error
-                    logger.critical("An exception occurred during MD setup: %s"%(exc))
+            #Match workers to the pool
+            workers["DESMOND"] = licenses.capacity()
 
-                    #Exit
-                    sys.exit()
-                
-                #Otherwise, MD setup was successful
-                else:
-                    #Capture current step
-                    logger.info("Setup success: %s"%(ligname_base))
-        
-        #Capture current step
-        logger.info("MD setup complete. Launching %s production jobs."%len(all_md_names))
+        #Check if repetition packs need more tokens than the pool holds
+        if licenses.capacity() != None and args.rep_pack > licenses.capacity():
+            #If so, document warning and split packs to what the pool can admit
+            logger.warning("--rep_pack %s needs more DESMOND_GPGPU tokens than the pool holds; packing %s repetitions per submission"%(args.rep_pack, licenses.capacity()))
 
-        #Start parallel task controller
-        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-            #Run MD asynchronously
-            prod_jobs = {executor.submit(md_production, SCHRODINGER, master_dir, args, desmond_host, lig): lig for lig in all_md_names}
+            #Shrink packs
+            args.rep_pack = licenses.capacity()
 
-            #For each asynchronous job
-            for future in concurrent.futures.as_completed(prod_jobs):
-                #Capture the output
-                lig = prod_jobs[future]
+        #Initiate list to capture names for MD jobs
+        all_md_names = []
 
-                #Try getting the trajectory names
-                try:
-                    outcms, outtrj = future.result()
+        #Check if user wants the campaign shared with other MDFit processes through a work queue
+        if args.work_queue == True:
+            #If they do, claim setup, production, and analysis items until the queue is drained
+            queue_md(SCHRODINGER, ligpath, lignum, master_dir, args, bmin_host, multisim_host, desmond_host, all_md_names, template_dir, workers, licenses, inst_params)
 
-                #If a step in MD fails
-                except Exception as exc:
-                    #Capture error
-                    logger.critical("%s generated an exception during production MD: %s"%(outcms, exc))
+        #Check if user wants production to start as soon as each ligand is set up
+        elif args.stream_md == True:
+            #If they do, run setup and production as one stream
+            stream_md(SCHRODINGER, ligpath, lignum, master_dir, args, bmin_host, multisim_host, desmond_host, all_md_names, template_dir, workers, licenses, inst_params)
 
-                    #Exit
-                    sys.exit()
-                
-                #Otherwise, MD was successful
-                else:
-                    #Capture current step
-                    logger.info("Production success: %s, %s"%(outcms, outtrj))
+        #Otherwise, finish all setup before launching production
+        else:
+            #Run setup and production in separate phases
+            barrier_md(SCHRODINGER, ligpath, lignum, master_dir, args, bmin_host, multisim_host, desmond_host, all_md_names, template_dir, workers, licenses, inst_params)
+
+        #Summarize time spent waiting on licenses versus running
+        licenses.summary()
 
     #Capture current step
     logger.info("Changing directory to %s"%master_dir)
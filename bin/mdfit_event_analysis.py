@@ -9,28 +9,19 @@
 import logging
 import sys
 import os
-import subprocess
 
 #Fixes issue with X11 forwarding
 os.environ['QT_QPA_PLATFORM']='offscreen'
 
+#Import MDFit modules
+import mdfit_job_monitor
+import mdfit_watchdog
+import mdfit_backends
+import mdfit_warm_pool
+
 ###Initiate logger###
 logger = logging.getLogger(__name__)
 
-def run_job(command):
-    #Run provided command, joining list with space. Pipe stdout and sdterror to log file
-    process = subprocess.run(' '.join(command), stdout=subprocess.PIPE, \
-        stderr=subprocess.STDOUT, shell=True, text=True)
-    
-    #Iterate over sdtout and sdterror
-    for line in process.stdout.split('\n'):
-        #Ignore blank lines
-        if line != "":
-            #Ignore ExitStatus
-            if "ExitStatus" not in line:
-                #Write to log file for debugging
-                logger.debug(line)
-
 def dircheck(master_dir, basename):
     #Generate directory name in scratch space for each ligand <ligname>-repetition<#>
     newdir = os.path.join(master_dir, "desmond_md_analysis", "scratch", basename)
@@ -100,6 +91,9 @@ def main(SCHRODINGER, rep, master_dir, args, inst_params):
     #Prepare Schrodinger run command ($SCHRODINGER/run)
     run_cmd = os.path.join(SCHRODINGER, 'run')
 
+    #Generate path to analysis scratch space, where event analysis writes its output
+    scratch_dir = os.path.join(master_dir, "desmond_md_analysis", "scratch")
+
     #Get repetition name <ligname>-repetition<#>
     basename = os.path.basename(rep)
 
@@ -120,9 +114,9 @@ def main(SCHRODINGER, rep, master_dir, args, inst_params):
         #If not, prepare directory for text data and plot files
         data_dir = dircheck(master_dir, basename)
 
-        #Need to wrap ASL in double quotes for Schrodinger to interpret
-        prot_ASL = '"%s"'%args.prot_ASL
-        lig_ASL = '"%s"'%args.lig_ASL
+        #Commands run without a shell, so each ASL is already one argument. Remove shell-style quotes
+        prot_ASL = args.prot_ASL.strip('"')
+        lig_ASL = args.lig_ASL.strip('"')
 
         #Prepare event analysis (analyze) command
         event_analysis_command1 = [run_cmd, "event_analysis.py", "analyze", cms_path, "-p", prot_ASL, "-l", lig_ASL, "-out", basename]
@@ -137,13 +131,23 @@ def main(SCHRODINGER, rep, master_dir, args, inst_params):
         logger.info("Generating eaf file: %s"%' '.join(event_analysis_command1))
 
         #Run event analysis (analyze) command
-        run_job(event_analysis_command1)
+        mdfit_warm_pool.run_job(event_analysis_command1, logger, scratch_dir, "ANALYSIS")
 
         #Capture current step
         logger.info("Running simulation analysis: %s"%' '.join(analyze_simulation_command))
 
-        #Run simulation analysis command
-        run_job(analyze_simulation_command)
+        #Get shared job monitor, if the user asked for one and this host class runs on jobcontrol. Calls mdfit_backends.py
+        monitor = mdfit_backends.monitor("ANALYSIS")
+
+        #Check if jobs are tracked by the monitor
+        if monitor != None:
+            #If so, submit without -WAIT and wait on the monitor
+            monitor.run(mdfit_job_monitor.detach(analyze_simulation_command), basename, scratch_dir, mdfit_watchdog.limit("ANALYSIS"), outputs=[eaf_out])
+
+        #Jobs are run with -WAIT, or on another backend
+        else:
+            #Run simulation analysis command, killing it at the ANALYSIS limit. Calls mdfit_watchdog.py
+            mdfit_watchdog.run_job(analyze_simulation_command, logger, "ANALYSIS", scratch_dir, outputs=[eaf_out])
 
         #Limitation of Schrodinger's code. Cannot control output filenames and asynchronous calls clash. Forced to run serially.
         #Return event analysis (report) command
@@ -0,0 +1,180 @@
+#!/ap/rhel7/bin/python3.6
+
+####################################################################
+# Corresponding Authors : Alexander Brueckner, Kaushik Lakkaraju ###
+# Contact : alexander.brueckner@bms.com, kaushik.lakkaraju@bms.com #
+####################################################################
+
+#Import Python modules
+import logging
+import os
+import signal
+import asyncio
+import threading
+import time
+
+###Initiate logger###
+logger = logging.getLogger(__name__)
+
+#Longest line read from a job before it is split (bytes)
+LINE_LIMIT = 1024 * 1024
+
+#Longest wait for a killed job's output to close (seconds). Processes that left the job's group can keep the pipe open
+DRAIN_TIMEOUT = 10
+
+#Set once MDFit is told to stop (e.g., its campaign is cancelled); no job is started after it
+stopping = threading.Event()
+
+#Process group of every running job: pid > command
+running = {}
+running_lock = threading.Lock()
+
+class JobResult:
+    #Exit status and timing of a finished command
+    def __init__(self, command, returncode, elapsed, timed_out, cancelled):
+        self.command = command
+        self.returncode = returncode
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+
+async def stream_output(process, joblogger, on_line):
+    #Read stdout and stderr line by line while the job runs
+    while True:
+        #Get next line
+        line = await process.stdout.readline()
+
+        #Stop at end of output
+        if not line:
+            break
+
+        #Decode and remove trailing newline
+        line = line.decode(errors="replace").rstrip()
+
+        #Ignore blank lines
+        if line != "":
+            #Ignore ExitStatus
+            if "ExitStatus" not in line:
+                #Write to log file for debugging
+                joblogger.debug(line)
+
+            #Hand line to caller, if requested (e.g., to find a JobId)
+            if on_line != None:
+                on_line(line)
+
+async def watch_cancel(cancel):
+    #Wait until another thread asks for the job to be cancelled
+    while not cancel.is_set():
+        await asyncio.sleep(0.5)
+
+async def kill(process):
+    #Stop job and every process it started; the job leads its own process group
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+    #Collect exit status
+    await process.wait()
+
+async def drain(job):
+    #Wait for a killed job's output to close, but never without bound
+    try:
+        await asyncio.wait_for(job, DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Output of a killed job still open after %s s; not waiting for it"%DRAIN_TIMEOUT)
+
+async def run_job_async(command, joblogger, cwd=None, timeout=None, cancel=None, on_line=None):
+    #Check if MDFit is stopping
+    if stopping.is_set():
+        #If so, start nothing new
+        raise RuntimeError("MDFit is stopping; not running %s"%command[0])
+
+    #Start timer
+    start = time.time()
+
+    #Execute argument list directly; no shell process in between. The job leads a new process group so it can be killed with its children
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, \
+        stderr=asyncio.subprocess.STDOUT, cwd=cwd, limit=LINE_LIMIT, start_new_session=True)
+
+    #Register job so it can be killed if MDFit stops; one started while stopping is killed at once
+    with running_lock:
+        running[process.pid] = command
+    if stopping.is_set():
+        await kill(process)
+
+    #Run job, always unregistering it
+    try:
+        return await wait_job(process, command, joblogger, start, timeout, cancel, on_line)
+    finally:
+        with running_lock:
+            running.pop(process.pid, None)
+
+async def wait_job(process, command, joblogger, start, timeout, cancel, on_line):
+    #Stream output and wait for exit in one task
+    job = asyncio.ensure_future(asyncio.gather(stream_output(process, joblogger, on_line), process.wait()))
+
+    #Tasks to wait on; the cancel watcher only exists if the caller can cancel
+    waiting = {job}
+    if cancel != None:
+        watcher = asyncio.ensure_future(watch_cancel(cancel))
+        waiting.add(watcher)
+
+    #Initiate flags
+    timed_out = False
+    cancelled = False
+
+    #Wait for job, timeout, or cancellation
+    try:
+        done, waiting = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+    #Coroutine itself was cancelled
+    except asyncio.CancelledError:
+        #Stop job before passing cancellation on
+        await kill(process)
+        job.cancel()
+        raise
+
+    #Check if job did not finish
+    if job not in done:
+        #Check if it was cancelled or ran out of time
+        cancelled = cancel != None and cancel.is_set()
+        timed_out = not cancelled
+
+        #Capture current step
+        joblogger.warning("%s after %.1f s, killing: %s"%("Cancelled" if cancelled else "Timed out", time.time() - start, ' '.join(command)))
+
+        #Stop job and drain its output
+        await kill(process)
+        await drain(job)
+
+    #Stop cancel watcher, if running
+    for task in waiting:
+        task.cancel()
+
+    #Get elapsed time
+    elapsed = time.time() - start
+
+    #Document exit status and timing
+    joblogger.debug("Exit status %s after %.1f s: %s"%(process.returncode, elapsed, command[0]))
+
+    #Return exit status and timing
+    return JobResult(command, process.returncode, elapsed, timed_out, cancelled)
+
+def terminate():
+    #Start no more jobs, and kill every running one with everything it started
+    stopping.set()
+    with running_lock:
+        pids = list(running)
+    for pid in pids:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    #Return number of jobs killed
+    return len(pids)
+
+def run_job(command, joblogger, cwd=None, timeout=None, cancel=None, on_line=None):
+    #Run provided command in its own event loop so every worker thread can call it. Output goes to the caller's logger as it arrives
+    return asyncio.run(run_job_async(command, joblogger, cwd, timeout, cancel, on_line))
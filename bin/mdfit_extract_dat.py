@@ -234,7 +234,7 @@ def main(SCHRODINGER, rep, master_dir, args):
     #Cannot fine dat files
     else:
         #Capture error
-        logger.critical("Dat files could not be located for %s. Try removing desmond_md_analysis directory are re-running analysis."%basename)
+        logger.critical("Dat files could not be located for %s. Remove %s-out.eaf and MDFit_state.db, then re-run analysis to regenerate them."%(basename, basename))
 
         #Exit
         sys.exit()
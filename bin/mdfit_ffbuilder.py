@@ -10,28 +10,17 @@ import logging
 import sys
 import os
 import shutil
-import subprocess
 import time
 import tarfile
 import glob
 
+#Import MDFit modules
+import mdfit_exec
+import mdfit_watchdog
+
 ###Initiate logger###
 logger = logging.getLogger(__name__)
 
-def run_job(command):
-    #Run provided command, joining list with space. Pipe stdout and sdterror to log file
-    process = subprocess.run(' '.join(command), stdout=subprocess.PIPE, \
-        stderr=subprocess.STDOUT, shell=True, text=True)
-    
-    #Iterate over sdtout and sdterror
-    for line in process.stdout.split('\n'):
-        #Ignore blank lines
-        if line != "":
-            #Ignore ExitStatus
-            if "ExitStatus" not in line:
-                #Write to log file for debugging
-                logger.debug(line)
-
 def prep_hostname(args, inst_params):
     #Add job-server prefix to host and append number of processors
     hostname = inst_params["hostnames"]["FFBUILDER"]
@@ -140,8 +129,8 @@ def ffbuilder(forcefieldfilepath, SCHRODINGER, ligfileprefix, ligpath, newdir, f
     #Capture current step
     logger.info("Running FFBuilder: %s"%' '.join(command))
 
-    #Run FFBuilder
-    run_job(command)
+    #Run FFBuilder, killing it at the FFBUILDER limit. Calls mdfit_watchdog.py
+    mdfit_watchdog.run_job(command, logger, "FFBUILDER", outputs=[outopls])
 
     #Return path to output opls file
     return outopls
@@ -186,7 +175,7 @@ def FFcleanup(forcefieldfilepath, forcefieldfile, homepath, outopls, SCHRODINGER
             logger.info("Upgrading custom parameters: %s"%' '.join(command))
 
             #Run upgrade
-            run_job(command)
+            mdfit_exec.run_job(command, logger)
 
             #Capture current step
             logger.info("Copying upgraded custom parameters to desired oplsdir")
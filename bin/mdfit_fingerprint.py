@@ -0,0 +1,163 @@
+#!/ap/rhel7/bin/python3.6
+
+####################################################################
+# Corresponding Authors : Alexander Brueckner, Kaushik Lakkaraju ###
+# Contact : alexander.brueckner@bms.com, kaushik.lakkaraju@bms.com #
+####################################################################
+
+#Import Python modules
+import logging
+import os
+import shutil
+import glob
+import json
+import hashlib
+import threading
+
+#Import MDFit modules
+import mdfit_ligand_library
+
+###Initiate logger###
+logger = logging.getLogger(__name__)
+
+#Path to template directory (MDFit/templates)
+template_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates")
+
+#Arguments that change the output of each stage
+STAGE_ARGS = {
+    "setup": ("prot", "precomplex", "solvent", "oplsdir"),
+    "production": ("md_sim_time", "md_traj_write_freq", "shared_relax", "oplsdir"),
+    "slice": ("slice_start", "slice_end"),
+    "event_analysis": ("prot_ASL", "lig_ASL"),
+    "tabulate": ("analysis_cutoff",),
+    "cluster": ("centering_ASL", "parch_align_ASL", "parch_solv_ASL", "n_solv", "rmsd_ASL", "n_clusters"),
+}
+
+#Templates each stage is written from. Edited templates change the stage's fingerprint
+STAGE_TEMPLATES = {
+    "setup": ("bmin_template.com", "positive_template.msj", "neutral_template.msj", "negative_template.msj"),
+    "production": ("desmond_md_job_template.cfg", "desmond_md_job_template.msj"),
+}
+
+#Stage whose output each stage reads. A changed upstream fingerprint changes every stage below it
+UPSTREAM = {
+    "setup": None,
+    "production": "setup",
+    "slice": "production",
+    "event_analysis": "slice",
+    "tabulate": "event_analysis",
+    "cluster": "slice",
+}
+
+#Input files and directories are hashed once per MDFit run: path > digest
+digests = {}
+directory_digests = {}
+digest_lock = threading.Lock()
+
+def file_digest(path):
+    #Check if a file was provided
+    if path == None:
+        #If not, nothing to hash
+        return None
+
+    #Hash each input file once
+    with digest_lock:
+        #Check if file was already hashed
+        if path not in digests:
+            #If not, hash file contents in blocks
+            sha = hashlib.sha256()
+            with open(path, 'rb') as fp:
+                for block in iter(lambda: fp.read(1024*1024), b''):
+                    sha.update(block)
+
+            #Keep digest
+            digests[path] = sha.hexdigest()
+
+    #Return digest
+    return digests[path]
+
+def directory_digest(path):
+    #Check if directory exists (e.g., no custom force field)
+    if path == None or os.path.isdir(path) == False:
+        #If not, nothing to hash
+        return None
+
+    #Check if directory was already hashed
+    with digest_lock:
+        if path in directory_digests:
+            return directory_digests[path]
+
+    #Hash name and contents of every file under the directory, in a fixed order
+    sha = hashlib.sha256()
+    for root, dirs, files in sorted(os.walk(path)):
+        dirs.sort()
+        for each_file in sorted(files):
+            sha.update(os.path.relpath(os.path.join(root, each_file), path).encode())
+            sha.update(file_digest(os.path.join(root, each_file)).encode())
+
+    #Keep digest
+    with digest_lock:
+        directory_digests[path] = sha.hexdigest()
+
+    #Return digest
+    return directory_digests[path]
+
+def structure_digest(args):
+    #Hash protein file, or precomplexed file if no protein was provided. First call must be made from the working directory
+    return file_digest(args.prot if args.prot else args.precomplex)
+
+def stage_fingerprint(args, stage, ligand, upstream):
+    #Collect stage name, relevant arguments, and upstream fingerprint
+    inputs = {"stage": stage, "ligand": ligand, "upstream": upstream}
+    for arg in STAGE_ARGS[stage]:
+        inputs[arg] = getattr(args, arg, None)
+
+    #Setup also depends on the contents of the protein (or precomplexed) structure file and the ligand's own structure. Calls mdfit_ligand_library.py
+    if stage == "setup":
+        inputs["structure"] = structure_digest(args)
+        inputs["ligand_structure"] = mdfit_ligand_library.structure_digest(ligand)
+
+    #Setup and production depend on the custom force field files
+    if stage in ("setup", "production"):
+        inputs["force_field"] = directory_digest(getattr(args, "oplsdir", None))
+
+    #Templates the stage is written from
+    for template in STAGE_TEMPLATES.get(stage, ()):
+        inputs[template] = file_digest(os.path.join(template_dir, template))
+
+    #Return hash of everything above
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+def fingerprints(args, ligand):
+    #Generate fingerprint of every stage for a ligand, following each stage's upstream chain
+    fps = {}
+    for stage in ("setup", "production", "slice", "event_analysis", "tabulate", "cluster"):
+        fps[stage] = stage_fingerprint(args, stage, ligand, fps.get(UPSTREAM[stage]))
+
+    #Return fingerprints
+    return fps
+
+def remove_outputs(paths):
+    #Iterate over output files and directories of an out-of-date stage
+    for path in paths:
+        #Remove directories (e.g., trajectories)
+        if os.path.isdir(path) == True:
+            shutil.rmtree(path)
+
+        #Remove files
+        elif os.path.isfile(path) == True:
+            os.remove(path)
+
+        #Nothing to remove
+        else:
+            continue
+
+        #Capture current step
+        logger.info("Removed out-of-date output: %s"%path)
+
+def remove_matching(directories, patterns):
+    #Iterate over directories that may hold stage outputs
+    for directory in directories:
+        #Remove everything matching each output pattern
+        for pattern in patterns:
+            remove_outputs(glob.glob(os.path.join(directory, pattern)))
@@ -9,27 +9,35 @@
 import logging
 import os
 import shutil
-import subprocess
 import re
 
+#Import MDFit modules
+import mdfit_warm_pool
+import mdfit_ligand_library
+
 ###Initiate logger###
 logger = logging.getLogger(__name__)
 
-def run_job(command):
-    #Run provided command, joining list with space. Pipe stdout and sdterror to log file
-    process = subprocess.run(' '.join(command), stdout=subprocess.PIPE, \
-        stderr=subprocess.STDOUT, shell=True, text=True)
-    
-    #Iterate over sdtout and sdterror
-    for line in process.stdout.split('\n'):
-        #Ignore blank lines
-        if line != "":
-            #Ignore ExitStatus
-            if "ExitStatus" not in line:
-                #Write to log file for debugging
-                logger.debug(line)
-
 def main(SCHRODINGER, ligname, master_dir, args):
+    #Get ligand from the shared ligand manifest
+    entry = mdfit_ligand_library.entry(ligname)
+
+    #Check if the manifest has the ligand's formal charge
+    if entry != None:
+        #If so, precomplexed structures already include the protein
+        if args.precomplex:
+            totQ = entry.formal_charge
+
+        #Add protein charge, read once for every ligand
+        else:
+            totQ = entry.formal_charge + mdfit_ligand_library.protein_charge(os.path.join(master_dir, args.prot))
+
+        #Document current step
+        logger.info("Total system charge for %s (ligand manifest): %s"%(ligname, totQ))
+
+        #Return total system charge
+        return totQ
+
     #Prepare Schrodinger proplister command ($SCHRODINGER/utilities/proplister)
     run_cmd = os.path.join(SCHRODINGER, "utilities", "proplister")
 
@@ -39,7 +47,7 @@ def main(SCHRODINGER, ligname, master_dir, args):
         command = [run_cmd, "-atom_bond_props", "%s_out_complex_min.mae"%ligname, "-c", "-o", "%s.csv"%ligname]
 
         #Run proplister
-        run_job(command)
+        mdfit_warm_pool.run_job(command, logger)
 
     #Proplister has been run before
     else:
@@ -9,28 +9,14 @@
 import logging
 import sys
 import os
-import subprocess
 
-#Import Schrodinger modules
-from schrodinger import structure
+#Import MDFit modules
+import mdfit_warm_pool
+import mdfit_ligand_library
 
 ###Initiate logger###
 logger = logging.getLogger(__name__)
 
-def run_job(command):
-    #Run provided command, joining list with space. Pipe stdout and sdterror to log file
-    process = subprocess.run(' '.join(command), stdout=subprocess.PIPE, \
-        stderr=subprocess.STDOUT, shell=True, text=True)
-    
-    #Iterate over sdtout and sdterror
-    for line in process.stdout.split('\n'):
-        #Ignore blank lines
-        if line != "":
-            #Ignore ExitStatus
-            if "ExitStatus" not in line:
-                #Write to log file for debugging
-                logger.debug(line)
-
 def filecheck(args, master_dir):
     #Document current step
     logger.info('Checking working directory for provided files: %s'%master_dir)
@@ -95,14 +81,21 @@ def set_vars(args, master_dir, SCHRODINGER):
     
     #Check if ligand library extension is mae and convert to SDF for downstream compatibility and non-Schrodinger MD engines
     if ligfiletype == ".mae" and not args.precomplex:
-        #Set up Schrodinger run command ($SCHRODINGER/utilities/structconvert)
-        run_cmd = os.path.join(SCHRODINGER, 'utilities', 'structconvert')
+        #Check if the library was already converted (e.g., by another MDFit process draining the same work queue)
+        if args.work_queue == True and os.path.isfile("%s.sdf"%ligfileprefix) and os.path.getmtime("%s.sdf"%ligfileprefix) >= os.path.getmtime(args.liglib):
+            #If so, never rewrite a file other processes are reading
+            logger.info("Converted ligand library found: %s.sdf"%ligfileprefix)
+
+        #Library needs converting
+        else:
+            #Set up Schrodinger run command ($SCHRODINGER/utilities/structconvert)
+            run_cmd = os.path.join(SCHRODINGER, 'utilities', 'structconvert')
 
-        #Prepare full command to convert mae file to sdf
-        command = [run_cmd, args.liglib, "%s.sdf"%ligfileprefix]
+            #Prepare full command to convert mae file to sdf
+            command = [run_cmd, args.liglib, "%s.sdf"%ligfileprefix]
 
-        #Run the command using subprocess
-        run_job(command)
+            #Run the command
+            mdfit_warm_pool.run_job(command, logger)
 
         #Change filetype to sdf
         ligfiletype = ".sdf"
@@ -110,19 +103,15 @@ def set_vars(args, master_dir, SCHRODINGER):
     #Return ligand library extension, ligand library name, and protein extension
     return ligfiletype, ligfileprefix, protfiletype
 
-def count_ligs(args, ligfiletype, maxliglimit):
-    #Initiate variable
-    nlig = 0
-    
-    #Use StructureReader to iterate through ligands
+def count_ligs(args, ligfileprefix, master_dir, maxliglimit):
+    #Generate path to ligand library (sdf library, converted if needed, or precomplexed structures)
     if args.liglib and not args.precomplex:
-        for s in structure.StructureReader(args.liglib):
-            #Increment nlig for each ligand
-            nlig+=1
+        ligpath = os.path.join(master_dir, "%s.sdf"%ligfileprefix)
     elif args.precomplex:
-        for s in structure.StructureReader(args.precomplex):
-            #Increment nlig for each ligand
-            nlig+=1
+        ligpath = os.path.join(master_dir, args.precomplex)
+
+    #Read library once, keeping each ligand's name, position, and properties for every later stage. Calls mdfit_ligand_library.py
+    nlig = len(mdfit_ligand_library.build(ligpath, master_dir))
 
     #If ligands are not found
     if nlig == 0:
@@ -137,8 +126,8 @@ def count_ligs(args, ligfiletype, maxliglimit):
         #Document current step
         logger.info("Number of ligands in library = %s"%nlig)
 
-        #Check that the number of ligands is less than the max limit for MD
-        if nlig > maxliglimit and args.skip_md == False:
+        #Check that the number of ligands is less than the max limit for MD. With a work queue, the limit is per MDFit process instead
+        if nlig > maxliglimit and args.skip_md == False and args.work_queue == False:
             #If true, log error
             logger.critical("Number of ligands in library (%s) exceeds the "\
             "allowed limit (%s); cannot proceed" % (nlig, maxliglimit))
@@ -157,7 +146,7 @@ def main(args, master_dir, maxliglimit, SCHRODINGER):
     ligfiletype, ligfileprefix, protfiletype = set_vars(args, master_dir, SCHRODINGER)
     
     #Count number of ligands in ligand library
-    nlig = count_ligs(args, ligfiletype, maxliglimit)
+    nlig = count_ligs(args, ligfileprefix, master_dir, maxliglimit)
 
     #Return ligand library extension, ligand library name, protein extension, and number of ligands
     return ligfiletype, ligfileprefix, protfiletype, nlig
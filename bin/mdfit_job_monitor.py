@@ -0,0 +1,518 @@
+#!/ap/rhel7/bin/python3.6
+
+####################################################################
+# Corresponding Authors : Alexander Brueckner, Kaushik Lakkaraju ###
+# Contact : alexander.brueckner@bms.com, kaushik.lakkaraju@bms.com #
+####################################################################
+
+#Import Python modules
+import logging
+import sys
+import os
+import re
+import glob
+import subprocess
+import threading
+import time
+import tempfile
+import shutil
+import concurrent.futures
+
+#Import MDFit modules
+import mdfit_exec
+import mdfit_state
+
+###Initiate logger###
+logger = logging.getLogger(__name__)
+
+#Job states reported by jobcontrol. Failure states are checked first
+FAILED_STATES = ("died", "killed", "fizzled", "failed", "stranded", "stopped", "canceled", "cancelled")
+FINISHED_STATES = ("completed", "finished")
+
+#Consecutive polls a job may be missing from jobcontrol -list before it is failed
+MISSING_POLLS = 3
+
+#Pattern for the job ID printed by every jobcontrol submission
+jobid_finder = re.compile(r'JobId:\s*(\S+)')
+
+#Monitor shared by every stage, if the user asked for one
+monitor = None
+
+class JobFailed(Exception):
+    #Raised through a job's future when jobcontrol reports a failure state
+    def __init__(self, name, jobid, status, returncode=None):
+        Exception.__init__(self, "%s (%s) finished with status: %s"%(name, jobid, status))
+        self.name = name
+        self.jobid = jobid
+        self.status = status
+        self.returncode = returncode
+
+class JobStalled(Exception):
+    #Raised when a job runs past its stage's wall-clock limit and is killed. Stalled jobs are requeued
+    def __init__(self, name, jobid, hours, returncode=None):
+        Exception.__init__(self, "%s (%s) stalled: killed after exceeding the %s h limit"%(name, jobid, hours))
+        self.name = name
+        self.jobid = jobid
+        self.hours = hours
+        self.returncode = returncode
+        self.stalled = True
+
+class JobMonitor:
+    #Single polling loop for every submitted job. Jobs are submitted without -WAIT and complete through futures
+    def __init__(self, SCHRODINGER, interval):
+        #Prepare Schrodinger's jobcontrol command ($SCHRODINGER/jobcontrol)
+        self.jobcontrol = os.path.join(SCHRODINGER, "jobcontrol")
+
+        #Seconds between status polls
+        self.interval = interval
+
+        #In-flight jobs: job ID > (name, future, deadline, limit). Deadline and limit (seconds) are None if the job has no limit
+        self.jobs = {}
+
+        #Consecutive polls each in-flight job was missing from jobcontrol -list: job ID > count
+        self.missing = {}
+
+        #Guards the in-flight job dictionary
+        self.lock = threading.Lock()
+
+        #Set to stop the polling loop
+        self.stopped = threading.Event()
+
+        #Polling loop runs in one background thread
+        self.thread = threading.Thread(target=self.poll_loop, name="MDFitJobMonitor", daemon=True)
+        self.thread.start()
+
+    def submit(self, command, name, cwd=None, limit=None, members=None, outputs=None):
+        #Generate key the job's ID is recorded under in the state database
+        key = job_key(command, name, members)
+
+        #Check if an earlier MDFit process submitted this job
+        jobid, status = recorded(self.jobcontrol, key)
+
+        #Check if that job already finished
+        if status == "finished":
+            #Nothing is left to re-attach to
+            mdfit_state.forget_job(key)
+
+            #Check if its outputs are back
+            if download(self.jobcontrol, jobid, outputs, cwd) == True:
+                #If so, return a finished future instead of submitting again
+                future = concurrent.futures.Future()
+                future.set_result(jobid)
+                return future
+
+            #Outputs were never downloaded; submit the job again
+            logger.warning("%s (%s) finished but its outputs are missing: %s; submitting again"%(key, jobid, ', '.join(missing_outputs(outputs, cwd))))
+            jobid, status = None, None
+
+        #Check if that job is still running
+        if status == "running":
+            #If so, wait on it instead of submitting again
+            return self.attach(jobid, name, limit, key)
+
+        #Capture current step
+        logger.info("Submitting %s: %s"%(name, ' '.join(command)))
+
+        #Collect job IDs printed while the job is submitted
+        jobids = []
+
+        #Look for the job ID in each line of output
+        def find_jobid(line):
+            theMatch = jobid_finder.search(line)
+
+            #If found, keep it, and record it at once so a restarted MDFit can re-attach
+            if theMatch:
+                jobids.append(theMatch.group(1))
+                mdfit_state.record_job(key, theMatch.group(1))
+
+        #Submit job. Returns as soon as jobcontrol has accepted it
+        mdfit_exec.run_job(command, logger, cwd, on_line=find_jobid)
+
+        #Keep last job ID reported
+        jobid = jobids[-1] if jobids != [] else None
+
+        #Check if job was accepted
+        if jobid == None:
+            #If not, there is nothing to monitor
+            raise RuntimeError("No JobId returned when submitting %s"%name)
+
+        #Return future for the job
+        return self.attach(jobid, name, limit, key)
+
+    def attach(self, jobid, name, limit=None, key=None):
+        #Generate future that completes when the job does
+        future = concurrent.futures.Future()
+
+        #Forget recorded job ID once the job is done; nothing is left to re-attach to
+        if key != None:
+            future.add_done_callback(lambda future: mdfit_state.forget_job(key))
+
+        #Register job with the polling loop. Its wall-clock limit counts from submission, so time stuck in the queue counts too
+        with self.lock:
+            stopped = self.stopped.is_set()
+            if stopped == False:
+                self.jobs[jobid] = (name, future, time.time() + limit if limit != None else None, limit)
+
+        #Check if monitor was stopped while the job was submitted
+        if stopped == True:
+            #If so, nothing would ever complete the job; kill it and fail its future
+            kill(self.jobcontrol, jobid)
+            future.set_exception(RuntimeError("Job monitor stopped before %s (%s) finished"%(name, jobid)))
+            return future
+
+        #Capture current step
+        logger.info("Monitoring %s: %s"%(name, jobid))
+
+        #Return future
+        return future
+
+    def run(self, command, name, cwd=None, limit=None, members=None, outputs=None):
+        #Submit job and wait for it. The thread sleeps on the future instead of holding a -WAIT process
+        return self.submit(command, name, cwd, limit, members, outputs).result()
+
+    def watchdog(self):
+        #Get snapshot of jobs past their limit
+        with self.lock:
+            stalled = [jobid for jobid, (name, future, deadline, limit) in self.jobs.items() if deadline != None and time.time() > deadline]
+
+        #Iterate over stalled jobs
+        for jobid in stalled:
+            #Remove job from in-flight list
+            with self.lock:
+                name, future, deadline, limit = self.jobs.pop(jobid)
+
+            #Kill job so its slot (and licenses) are freed
+            kill(self.jobcontrol, jobid)
+
+            #Fire completion callbacks with the stall
+            future.set_exception(JobStalled(name, jobid, "%g"%(limit/3600)))
+
+    def poll(self):
+        #Kill jobs that ran past their limit
+        self.watchdog()
+
+        #Get snapshot of in-flight job IDs
+        with self.lock:
+            jobids = list(self.jobs)
+
+        #Check if anything is running
+        if jobids == []:
+            #If not, nothing to poll
+            return
+
+        #Ask jobcontrol for the status of every in-flight job at once
+        process = subprocess.run([self.jobcontrol, "-list"] + jobids, stdout=subprocess.PIPE, \
+            stderr=subprocess.STDOUT, text=True, timeout=300)
+
+        #Initiate list of job IDs jobcontrol reported
+        seen = []
+
+        #Iterate over jobcontrol output
+        for line in process.stdout.split('\n'):
+            #Split line into words
+            words = line.split()
+
+            #Skip lines that do not start with one of our job IDs
+            if words == [] or words[0] not in jobids:
+                continue
+
+            #Get job ID and lowercase status words
+            jobid = words[0]
+            seen.append(jobid)
+            states = [word.lower() for word in words[1:]]
+
+            #Check for failure first; failed jobs can also be "completed"
+            failed, finished = classify(states)
+
+            #Job is still running
+            if failed == [] and finished == []:
+                continue
+
+            #Remove job from in-flight list. The watchdog may have removed it already
+            with self.lock:
+                if jobid not in self.jobs:
+                    continue
+                name, future, deadline, limit = self.jobs.pop(jobid)
+
+            #Check if job failed
+            if failed != []:
+                #Capture error
+                logger.error("%s (%s) %s"%(name, jobid, failed[0]))
+
+                #Fire completion callbacks with the failure
+                future.set_exception(JobFailed(name, jobid, failed[0]))
+
+            #Job finished
+            else:
+                #Capture current step
+                logger.info("%s (%s) %s"%(name, jobid, finished[0]))
+
+                #Fire completion callbacks
+                future.set_result(jobid)
+
+        #Check if jobcontrol answered. A failed -list says nothing about the jobs
+        if process.returncode == 0:
+            #If so, fail jobs it has not known for several polls in a row
+            self.vanished([jobid for jobid in jobids if jobid not in seen])
+
+    def vanished(self, missing):
+        #Forget counts of jobs that were reported again or are done
+        with self.lock:
+            self.missing = {jobid: count for jobid, count in self.missing.items() if jobid in missing and jobid in self.jobs}
+
+        #Iterate over jobs missing from this poll
+        for jobid in missing:
+            #Count poll and check if the job has been missing for too long
+            with self.lock:
+                if jobid not in self.jobs:
+                    continue
+                self.missing[jobid] = self.missing.get(jobid, 0) + 1
+                if self.missing[jobid] < MISSING_POLLS:
+                    continue
+
+                #Remove job from in-flight list
+                name, future, deadline, limit = self.jobs.pop(jobid)
+                del self.missing[jobid]
+
+            #Capture error
+            logger.error("%s (%s) missing from jobcontrol for %s polls"%(name, jobid, MISSING_POLLS))
+
+            #Fire completion callbacks with the failure
+            future.set_exception(JobFailed(name, jobid, "vanished"))
+
+    def poll_loop(self):
+        #Poll until stopped
+        while not self.stopped.wait(self.interval):
+            #Never let a bad poll kill the monitor
+            try:
+                self.poll()
+            except Exception as exc:
+                logger.warning("Job status poll failed: %s"%exc)
+
+    def stop(self):
+        #Stop polling loop
+        self.stopped.set()
+
+        #Remove every job still in flight
+        with self.lock:
+            jobs = self.jobs
+            self.jobs = {}
+
+        #Fail their futures so no waiting stage blocks forever
+        for jobid, (name, future, deadline, limit) in jobs.items():
+            future.set_exception(RuntimeError("Job monitor stopped before %s (%s) finished"%(name, jobid)))
+
+    def terminate(self):
+        #Stop polling loop and accepting jobs
+        with self.lock:
+            self.stopped.set()
+            jobids = list(self.jobs)
+
+        #Kill every job still in flight, then fail their futures
+        for jobid in jobids:
+            kill(self.jobcontrol, jobid)
+        self.stop()
+
+def classify(states):
+    #Return failure and finished states among a job's lowercase status words
+    failed = [state for state in states if state in FAILED_STATES]
+    finished = [state for state in states if state in FINISHED_STATES]
+    return failed, finished
+
+def job_status(jobcontrol, jobid):
+    #Ask jobcontrol for the status of one job
+    try:
+        process = subprocess.run([jobcontrol, "-list", jobid], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=300)
+    except Exception as exc:
+        logger.warning("Could not get status of %s: %s"%(jobid, exc))
+        return None
+
+    #Iterate over jobcontrol output
+    for line in process.stdout.split('\n'):
+        #Split line into words
+        words = line.split()
+
+        #Check for the job's line
+        if words != [] and words[0] == jobid:
+            #If found, check for failure first; failed jobs can also be "completed"
+            failed, finished = classify([word.lower() for word in words[1:]])
+            return "failed" if failed != [] else "finished" if finished != [] else "running"
+
+    #Job is not known to jobcontrol
+    return None
+
+def job_key(command, name, members=None):
+    #Generate key for a job: program (or $SCHRODINGER/run script) and job name. Production and analysis of one repetition share a job name
+    program = os.path.basename(command[0])
+    if program == "run" and len(command) > 1:
+        program = command[1]
+
+    #Batch names are numbered in submission order, so a batch is also keyed by the ligands or repetitions in it
+    if members != None:
+        return "%s:%s[%s]"%(program, name, ','.join(members))
+    return "%s:%s"%(program, name)
+
+def recorded(jobcontrol, key):
+    #Get job ID recorded by an earlier MDFit process, if any
+    jobid = mdfit_state.recorded_job(key)
+
+    #Check if there is one
+    if jobid == None:
+        #If not, the job must be submitted
+        return None, None
+
+    #Ask jobcontrol what became of it
+    status = job_status(jobcontrol, jobid)
+
+    #Check if it is running or finished
+    if status in ("running", "finished"):
+        #If so, capture current step
+        logger.info("Re-attaching to %s (%s): %s"%(key, jobid, status))
+        return jobid, status
+
+    #Job failed or is unknown; forget it and submit again
+    logger.warning("Recorded job %s (%s) is %s; submitting again"%(key, jobid, status if status != None else "unknown to jobcontrol"))
+    mdfit_state.forget_job(key)
+    return None, None
+
+def missing_outputs(outputs, cwd=None):
+    #Get outputs (paths or glob patterns, relative to the job's directory) that match no file. Without declared outputs, nothing is known to be missing
+    if outputs == None:
+        return []
+    return [output for output in outputs if glob.glob(os.path.join(cwd if cwd != None else os.getcwd(), output)) == []]
+
+def download(jobcontrol, jobid, outputs, cwd=None):
+    #Check if a finished job's outputs are in its directory
+    if missing_outputs(outputs, cwd) == []:
+        return True
+
+    #If not, ask the job server for them once. Never let a failed download stop the caller
+    logger.info("Downloading outputs of %s: %s"%(jobid, ', '.join(missing_outputs(outputs, cwd))))
+    try:
+        subprocess.run([jobcontrol, "-download", jobid], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, cwd=cwd, timeout=300)
+    except Exception as exc:
+        logger.warning("Could not download outputs of %s: %s"%(jobid, exc))
+
+    #Check if they came back
+    return missing_outputs(outputs, cwd) == []
+
+def kill(jobcontrol, jobid):
+    #Capture error
+    logger.error("Killing job %s"%jobid)
+
+    #Ask jobcontrol to kill the job. Never let a failed kill stop the caller
+    try:
+        subprocess.run([jobcontrol, "-kill", jobid], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=300)
+    except Exception as exc:
+        logger.warning("Could not kill %s: %s"%(jobid, exc))
+
+def detach(command):
+    #Remove flags that keep the submitting process attached to the job
+    return [word for word in command if word not in ("-WAIT", "-ATTACHED")]
+
+def start(SCHRODINGER, interval):
+    #Start monitor shared by every stage
+    global monitor
+    monitor = JobMonitor(SCHRODINGER, interval)
+
+    #Capture current step
+    logger.info("Job monitor polling jobcontrol every %s s"%interval)
+
+    #Return monitor
+    return monitor
+
+def current():
+    #Return shared monitor, or None if jobs are run with -WAIT
+    return monitor
+
+def stop():
+    #Stop shared monitor, if running
+    global monitor
+    if monitor != None:
+        monitor.stop()
+        monitor = None
+
+def terminate():
+    #Kill jobs of shared monitor, if running; stop() then only clears it
+    if monitor != None:
+        monitor.terminate()
+
+def stub_check():
+    #Local check of the monitor against a stub jobcontrol: python mdfit_job_monitor.py test
+    stub_dir = tempfile.mkdtemp(prefix="mdfit_monitor_")
+
+    #Stub prints "<jobid> <status>" for every job with a status file; jobs without one are unknown to it. -download writes <jobid>.out if download_<jobid> exists, and -kill touches killed_<jobid>
+    with open(os.path.join(stub_dir, "jobcontrol"), "w") as fp:
+        fp.write('#!/bin/sh\nif [ "$1" = "-download" ]; then [ -f "%s/download_$2" ] && touch "%s/$2.out"; exit 0; fi\nif [ "$1" = "-kill" ]; then touch "%s/killed_$2"; exit 0; fi\nshift\nfor id in "$@"; do [ -f "%s/$id" ] && echo "$id $(cat %s/$id)"; done\nexit 0\n'%((stub_dir,)*5))
+    os.chmod(os.path.join(stub_dir, "jobcontrol"), 0o755)
+
+    #Stub job submission prints a new JobId, "resubmitted", that has already completed
+    with open(os.path.join(stub_dir, "job"), "w") as fp:
+        fp.write('#!/bin/sh\necho completed > "%s/resubmitted"\necho "JobId: resubmitted"\n'%stub_dir)
+    os.chmod(os.path.join(stub_dir, "job"), 0o755)
+
+    #Set status of a stub job
+    def status(jobid, state):
+        with open(os.path.join(stub_dir, jobid), "w") as fp:
+            fp.write(state)
+
+    #Start monitor against stub, polling fast
+    test_monitor = JobMonitor(stub_dir, 0.1)
+
+    #Attach finished, died, vanished, and never-finishing jobs
+    for jobid in ("finished", "died", "vanished", "running"):
+        status(jobid, "running")
+    futures = {jobid: test_monitor.attach(jobid, "stub_%s"%jobid) for jobid in ("finished", "died", "vanished", "running")}
+
+    #Let jobs change state
+    status("finished", "completed")
+    status("died", "died")
+    os.remove(os.path.join(stub_dir, "vanished"))
+
+    #Collect outcomes
+    outcomes = {}
+    for jobid in ("finished", "died", "vanished"):
+        try:
+            outcomes[jobid] = futures[jobid].result(timeout=10)
+        except Exception as exc:
+            outcomes[jobid] = exc
+
+    #Re-attach to finished jobs recorded by an earlier process: one whose outputs download, and one whose outputs are gone
+    mdfit_state.open_state(stub_dir)
+    for jobid in ("downloaded", "gone"):
+        status(jobid, "completed")
+        mdfit_state.record_job(job_key([os.path.join(stub_dir, "job")], jobid), jobid)
+    status("download_downloaded", "")
+    for jobid in ("downloaded", "gone"):
+        try:
+            outcomes["re-attach %s"%jobid] = test_monitor.run([os.path.join(stub_dir, "job")], jobid, stub_dir, outputs=["%s.out"%jobid])
+        except Exception as exc:
+            outcomes["re-attach %s"%jobid] = exc
+    mdfit_state.close()
+
+    #Terminate monitor; the running job must be killed and fail instead of hanging, and a job attached afterwards is killed at once
+    test_monitor.terminate()
+    for jobid, future in (("running", futures["running"]), ("late", test_monitor.attach("late", "stub_late"))):
+        try:
+            outcomes[jobid] = future.result(timeout=10)
+        except Exception as exc:
+            outcomes[jobid] = exc
+    killed = sorted(name[len("killed_"):] for name in os.listdir(stub_dir) if name.startswith("killed_"))
+
+    #Remove stub
+    shutil.rmtree(stub_dir)
+
+    #Print outcomes
+    for jobid, outcome in outcomes.items():
+        print("%-20s %s"%(jobid, outcome if not isinstance(outcome, Exception) else "%s: %s"%(type(outcome).__name__, outcome)))
+    print("%-20s %s"%("killed", killed))
+
+    #Check outcomes
+    return outcomes["finished"] == "finished" and isinstance(outcomes["died"], JobFailed) and isinstance(outcomes["vanished"], JobFailed) and \
+        outcomes["vanished"].status == "vanished" and isinstance(outcomes["running"], RuntimeError) and \
+        isinstance(outcomes["late"], RuntimeError) and killed == ["late", "running"] and outcomes["re-attach downloaded"] == "downloaded" and outcomes["re-attach gone"] == "resubmitted"
+
+if __name__ == '__main__':
+    #Local check of the monitor without Schrodinger: python mdfit_job_monitor.py test
+    if sys.argv[1:2] == ["test"]:
+        sys.exit(0 if stub_check() else 1)
@@ -0,0 +1,452 @@
+#!/ap/rhel7/bin/python3.6
+
+####################################################################
+# Corresponding Authors : Alexander Brueckner, Kaushik Lakkaraju ###
+# Contact : alexander.brueckner@bms.com, kaushik.lakkaraju@bms.com #
+####################################################################
+
+#Import Python modules
+import logging
+import os
+import re
+import csv
+import hashlib
+import threading
+
+###Initiate logger###
+logger = logging.getLogger(__name__)
+
+#Manifest filename, kept in the campaign (master) directory
+MANIFEST_NAME = "ligand_manifest.csv"
+
+#Manifest shared by every stage: entries in library order
+manifest = None
+manifest_lock = threading.Lock()
+
+#Library the manifest indexes, and the content hash of each of its structures: ligand > digest
+library = None
+structure_digests = {}
+
+#Protein formal charges, computed once per protein file: path > charge
+protein_charges = {}
+
+#SDF atom block charge codes (V2000)
+SDF_CHARGE_CODES = {1: 3, 2: 2, 3: 1, 4: 0, 5: -1, 6: -2, 7: -3}
+
+#Pattern for Maestro values; quoted strings may contain spaces
+mae_token = re.compile(r'"(?:[^"\\]|\\.)*"|\S+')
+
+class LibraryEntry:
+    #One structure in the ligand library: position in the file and properties used to plan MD
+    def __init__(self, title, number, offset, length, atoms, heavy_atoms, formal_charge):
+        self.title = title
+        self.number = number
+        self.offset = offset
+        self.length = length
+        self.atoms = atoms
+        self.heavy_atoms = heavy_atoms
+        self.formal_charge = formal_charge
+
+def sdf_records(fp):
+    #Initiate start of current record, its first line (title), and its lines
+    start = 0
+    title = None
+    lines = []
+
+    #Iterate over lines, keeping byte positions
+    for line in fp:
+        #First line of a record is its title
+        if title == None:
+            title = line.decode(errors="replace").rstrip("\r\n")
+
+        #Keep record lines
+        lines.append(line)
+
+        #Record ends with $$$$
+        if line.strip() == b"$$$$":
+            #Return title, offset, and contents
+            data = b"".join(lines)
+            yield title, start, data
+
+            #Next record starts here
+            start += len(data)
+            title = None
+            lines = []
+
+    #Keep final record if it was not terminated with $$$$
+    if b"".join(lines).strip() != b"":
+        yield title, start, b"".join(lines)
+
+def sdf_properties(data):
+    #Split record into lines
+    lines = data.decode(errors="replace").splitlines()
+
+    #Initiate atom counts and charges
+    atoms = 0
+    heavy_atoms = 0
+    block_charge = 0
+    chg_charge = 0
+    has_chg = False
+
+    #Check for V3000 connection table
+    if len(lines) > 3 and "V3000" in lines[3]:
+        #Flag for atom block
+        in_atoms = False
+
+        #Iterate over lines
+        for line in lines[4:]:
+            #Find start and end of atom block
+            if line.startswith("M  V30 BEGIN ATOM"):
+                in_atoms = True
+            elif line.startswith("M  V30 END ATOM"):
+                break
+
+            #Read atom line: M  V30 index symbol x y z map [CHG=n ...]
+            elif in_atoms and line.startswith("M  V30"):
+                words = line.split()
+                atoms += 1
+                if words[3] not in ("H", "D", "T"):
+                    heavy_atoms += 1
+                for word in words[8:]:
+                    if word.startswith("CHG="):
+                        block_charge += int(word[4:])
+
+    #V2000 connection table
+    elif len(lines) > 3:
+        #Get number of atoms from counts line
+        natoms = int(lines[3][0:3])
+
+        #Iterate over atom block
+        for line in lines[4:4+natoms]:
+            atoms += 1
+            if line[31:34].strip() not in ("H", "D", "T"):
+                heavy_atoms += 1
+
+            #Add atom block charge code, if present
+            code = line[36:39].strip()
+            if code != "":
+                block_charge += SDF_CHARGE_CODES.get(int(code), 0)
+
+        #Iterate over property block
+        for line in lines[4+natoms:]:
+            #Charge properties replace every atom block charge
+            if line.startswith("M  CHG"):
+                has_chg = True
+                words = line.split()
+                chg_charge += sum(int(value) for value in words[4::2])
+
+    #Return atom counts and formal charge
+    return atoms, heavy_atoms, chg_charge if has_chg else block_charge
+
+def mae_title(lines):
+    #Initiate lists of property names and values
+    keys = []
+    values = []
+
+    #Flag for when property values begin (after :::)
+    in_values = False
+
+    #Iterate over lines of the ct block, skipping the opening "f_m_ct {" line
+    for line in lines[1:]:
+        #Remove surrounding whitespace
+        text = line.decode(errors="replace").strip()
+
+        #Values begin after :::
+        if text == ":::":
+            #Check if values already began
+            if in_values:
+                #If so, all values have been read
+                break
+            in_values = True
+            continue
+
+        #Collect property names and then property values, one per line
+        if in_values:
+            values.append(text)
+        elif text != "" and not text.startswith("#"):
+            keys.append(text)
+
+        #Stop once the title has been read
+        if "s_m_title" in keys and len(values) > keys.index("s_m_title"):
+            #Remove quotes around titles that contain spaces
+            title = values[keys.index("s_m_title")]
+            if title.startswith('"') and title.endswith('"'):
+                title = title[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+            return title
+
+    #No title found
+    return ""
+
+def mae_properties(lines):
+    #Initiate atom counts and charge
+    atoms = 0
+    heavy_atoms = 0
+    charge = 0
+
+    #Initiate atom block state: None (outside), "keys", or "rows"
+    block = None
+    keys = []
+
+    #Iterate over lines of the ct block
+    for line in lines:
+        #Remove surrounding whitespace
+        text = line.decode(errors="replace").strip()
+
+        #Find start of atom block, m_atom[N] {
+        if block == None and text.startswith("m_atom["):
+            block = "keys"
+            keys = []
+
+        #Collect atom property names until :::
+        elif block == "keys":
+            if text == ":::":
+                block = "rows"
+            elif text != "" and not text.startswith("#"):
+                keys.append(text)
+
+        #Read atom rows until the closing :::
+        elif block == "rows":
+            if text == ":::":
+                block = None
+                continue
+
+            #First value is the atom index; the rest follow the property names
+            values = mae_token.findall(text)[1:]
+            row = dict(zip(keys, values))
+            atoms += 1
+
+            #Count atoms other than hydrogen
+            if row.get("i_m_atomic_number", "0") != "1":
+                heavy_atoms += 1
+
+            #Add formal charge
+            if row.get("i_m_formal_charge", "<>") != "<>":
+                charge += int(row["i_m_formal_charge"])
+
+    #Return atom counts and formal charge
+    return atoms, heavy_atoms, charge
+
+def mae_records(fp):
+    #Initiate start and lines of current ct block
+    start = None
+    lines = []
+
+    #Initiate position in file
+    position = 0
+
+    #Iterate over lines, keeping byte positions
+    for line in fp:
+        #Check for start of a new ct block (top-level blocks are not indented)
+        if line.startswith(b"f_m_ct"):
+            #Return previous ct block, if any
+            if start != None:
+                yield mae_title(lines), start, lines
+
+            #Start new ct block
+            start = position
+            lines = []
+
+        #Keep lines of the ct block. Lines before the first block are the file header
+        if start != None:
+            lines.append(line)
+
+        #Move position to next line
+        position += len(line)
+
+    #Return last ct block
+    if start != None:
+        yield mae_title(lines), start, lines
+
+def scan(ligpath):
+    #Get library extension (.sdf or .mae)
+    ext = os.path.splitext(ligpath)[1].lower()
+
+    #Initiate manifest entries
+    entries = []
+
+    #Capture current step
+    logger.info("Indexing ligand library in one pass: %s"%ligpath)
+
+    #Read library once
+    with open(ligpath, 'rb') as fp:
+        #Check if library is a Maestro file
+        if ext == ".mae":
+            #Iterate over ct blocks, in library order
+            for title, offset, lines in mae_records(fp):
+                atoms, heavy_atoms, charge = mae_properties(lines)
+                entries.append(LibraryEntry(title, len(entries), offset, sum(len(line) for line in lines), atoms, heavy_atoms, charge))
+
+        #Library is an SDF file
+        else:
+            #Iterate over records, in library order
+            for title, offset, data in sdf_records(fp):
+                atoms, heavy_atoms, charge = sdf_properties(data)
+                entries.append(LibraryEntry(title, len(entries), offset, len(data), atoms, heavy_atoms, charge))
+
+    #Return manifest entries
+    return entries
+
+def library_source(ligpath):
+    #Identify the library a manifest indexes: absolute path, size, and modification time (ns). A library moved, replaced, or copied over (even with an older time) differs
+    info = os.stat(ligpath)
+    return ["#library", os.path.abspath(ligpath), str(info.st_size), str(info.st_mtime_ns)]
+
+def manifest_source(master_dir):
+    #Get library recorded on the first line of a manifest; None if it has none (written by an older MDFit)
+    with open(os.path.join(master_dir, MANIFEST_NAME), 'r', newline='') as fp:
+        first = next(csv.reader(fp), None)
+    return first if first != None and first[:1] == ["#library"] else None
+
+def write_manifest(master_dir, entries, source):
+    #Write manifest: library it indexes, then title, number, offset, length, atoms, heavy atoms, formal charge
+    with open(os.path.join(master_dir, MANIFEST_NAME), 'w', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(source)
+        writer.writerow(["title", "number", "offset", "length", "atoms", "heavy_atoms", "formal_charge"])
+        for entry in entries:
+            writer.writerow([entry.title, entry.number, entry.offset, entry.length, entry.atoms, entry.heavy_atoms, entry.formal_charge])
+
+def read_manifest(master_dir):
+    #Read manifest
+    with open(os.path.join(master_dir, MANIFEST_NAME), 'r', newline='') as fp:
+        #Skip library line
+        fp.readline()
+
+        #Return entries in library order
+        return [LibraryEntry(row["title"], int(row["number"]), int(row["offset"]), int(row["length"]), int(row["atoms"]), int(row["heavy_atoms"]), int(row["formal_charge"])) for row in csv.DictReader(fp)]
+
+def build(ligpath, master_dir):
+    #Build manifest once per MDFit run; every stage shares it
+    global manifest, library
+    with manifest_lock:
+        #Keep library path; structures are read by offset from it
+        library = os.path.abspath(ligpath)
+
+        #Generate path to manifest
+        manifest_path = os.path.join(master_dir, MANIFEST_NAME)
+
+        #Identify library
+        source = library_source(ligpath)
+
+        #Check if a previous run wrote the manifest for this same library
+        if os.path.isfile(manifest_path) == True and manifest_source(master_dir) == source:
+            #If so, read manifest
+            manifest = read_manifest(master_dir)
+
+            #Capture current step
+            logger.info("Ligand manifest found: %s (%s ligands)"%(manifest_path, len(manifest)))
+
+        #Library is new or has changed
+        else:
+            #Index library and get ligand properties
+            manifest = scan(ligpath)
+
+            #Keep manifest next to the campaign
+            write_manifest(master_dir, manifest, source)
+
+            #Capture current step
+            logger.info("Wrote ligand manifest: %s (%s ligands)"%(manifest_path, len(manifest)))
+
+    #Return manifest
+    return manifest
+
+def current():
+    #Return shared manifest, or None if not built
+    return manifest
+
+def title(i):
+    #Return ligand name for ligand number i. Remove any trailing spaces
+    return manifest[i].title.strip()
+
+def entry(ligname):
+    #Find manifest entry for a ligand name
+    for each_entry in manifest if manifest != None else []:
+        if each_entry.title.strip() == ligname:
+            return each_entry
+
+    #Ligand is not in the manifest
+    return None
+
+def structure_digest(ligname):
+    #Hash a ligand's structure record in the library, once per MDFit run. None if the ligand is not in the manifest
+    with manifest_lock:
+        #Check if structure was already hashed
+        if ligname not in structure_digests:
+            #If not, find it in the manifest
+            each_entry = entry(ligname)
+            if each_entry == None:
+                return None
+
+            #Hash its record
+            structure_digests[ligname] = hashlib.sha256(read_structure(library, manifest, manifest.index(each_entry))).hexdigest()
+
+    #Return digest
+    return structure_digests[ligname]
+
+def read_structure(ligpath, entries, i, fp=None):
+    #Open library, unless the caller already has it open
+    if fp == None:
+        with open(ligpath, 'rb') as fp:
+            return read_structure(ligpath, entries, i, fp)
+
+    #Check if library is a Maestro file
+    if os.path.splitext(ligpath)[1].lower() == ".mae":
+        #If so, the file header (everything before the first structure) goes in front of it
+        fp.seek(0)
+        header = fp.read(entries[0].offset)
+    else:
+        #SDF records stand alone
+        header = b""
+
+    #Go to structure
+    fp.seek(entries[i].offset)
+
+    #Return header and structure
+    return header + fp.read(entries[i].length)
+
+def write_ligands(ligpath, out_dir):
+    #Get library extension (.sdf or .mae)
+    ext = os.path.splitext(ligpath)[1].lower()
+
+    #Open library once and copy each structure by its offset; nothing is parsed again
+    with open(ligpath, 'rb') as fp:
+        #Iterate over structures
+        for i, each_entry in enumerate(manifest):
+            #Generate per-ligand filename <ligname>.sdf or <ligname>.mae
+            outfile = os.path.join(out_dir, "%s%s"%(each_entry.title.strip(), ext))
+
+            #Check if ligand file exists
+            if os.path.isfile(outfile) == False:
+                #If not, write structure next to its final name and rename it into place; other MDFit processes sharing scratch never see a partial file
+                with open("%s.%s.tmp"%(outfile, os.getpid()), 'wb') as out:
+                    out.write(read_structure(ligpath, manifest, i, fp))
+                os.replace("%s.%s.tmp"%(outfile, os.getpid()), outfile)
+
+    #Write title list (one title per line, same as proplister)
+    with open(os.path.join(out_dir, "lignames.%s.tmp"%os.getpid()), 'w') as fp:
+        for each_entry in manifest:
+            fp.write("%s\n"%each_entry.title)
+    os.replace(os.path.join(out_dir, "lignames.%s.tmp"%os.getpid()), os.path.join(out_dir, "lignames.csv"))
+
+def extract(ligpath, i, outfile):
+    #Capture current step
+    logger.info("Getting ligand %s (%s) from ligand manifest"%(title(i), i+1))
+
+    #Write structure to requested file
+    with open(outfile, 'wb') as out:
+        out.write(read_structure(ligpath, manifest, i))
+
+def protein_charge(prot_path):
+    #Compute formal charge of the protein file once
+    with manifest_lock:
+        #Check if protein was already read
+        if prot_path not in protein_charges:
+            #If not, sum formal charges over every ct block
+            with open(prot_path, 'rb') as fp:
+                protein_charges[prot_path] = sum(mae_properties(lines)[2] for title, offset, lines in mae_records(fp))
+
+            #Capture current step
+            logger.info("Protein formal charge for %s: %s"%(prot_path, protein_charges[prot_path]))
+
+    #Return protein charge
+    return protein_charges[prot_path]
@@ -58,6 +58,13 @@ def parse_arguments(master_dir, homepath):
     desmond.add_argument('-t', '--md_sim_time', dest='md_sim_time', type=float, default='2000', help='in picoseconds; default = 2000')
     desmond.add_argument('--md_traj_write_freq', dest='md_traj_write_freq', type=float, default='100', help='in picoseconds; default = 100')
     desmond.add_argument('-r', '--md_repetitions', dest='md_repetitions', type=int, default='1', help='number of MD simulations to run for each ligand, each with a different random seed; default = 1')
+    desmond.add_argument('--bmin_batch', dest='bmin_batch', type=int, default=1, help='number of complexes minimized together in one bmin job during MD setup; default = 1 (one job per ligand)')
+    desmond.add_argument('--multisim_batch', dest='multisim_batch', type=int, default=1, help='number of same-charge systems built together in one multisim run during MD setup; default = 1 (one run per ligand)')
+    desmond.add_argument('--multisim_maxjob', dest='multisim_maxjob', type=int, default=0, help='-maxjob for batched multisim runs; default = 0 (batch size)')
+    desmond.add_argument('--rep_pack', dest='rep_pack', type=int, default=1, help='number of repetitions of a ligand submitted together as one multisim job with one seed each; default = 1 (one job per repetition)')
+    desmond.add_argument('--shared_relax', dest='shared_relax', action='store_true', help='run the relaxation protocol once per ligand and start every repetition from the relaxed system with its own velocity seed; default = false')
+    desmond.add_argument('--schedule', dest='schedule', choices=('library', 'lpt', 'sjf'), default='library', help='order of setup and production: library order, longest (largest system) first, or shortest first; default = library')
+    desmond.add_argument('--stream_md', dest='stream_md', action='store_true', help='submit production MD for each ligand as soon as its own setup finishes; default = false')
 
     analysis.add_argument('--skip_analysis', dest='skip_analysis', action='store_true', help='skip MD simulation analysis; default = false')
     analysis.add_argument('--slice_start', dest='slice_start', type=int, default=0, help='frame to start analysis. default: 0')
@@ -65,6 +72,7 @@ def parse_arguments(master_dir, homepath):
     analysis.add_argument('--analysis_lig', dest='analysis_lig', default='all', help='name of ligand for MD analysis; default = all')
     analysis.add_argument('--prot_ASL', dest='prot_ASL', default='"protein"', help='ASL definition for protein; default = "protein"')
     analysis.add_argument('--lig_ASL', dest='lig_ASL', default='"auto"', help='ASL definition for ligands; default = "auto"')
+    analysis.add_argument('--pipeline_analysis', dest='pipeline_analysis', action='store_true', help='analyze each repetition as soon as its production MD finishes; implies --stream_md; default = false')
     analysis.add_argument('--analysis_cutoff', dest='analysis_cutoff', type=float, default='0.0000', help='interactions above this percentage of the simulation will be recorded; default=0.0000')
     
     clustering.add_argument('--skip_cluster', dest='skip_cluster', action='store_true', help='skip trajectory clustering; default = false')
@@ -75,7 +83,19 @@ def parse_arguments(master_dir, homepath):
     clustering.add_argument('--parch_solv_ASL', dest='parch_solv_ASL', default='"auto"', help='ASL definition for atoms around which solvent is retained; default = "auto"')
     clustering.add_argument('--n_solv', dest='n_solv', type=int, default='100', help='number of solvent molecules to keep during parching; default = 100')
 
-    misc.add_argument('-m', '--max_workers', dest='max_workers', type=int, default=0, help='number of workers for multitasking; default = min(32, os.cpu_count() + 4)')
+    misc.add_argument('-m', '--max_workers', dest='max_workers', type=int, default=0, help='number of workers for multitasking; overrides every host class limit in the "workers" block of parameters.json; default = the "workers" block, or min(32, os.cpu_count() + 4)')
+    misc.add_argument('--monitor_jobs', dest='monitor_jobs', action='store_true', help='submit Schrodinger jobs without -WAIT and track them all from one polling loop; implies --stream_md; default = false')
+    misc.add_argument('--poll_interval', dest='poll_interval', type=float, default='60', help='seconds between job status polls with --monitor_jobs; default = 60')
+    misc.add_argument('--in_process', dest='in_process', action='store_true', help='merge protein and ligand with the Schrodinger structure API instead of structcat and pv_convert.py subprocesses; default = false')
+    misc.add_argument('--warm_pool', dest='warm_pool', type=int, default=0, help='number of long-lived Schrodinger workers that run short utilities (event_analysis.py, pv_convert.py, structconvert, structcat, proplister) without a new interpreter per call; default = 0 (off)')
+    misc.add_argument('--keep_going', dest='keep_going', action='store_true', help='skip a ligand or repetition whose stage fails and finish the rest of the campaign; failures are summarized at the end (MDFit_failures.csv); default = false')
+    misc.add_argument('--retries', dest='retries', type=int, default=0, help='number of times a stage is retried after a transient job server or license error; default = 0')
+    misc.add_argument('--retry_backoff', dest='retry_backoff', type=float, default='60', help='seconds before the first retry; doubled after every further failure; default = 60')
+    misc.add_argument('--stall_requeue', dest='stall_requeue', type=int, default='1', help='number of times a job killed at its wall-clock limit (the "limits" block of parameters.json) is requeued; default = 1')
+    misc.add_argument('--work_queue', dest='work_queue', action='store_true', help='claim ligand, repetition, and stage work items from a queue in the campaign directory (MDFit_queue), so several MDFit processes, e.g. on different login nodes, drain one campaign together; implies --pipeline_analysis; default = false')
+    misc.add_argument('--lease_time', dest='lease_time', type=float, default='600', help='seconds a claimed work item stays reserved after its MDFit process stops renewing it (e.g., dies) with --work_queue; default = 600')
+    misc.add_argument('--daemon', dest='daemon', action='store_true', help='draw host class slots and license tokens from the budget shared by every campaign on the MDFit daemon (MDFit.py daemon), instead of this campaign\'s own limits alone; default = false')
+    misc.add_argument('--priority', dest='priority', type=float, default='1', help='fair-share weight of this campaign on the MDFit daemon; a campaign with priority 2 gets twice the slots of a campaign with priority 1 when both are waiting; default = 1')
     misc.add_argument('-d', '--debug', action='store_const', dest='loglevel', const=logging.DEBUG, default=logging.INFO, help='Print all debugging statements to log file')
 
     #Get all arguments and check for any unknown variables
@@ -131,6 +151,62 @@ def parse_arguments(master_dir, homepath):
             #Exit
             sys.exit()
 
+    #Check if user wants the campaign drained through a shared work queue
+    if args.work_queue:
+        #The queue hands out MD stages
+        if args.skip_md:
+            #If MD is skipped, document warning and run stages normally
+            logger.warning("--work_queue requires Desmond MD; running stages one after the other")
+
+            #Turn off work queue
+            args.work_queue = False
+
+        #MD will run
+        else:
+            #Analysis items are queued as each repetition finishes production
+            args.pipeline_analysis = not args.skip_analysis
+
+            #Check if user wants repetitions packed
+            if args.rep_pack > 1:
+                #Repetitions of a ligand may be claimed by different processes, so they cannot be packed
+                logger.warning("--rep_pack is ignored with --work_queue; every repetition is submitted on its own")
+
+                #Turn off packing
+                args.rep_pack = 1
+
+    #Check if user wants analysis pipelined with Desmond MD
+    if args.pipeline_analysis:
+        #Pipelining needs both MD and analysis to run
+        if args.skip_md or args.skip_analysis:
+            #If one is skipped, document warning and run stages normally
+            logger.warning("--pipeline_analysis requires both MD and analysis; running stages one after the other")
+
+            #Turn off pipelining
+            args.pipeline_analysis = False
+
+        #Both stages will run
+        else:
+            #Production must stream for repetitions to reach analysis early
+            args.stream_md = True
+
+    #Check if the MDFit daemon started this campaign
+    if os.getenv("MDFIT_CAMPAIGN") != None:
+        #If so, it shares the daemon's budget
+        args.daemon = True
+
+    #Check if campaign shares the MDFit daemon's budget
+    if args.daemon and args.monitor_jobs:
+        #Slots are held for the whole job, which only the blocking job path does
+        logger.warning("--monitor_jobs is ignored with --daemon; the daemon schedules every job instead")
+
+        #Turn off job monitor
+        args.monitor_jobs = False
+
+    #Check if user wants jobs tracked by the job monitor
+    if args.monitor_jobs:
+        #Production is launched and finished through the streaming loop
+        args.stream_md = True
+
     #Return all arguments
     return args
 
@@ -9,29 +9,55 @@
 import logging
 import os
 import shutil
-import subprocess
+import threading
+
+#Import Schrodinger modules
+from schrodinger import structure
+
+#Import MDFit modules
+import mdfit_warm_pool
+import mdfit_ligand_library
 
 ###Initiate logger###
 logger = logging.getLogger(__name__)
 
-def run_job(command):
-    #Run provided command, joining list with space. Pipe stdout and sdterror to log file
-    process = subprocess.run(' '.join(command), stdout=subprocess.PIPE, \
-        stderr=subprocess.STDOUT, shell=True, text=True)
-    
-    #Iterate over sdtout and sdterror
-    for line in process.stdout.split('\n'):
-        #Ignore blank lines
-        if line != "":
-            #Ignore ExitStatus
-            if "ExitStatus" not in line:
-                #Write to log file for debugging
-                logger.debug(line)
+#Protein structures read once per MDFit run: path > structure
+proteins = {}
+protein_lock = threading.Lock()
 
-def main(SCHRODINGER, ligpath, ligname, i, master_dir, args):
-    #Prepare Schrodinger's structure subset command ($SCHRODINGER/utilities/structsubset)
-    run_cmd = os.path.join(SCHRODINGER, 'utilities', 'structsubset')
+def read_protein(protein_path):
+    #Read protein once; every ligand merges into the same receptor
+    with protein_lock:
+        #Check if protein was already read
+        if protein_path not in proteins:
+            #If not, read receptor (first structure, as pv_convert.py uses)
+            proteins[protein_path] = structure.StructureReader.read(protein_path)
+
+    #Return protein structure
+    return proteins[protein_path]
+
+def merge_complex(protein_path, ligfile, pvcomplex, outname):
+    #Read ligand
+    ligand = structure.StructureReader.read(ligfile)
+
+    #Get protein, read once
+    protein = read_protein(protein_path)
+
+    #Capture current step
+    logger.info("Complexing and merging protein and ligand in-process: %s + %s > %s"%(protein_path, ligfile, outname))
 
+    #Write pose viewer file (protein, then ligand), same as structcat
+    with structure.StructureWriter(pvcomplex) as writer:
+        writer.append(protein)
+        writer.append(ligand)
+
+    #Merge ligand into protein, same as pv_convert.py -mode merge. Merge returns a new structure; cached protein is unchanged
+    complex_st = protein.merge(ligand)
+
+    #Write merged complex
+    complex_st.write(outname)
+
+def main(SCHRODINGER, ligpath, ligname, i, master_dir, args):
     #Prepare Schrodinger's structure concatination command ($SCHRODINGER/utilities/structcat)
     structcat = os.path.join(SCHRODINGER, 'utilities', 'structcat')
 
@@ -46,31 +72,30 @@ def main(SCHRODINGER, ligpath, ligname, i, master_dir, args):
 
     #Check if pose viewer file exists
     if os.path.isfile(os.path.join(master_dir, "desmond_md", ligname, "md_setup", pvcomplex)) == False:
-        #If not, check if ligand sdf file exists and ligands are not precomplexed with protein
-        if os.path.isfile("%s.sdf"%ligname) == False and not args.precomplex:
-            #If not, prepare structure subset command (extract ligand from library)
-            command = [run_cmd, '-n', str(i+1), ligpath, '%s.sdf'%ligname]
+        #If not, generate ligand filename; sdf for ligand libraries, mae for precomplexed structures
+        ligfile = "%s.mae"%ligname if args.precomplex else "%s.sdf"%ligname
 
-            #Document current step
-            logger.info("Getting ligand: %s"%' '.join(command))
+        #Check if ligand file was already written when the library was indexed
+        if os.path.isfile(ligfile) == False:
+            #If not, extract ligand from library by its byte offset. Calls mdfit_ligand_library.py
+            mdfit_ligand_library.extract(ligpath, i, ligfile)
 
-            #Run structure subset (extract ligand from library)
-            run_job(command)
-        
-        #Ligands are precomplexed with protein
-        else:
-            #If not, prepare structure subset command (extract ligand from library)
-            command = [run_cmd, '-n', str(i+1), ligpath, '%s.mae'%ligname]
+        #Check if user wants setup bookkeeping done with the structure API instead of subprocesses
+        if args.in_process and not args.precomplex:
+            #If so, complex and merge protein and ligand without starting structcat or pv_convert.py
+            merge_complex(os.path.join(master_dir, args.prot), ligfile, pvcomplex, outname)
 
-            #Document current step
-            logger.info("Getting ligand: %s"%' '.join(command))
+        #Check if precomplexed structure only needs to be copied
+        elif args.in_process and args.precomplex:
+            #Capture current step
+            logger.info("Copying precomplexed structure in-process: %s > %s"%(ligfile, outname))
 
-            #Run structure subset (extract ligand from library)
-            run_job(command)
-        
+            #Copy precomplexed structure to pose viewer and complex filenames
+            shutil.copy(ligfile, pvcomplex)
+            shutil.copy(pvcomplex, outname)
 
         #Check if protein and ligand are pre-complexed
-        if not args.precomplex:
+        elif not args.precomplex:
             #If not, generate path to protein file
             protein_path = os.path.join(master_dir, args.prot)
 
@@ -87,10 +112,10 @@ def main(SCHRODINGER, ligpath, ligname, i, master_dir, args):
             logger.info("Merging protein and ligand: %s"%' '.join(command2))
             
             #Run concatination command
-            run_job(command1)
+            mdfit_warm_pool.run_job(command1, logger)
 
             #Run pose viewer command
-            run_job(command2)
+            mdfit_warm_pool.run_job(command2, logger)
 
             #Rename auto-generated output complex name to desired filename ("-out" > "_out")
             os.rename("%s-out_complex.mae"%ligname,outname)
@@ -110,10 +135,10 @@ def main(SCHRODINGER, ligpath, ligname, i, master_dir, args):
             logger.info("Merging protein and ligand: %s"%' '.join(command2))
 
             #Run concatination command
-            run_job(command1)
+            mdfit_warm_pool.run_job(command1, logger)
 
             #Run pose viewer command
-            run_job(command2)
+            mdfit_warm_pool.run_job(command2, logger)
 
             #Copy pose viewer complex to desired filename
             shutil.copy(pvcomplex,outname)
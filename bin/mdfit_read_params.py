@@ -41,7 +41,43 @@ def write_json(MDFit_path):
         },
         "parameters": {
             "MAXLIGS":100,
-            "FFPROC":32
+            "FFPROC":32,
+            "DAEMON":"/tmp/mdfit_daemon.sock"
+        },
+        "workers": {
+            "BMIN":32,
+            "MULTISIM":32,
+            "DESMOND":16,
+            "ANALYSIS":16
+        },
+        "licenses": {
+            "DESMOND_GPGPU": {
+                "TOKENS":256,
+                "PER_JOB":16
+            }
+        },
+        "limits": {
+            "FFBUILDER":10,
+            "BMIN":2,
+            "MULTISIM":2,
+            "DESMOND":24,
+            "ANALYSIS":8,
+            "CLUSTER":8
+        },
+        "backends": {
+            "FFBUILDER":"jobcontrol",
+            "BMIN":"jobcontrol",
+            "MULTISIM":"jobcontrol",
+            "DESMOND":"jobcontrol",
+            "ANALYSIS":"jobcontrol",
+            "CLUSTER":"local"
+        },
+        "slurm": {
+            "PARTITION":"general",
+            "ACCOUNT":"",
+            "CPUS":1,
+            "MEM":"",
+            "POLL":30
         }
     }
 
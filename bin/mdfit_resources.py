@@ -0,0 +1,209 @@
+#!/ap/rhel7/bin/python3.6
+
+####################################################################
+# Corresponding Authors : Alexander Brueckner, Kaushik Lakkaraju ###
+# Contact : alexander.brueckner@bms.com, kaushik.lakkaraju@bms.com #
+####################################################################
+
+#Import Python modules
+import logging
+import sys
+import os
+import time
+import threading
+
+#Import MDFit modules
+import mdfit_daemon
+
+###Initiate logger###
+logger = logging.getLogger(__name__)
+
+#Host classes that get their own concurrency limit (keys in the "workers" block of parameters.json)
+HOST_CLASSES = ("BMIN", "MULTISIM", "DESMOND", "ANALYSIS")
+
+#General runtime limit guidance per host class, in hours (README). Overridden by the "limits" block of parameters.json
+RUNTIME_LIMITS = {"FFBUILDER": 10, "BMIN": 2, "MULTISIM": 2, "DESMOND": 24, "ANALYSIS": 8, "CLUSTER": 8}
+
+def default_workers(args):
+    #Check if user provided a number of workers
+    if args.max_workers == 0:
+        #If not, return either 32 or (number of cpu+4)
+        workers = min(32, os.cpu_count() + 4)
+
+    #User provided number of workers
+    else:
+        #Assign to variable
+        workers = args.max_workers
+
+    #Return number of workers
+    return workers
+
+def host_workers(args, inst_params):
+    #Get per-host-class limits from json file. Older parameter files may not have them
+    limits = inst_params.get("workers", {})
+
+    #Initiate dictionary of limits
+    workers = {}
+
+    #Iterate over host classes
+    for hostclass in HOST_CLASSES:
+        #Check if user provided a number of workers
+        if args.max_workers != 0:
+            #If so, it overrides the json file
+            workers[hostclass] = args.max_workers
+
+        #Check if institution set a limit for this host class
+        elif hostclass in limits:
+            #If so, use it
+            workers[hostclass] = int(limits[hostclass])
+
+        #No limit for this host class
+        else:
+            #Fall back to the coordinator default
+            workers[hostclass] = default_workers(args)
+
+    #Capture current step
+    logger.info("Concurrent jobs per host class: %s"%workers)
+
+    #Return limits
+    return workers
+
+def runtime_limit(inst_params, hostclass):
+    #Get wall-clock limit of a host class (hours) from json file, or the README guidance
+    return float(inst_params.get("limits", {}).get(hostclass, RUNTIME_LIMITS[hostclass]))
+
+def host_limits(workers):
+    #Generate one semaphore per host class so each queue is filled exactly to capacity
+    limits = {}
+
+    #Iterate over host classes
+    for hostclass in HOST_CLASSES:
+        #Bound the number of jobs running on this host class at once
+        limits[hostclass] = threading.BoundedSemaphore(workers[hostclass])
+
+    #Return semaphores
+    return limits
+
+class LicensePool:
+    #Token bucket over a license feature (e.g., DESMOND_GPGPU). Jobs are only released when their tokens are free
+    def __init__(self, feature, tokens, per_job):
+        #License feature name passed to -lic
+        self.feature = feature
+
+        #Size of the license pool. None means no admission control
+        self.tokens = tokens
+
+        #Tokens checked out by each job
+        self.per_job = per_job
+
+        #Tokens currently free
+        self.free = tokens
+
+        #Lets waiting jobs sleep until tokens come back
+        self.condition = threading.Condition()
+
+        #Queue wait and run times for each job (name, wait, run)
+        self.timings = []
+
+        #Tokens held from the MDFit daemon's budget, by number of jobs in the submission
+        self.grants = {}
+
+    def need(self, jobs):
+        #Tokens checked out by a submission running several jobs at once
+        return self.per_job * jobs
+
+    def capacity(self):
+        #Number of jobs the pool can run at once, or None if the pool size is unknown
+        return self.tokens//self.per_job if self.tokens != None else None
+
+    def acquire(self, jobs=1):
+        #Start timer for time spent waiting on tokens
+        start = time.time()
+
+        #Check if the pool size is known
+        if self.tokens != None:
+            #Check that the submission can ever be admitted
+            if self.need(jobs) > self.tokens:
+                raise RuntimeError("%s submission of %s jobs needs %s tokens but the pool only has %s"%(self.feature, jobs, self.need(jobs), self.tokens))
+
+            #If it is, wait until enough tokens are free
+            with self.condition:
+                while self.free < self.need(jobs):
+                    self.condition.wait()
+
+                #Check out tokens
+                self.free -= self.need(jobs)
+
+        #Wait for tokens from the budget shared with other campaigns, if the campaign joined the MDFit daemon. Calls mdfit_daemon.py
+        grant = mdfit_daemon.acquire(self.feature, self.need(jobs))
+        if grant != None:
+            with self.condition:
+                self.grants.setdefault(jobs, []).append(grant)
+
+        #Return time spent waiting in the queue
+        return time.time() - start
+
+    def release(self, jobs=1):
+        #Return tokens to the MDFit daemon's budget, if any were held. Calls mdfit_daemon.py
+        with self.condition:
+            grant = self.grants[jobs].pop() if self.grants.get(jobs) else None
+        mdfit_daemon.release(grant)
+
+        #Check if the pool size is known
+        if self.tokens != None:
+            #If it is, return tokens and wake waiting jobs
+            with self.condition:
+                self.free += self.need(jobs)
+                self.condition.notify_all()
+
+    def record(self, name, queue_wait, run_time):
+        #Keep queue wait separate from run time
+        with self.condition:
+            self.timings.append((name, queue_wait, run_time))
+
+        #Capture current step
+        logger.info("%s license timing for %s: queue wait %.1f s, run %.1f s"%(self.feature, name, queue_wait, run_time))
+
+    def summary(self):
+        #Check if any jobs were run
+        if self.timings != []:
+            #If so, sum queue wait and run times
+            total_wait = sum(timing[1] for timing in self.timings)
+            total_run = sum(timing[2] for timing in self.timings)
+
+            #Capture current step
+            logger.info("%s jobs: %s, total queue wait %.1f s, total run %.1f s"%(self.feature, len(self.timings), total_wait, total_run))
+
+def license_pool(inst_params, feature):
+    #Get license settings from json file. Older parameter files may not have them
+    settings = inst_params.get("licenses", {}).get(feature, {})
+
+    #Tokens each job checks out; Desmond GPU jobs have always used 16
+    per_job = int(settings.get("PER_JOB", 16))
+
+    #Size of the license pool
+    tokens = settings.get("TOKENS")
+
+    #Check if the pool size was provided
+    if tokens == None:
+        #If not, document current step
+        logger.info("No %s pool size in parameters.json; jobs are not held for license tokens"%feature)
+
+    #Pool size was provided
+    else:
+        #Convert to integer
+        tokens = int(tokens)
+
+        #Check that a single job can ever run
+        if per_job > tokens:
+            #If not, capture error
+            logger.critical("%s jobs need %s tokens but the pool only has %s; cannot proceed"%(feature, per_job, tokens))
+
+            #Exit
+            sys.exit(1)
+
+        #Document current step
+        logger.info("%s pool: %s tokens, %s per job"%(feature, tokens, per_job))
+
+    #Return license pool
+    return LicensePool(feature, tokens, per_job)
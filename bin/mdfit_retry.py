@@ -0,0 +1,134 @@
+#!/ap/rhel7/bin/python3.6
+
+####################################################################
+# Corresponding Authors : Alexander Brueckner, Kaushik Lakkaraju ###
+# Contact : alexander.brueckner@bms.com, kaushik.lakkaraju@bms.com #
+####################################################################
+
+#Import Python modules
+import logging
+import sys
+import os
+import re
+import csv
+import threading
+import time
+
+###Initiate logger###
+logger = logging.getLogger(__name__)
+
+#Failure summary filename, written to the campaign (master) directory
+FAILURES_NAME = "MDFit_failures.csv"
+
+#Errors from the job server or license server that are worth retrying (jobcontrol and Slurm states, submission, and license checkout)
+transient_finder = re.compile(r'license|No JobId|jobserver|job server|connection (refused|reset)|timed out|temporarily unavailable|finished with status: (died|stranded|fizzled|node_fail|preempted|boot_fail|vanished)', re.IGNORECASE)
+
+#Failures isolated by --keep_going: (stage, name, attempts, error)
+failures = []
+failures_lock = threading.Lock()
+
+#Longest single wait between attempts (seconds)
+MAX_BACKOFF = 3600
+
+def transient(exc):
+    #Check if an error came from the job server or license server rather than from the job itself
+    return transient_finder.search(str(exc)) != None
+
+def should_retry(args, exc, attempt):
+    #Requeue jobs killed by the watchdog until the user's number of requeues is used up
+    if getattr(exc, "stalled", False) == True:
+        return attempt < args.stall_requeue
+
+    #Retry transient errors, and runs that can resume from a checkpoint, until the user's number of retries is used up
+    return attempt < args.retries and (transient(exc) or getattr(exc, "restartable", False) == True)
+
+def backoff(args, attempt):
+    #Double the wait after every failed attempt: backoff, 2 x backoff, 4 x backoff, ...
+    return min(MAX_BACKOFF, args.retry_backoff * 2**(attempt - 1))
+
+def retry(args, stage, name, attempt, func, *fargs):
+    #Run func(*fargs), retrying transient errors with exponential backoff. Attempt is the number of attempts already made
+    while True:
+        #Check if this is a retry
+        if attempt > 0:
+            #If so, wait before trying again
+            wait = backoff(args, attempt)
+            logger.warning("Retrying %s %s in %.0f s (attempt %s)"%(stage, name, wait, attempt + 1))
+            time.sleep(wait)
+
+        #Try stage. Stages that log CRITICAL and call sys.exit() fail like any other error, so --keep_going can isolate them
+        try:
+            try:
+                return func(*fargs)
+            except SystemExit as exc:
+                raise RuntimeError("%s %s exited with status %s; see log for details"%(stage, name, exc.code))
+
+        #Stage failed
+        except Exception as exc:
+            #Check if the error is worth retrying
+            if should_retry(args, exc, attempt) == False:
+                #If not, pass it on, with the number of attempts made
+                exc.mdfit_attempts = attempt + 1
+                raise
+
+            #Capture error
+            logger.warning("%s %s %s: %s"%(stage, name, "stalled and is requeued" if getattr(exc, "stalled", False) == True else "failed with a transient error", exc))
+
+            #Count attempt
+            attempt += 1
+
+def call(args, stage, name, func, *fargs):
+    #Run func(*fargs), retrying transient errors with exponential backoff
+    return retry(args, stage, name, 0, func, *fargs)
+
+def handle(args, stage, name, exc):
+    #Check if user wants failures isolated to their ligand or repetition
+    if args.keep_going == False:
+        #If not, capture error
+        logger.critical("%s generated an exception during %s: %s"%(name, stage, exc))
+
+        #Exit
+        sys.exit()
+
+    #Capture error
+    logger.error("%s generated an exception during %s: %s. Continuing with the rest of the campaign (--keep_going)"%(name, stage, exc))
+
+    #Add to failure summary
+    with failures_lock:
+        failures.append((stage, name, getattr(exc, "mdfit_attempts", 1), str(exc)))
+
+def failed(stage=None):
+    #Return names that failed (a stage, or any stage)
+    with failures_lock:
+        return set(name for each_stage, name, attempts, error in failures if stage == None or each_stage == stage)
+
+def summary(master_dir, filename=FAILURES_NAME):
+    #Get snapshot of failures
+    with failures_lock:
+        rows = list(failures)
+
+    #Check if anything failed
+    if rows == []:
+        #If not, remove summary left by an earlier run
+        if os.path.isfile(os.path.join(master_dir, filename)) == True:
+            os.remove(os.path.join(master_dir, filename))
+
+        #Nothing to report
+        return 0
+
+    #Capture failure summary
+    logger.error("%s stages failed and were skipped (--keep_going):"%len(rows))
+    for stage, name, attempts, error in rows:
+        logger.error("  %s %s after %s attempt(s): %s"%(stage, name, attempts, error))
+
+    #Write failure summary for rerunning or inspecting
+    with open(os.path.join(master_dir, filename), 'w', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(["stage", "name", "attempts", "error"])
+        writer.writerows(rows)
+
+    #Capture current step
+    logger.error("Failure summary written to %s"%os.path.join(master_dir, filename))
+
+    #Return number of failures
+    return len(rows)
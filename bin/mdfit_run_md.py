@@ -8,26 +8,46 @@
 #Import Python modules
 import logging
 import os
-import subprocess
+import re
+import glob
+import shutil
+import threading
+import time
+
+#Import MDFit modules
+import mdfit_batch
+import mdfit_exec
+import mdfit_job_monitor
+import mdfit_watchdog
+import mdfit_backends
+import mdfit_work_queue
 
 ###Initiate logger###
 logger = logging.getLogger(__name__)
 
-def run_job(command):
-    #Run provided command, joining list with space. Pipe stdout and sdterror to log file
-    process = subprocess.run(' '.join(command), stdout=subprocess.PIPE, \
-        stderr=subprocess.STDOUT, shell=True, text=True)
-    
-    #Iterate over sdtout and sdterror
-    for line in process.stdout.split('\n'):
-        #Ignore blank lines
-        if line != "":
-            #Ignore ExitStatus
-            if "ExitStatus" not in line:
-                #Write to log file for debugging
-                logger.debug(line)
-
-def main(ligname, args, desmond_host, SCHRODINGER, master_dir):
+#One lock per ligand so its relaxation runs once while its repetitions wait: ligand > lock
+relax_locks = {}
+relax_locks_lock = threading.Lock()
+
+#Exit status of the last Desmond run of each repetition, recorded with its production stage: repetition > returncode
+exit_codes = {}
+
+#Time Desmond spent running each repetition, without queue or relaxation waits. Segments of restarted runs add up: repetition > seconds
+run_times = {}
+
+#Pattern for the segment number of a saved partial trajectory, <repetition>_seg<#>-out.cms
+segment_number = re.compile(r'_seg(\d+)-out\.cms$')
+
+class ProductionIncomplete(Exception):
+    #Raised when Desmond finishes without a trajectory. If multisim left a checkpoint, the next attempt resumes from it
+    def __init__(self, ligname, checkpoint, returncode=None):
+        Exception.__init__(self, "Desmond wrote no trajectory for %s%s"%(ligname, "; the next attempt resumes from %s"%checkpoint if checkpoint != None else ""))
+        self.ligname = ligname
+        self.checkpoint = checkpoint
+        self.returncode = returncode
+        self.restartable = checkpoint != None
+
+def trj_names(ligname):
     #Generate trajectory file name
     outcms = "%s-out.cms"%ligname
 
@@ -37,19 +57,448 @@ def main(ligname, args, desmond_host, SCHRODINGER, master_dir):
     #Get base ligand name <ligand>
     lig_basename = ligname.split("_repetition")[0]
 
+    #Return trajectory file and directory names and ligand name
+    return outcms, outtrj, lig_basename
+
+def trj_exists(ligname, master_dir):
+    #Generate trajectory names
+    outcms, outtrj, lig_basename = trj_names(ligname)
+
+    #Check if trajectory file and directory exist
+    return os.path.isfile(os.path.join(master_dir, "desmond_md", lig_basename, ligname, outcms)) == True and os.path.isdir(os.path.join(master_dir, "desmond_md", lig_basename, ligname, outtrj)) == True
+
+def md_command(ligname, args, desmond_host, SCHRODINGER, licenses):
+    #Generate trajectory names
+    outcms, outtrj, lig_basename = trj_names(ligname)
+
+    #Prepare Schrodinger's multisim command ($SCHRODINGER/utilities/multisim)
+    run_cmd = os.path.join(SCHRODINGER, "utilities", "multisim")
+
+    #Prepare Desmond MD command
+    command = [run_cmd, '-JOBNAME', ligname, '-HOST', desmond_host, '-maxjob', '1', '-cpu', '1', '-m', '%s_md.msj'%ligname, '-c', '%s_md.cfg'%ligname, '-description', 'Molecular Dynamics', '%s_md.cms'%ligname, '-mode', 'umbrella', '-set', 'stage[1].set_family.md.jlaunch_opt=["-gpu"]', '-o', outcms, '-OPLSDIR', args.oplsdir, '-lic', '%s:%s'%(licenses.feature, licenses.per_job), '-ATTACHED', '-WAIT']
+
+    #Return command
+    return command
+
+def checkpoint(ligname):
+    #Return multisim checkpoint left in scratch space by an earlier, unfinished run, or None
+    checkpoint_file = "%s-multisim_checkpoint"%ligname
+    return checkpoint_file if os.path.isfile(checkpoint_file) == True else None
+
+def segments(ligname):
+    #Return saved partial trajectories (cms files) of a repetition, in segment order
+    return sorted(glob.glob("%s_seg*-out.cms"%ligname), key=lambda cms: int(segment_number.search(cms).group(1)))
+
+def save_segment(ligname):
+    #Find trajectories written by the unfinished run's stage directories (<repetition>_<stage>), newest last
+    trjs = sorted(glob.glob(os.path.join("%s_[0-9]*"%ligname, "*_trj")), key=os.path.getmtime)
+
+    #Check if the run wrote any frames
+    if trjs == []:
+        #If not, the restart starts from the checkpoint alone
+        return None
+
+    #Get latest partial trajectory and the system it belongs to
+    partial_trj = trjs[-1]
+
+    #Check if it was already saved by an earlier attempt that wrote no new frames
+    if segments(ligname) != [] and os.path.getmtime(partial_trj) <= os.path.getmtime(segments(ligname)[-1]):
+        #If so, nothing new to keep
+        return None
+    partial_cms = [cms for cms in (partial_trj[:-len("_trj")] + "-out.cms", partial_trj[:-len("_trj")] + "-in.cms") if os.path.isfile(cms) == True]
+
+    #Check if the system was found
+    if partial_cms == []:
+        #If not, the frames cannot be merged
+        logger.warning("No system found for partial trajectory %s; it will not be merged"%partial_trj)
+        return None
+
+    #Generate next segment name <repetition>_seg<#>
+    segment = "%s_seg%s"%(ligname, len(segments(ligname)) + 1)
+
+    #Copy partial trajectory; the restarted stage still needs its own files
+    shutil.copytree(partial_trj, "%s_trj"%segment)
+    shutil.copy(partial_cms[0], "%s-out.cms"%segment)
+
+    #Capture current step
+    logger.info("Saved partial trajectory of %s as %s"%(ligname, segment))
+
+    #Return segment name
+    return segment
+
+def restart_command(ligname, checkpoint_file, args, desmond_host, SCHRODINGER, licenses):
+    #Generate trajectory names
+    outcms, outtrj, lig_basename = trj_names(ligname)
+
+    #Prepare Schrodinger's multisim command ($SCHRODINGER/utilities/multisim)
+    run_cmd = os.path.join(SCHRODINGER, "utilities", "multisim")
+
+    #Prepare Desmond MD restart command. Completed stages are skipped and the failed stage continues from its last Desmond checkpoint
+    command = [run_cmd, '-JOBNAME', ligname, '-RESTART', checkpoint_file, '-HOST', desmond_host, '-maxjob', '1', '-cpu', '1', '-o', outcms, '-OPLSDIR', args.oplsdir, '-lic', '%s:%s'%(licenses.feature, licenses.per_job), '-ATTACHED', '-WAIT']
+
+    #Return command
+    return command
+
+def production_command(ligname, args, desmond_host, SCHRODINGER, licenses):
+    #Get checkpoint of an earlier, unfinished run
+    checkpoint_file = checkpoint(ligname)
+
+    #Check if there is one
+    if checkpoint_file == None:
+        #If not, run from the start
+        return md_command(ligname, args, desmond_host, SCHRODINGER, licenses)
+
+    #Keep the frames written so far; they are merged with the restarted run's trajectory
+    save_segment(ligname)
+
+    #Capture current step
+    logger.info("Resuming Desmond MD for %s from %s"%(ligname, checkpoint_file))
+
+    #Return restart command
+    return restart_command(ligname, checkpoint_file, args, desmond_host, SCHRODINGER, licenses)
+
+def check_trj(ligname, master_dir):
+    #Generate trajectory names
+    outcms, outtrj, lig_basename = trj_names(ligname)
+
+    #Check if Desmond wrote a trajectory to scratch space, or it was already moved to the permanent directory
+    if (os.path.isfile(outcms) == False or os.path.isdir(outtrj) == False) and trj_exists(ligname, master_dir) == False:
+        #If not, the run is incomplete
+        raise ProductionIncomplete(ligname, checkpoint(ligname), exit_codes.pop(ligname, None))
+
+def merge_segments(ligname, SCHRODINGER):
+    #Generate trajectory names
+    outcms, outtrj, lig_basename = trj_names(ligname)
+
+    #Get saved partial trajectories
+    parts = segments(ligname)
+
+    #Check if the trajectory was written in one run
+    if parts == [] or os.path.isfile(outcms) == False:
+        #If so, nothing to merge
+        return
+
+    #Prepare Schrodinger run command ($SCHRODINGER/run)
+    run_cmd = os.path.join(SCHRODINGER, "run")
+
+    #Prepare merge command: every segment, then the restarted run, in time order. Overlapping frames are taken from the later segment
+    command = [run_cmd, "trj_merge.py", outcms] + ["%s_trj"%cms[:-len("-out.cms")] for cms in parts] + [outtrj, "-o", "%s_merged"%ligname]
+
+    #Capture current step
+    logger.info("Merging %s trajectory segments: %s"%(len(parts) + 1, ' '.join(command)))
+
+    #Run merge
+    mdfit_exec.run_job(command, logger)
+
+    #Check if merge wrote a trajectory
+    if os.path.isfile("%s_merged-out.cms"%ligname) == False or os.path.isdir("%s_merged_trj"%ligname) == False:
+        #If not, keep segments for the next attempt
+        raise RuntimeError("trj_merge.py wrote no merged trajectory for %s"%ligname)
+
+    #Replace restarted run's trajectory with the merged one, so slicing and analysis see one trajectory
+    shutil.rmtree(outtrj)
+    os.remove(outcms)
+    os.rename("%s_merged_trj"%ligname, outtrj)
+    os.rename("%s_merged-out.cms"%ligname, outcms)
+
+    #Remove segments and checkpoint; the repetition is complete
+    for cms in parts:
+        shutil.rmtree("%s_trj"%cms[:-len("-out.cms")], ignore_errors=True)
+        os.remove(cms)
+    if checkpoint(ligname) != None:
+        os.remove(checkpoint(ligname))
+
+def submit(ligname, args, desmond_host, SCHRODINGER, master_dir, licenses, slot, monitor):
     #Check if trajectory file and directory exist
-    if os.path.isfile(os.path.join(master_dir, "desmond_md", lig_basename, ligname, outcms)) == False or os.path.isdir(os.path.join(master_dir, "desmond_md", lig_basename, ligname, outtrj)) == False:
-        #If not, prepare Schrodinger's multisim command ($SCHRODINGER/utilities/multisim)
-        run_cmd = os.path.join(SCHRODINGER, "utilities", "multisim")
+    if trj_exists(ligname, master_dir) == True:
+        #If they do, capture current step
+        logger.info("Desmond trajectory found: %s"%ligname)
+
+        #Nothing to wait on
+        return None
+
+    #Prepare Desmond MD command (or restart from checkpoint) without -WAIT; the monitor tracks the job
+    command = mdfit_job_monitor.detach(production_command(ligname, args, desmond_host, SCHRODINGER, licenses))
+
+    #Start timer for queue wait
+    start = time.time()
+
+    #Wait for a free Desmond slot, then for enough license tokens
+    slot.acquire()
+    licenses.acquire()
+
+    #Get time spent waiting
+    queue_wait = time.time() - start
+
+    #Start timer for run time
+    start = time.time()
+
+    #Submit Desmond MD
+    try:
+        job = monitor.submit(command, ligname, limit=mdfit_watchdog.limit("DESMOND"), outputs=list(trj_names(ligname)[:2]))
+
+    #If submission fails, give slot and tokens back
+    except Exception:
+        licenses.release()
+        slot.release()
+        raise
+
+    #Called by the monitor when the job finishes
+    def finished(job):
+        #Give slot and tokens back
+        licenses.release()
+        slot.release()
+
+        #Record queue wait and run time separately
+        licenses.record(ligname, queue_wait, time.time() - start)
+        run_times[ligname] = run_times.get(ligname, 0.0) + time.time() - start
+
+    #Release resources when the job finishes
+    job.add_done_callback(finished)
+
+    #Return future for the job
+    return job
+
+def production_stage(lines, rep):
+    #Find production stage, the simulate block that reads the repetition's cfg file
+    cfg_line = [n for n, line in enumerate(lines) if 'cfg_file' in line and '"%s_md.cfg"'%rep in line][0]
+    first = max(n for n in range(cfg_line) if lines[n].strip().startswith("simulate"))
+    last = min(n for n in range(cfg_line, len(lines)) if lines[n].strip() == "}")
+
+    #Return first and last line of the stage
+    return first, last
+
+def task_stage(lines):
+    #Find end of the task stage (first stage of every msj)
+    first = min(n for n, line in enumerate(lines) if line.strip().startswith("task"))
+    return min(n for n in range(first, len(lines)) if lines[n].rstrip() == "}")
 
-        #Prepare Desmond MD command
-        command = [run_cmd, '-JOBNAME', ligname, '-HOST', desmond_host, '-maxjob', '1', '-cpu', '1', '-m', '%s_md.msj'%ligname, '-c', '%s_md.cfg'%ligname, '-description', '"Molecular Dynamics"', '%s_md.cms'%ligname, '-mode', 'umbrella', '-set', '"stage[1].set_family.md.jlaunch_opt=[\"-gpu\"]"', '-o', outcms, '-OPLSDIR', args.oplsdir, '-lic', 'DESMOND_GPGPU:16', '-ATTACHED', '-WAIT']
+def write_relax_msj(lig_basename, rep):
+    #Read msj of the repetition (written from desmond_md_job_template.msj)
+    with open("%s_md.msj"%rep, "r") as template:
+        lines = template.readlines()
+
+    #Keep every stage before production (relaxation protocol)
+    first, last = production_stage(lines, rep)
+
+    #Write relaxation msj
+    with open("%s_relax.msj"%lig_basename, "w") as relaxoutput:
+        relaxoutput.writelines(lines[:first])
+
+def write_production_msj(rep):
+    #Read msj of the repetition
+    with open("%s_md.msj"%rep, "r") as template:
+        lines = template.readlines()
+
+    #Find task and production stages
+    task_end = task_stage(lines)
+    first, last = production_stage(lines, rep)
+
+    #Rewrite msj without the relaxation stages; production randomizes velocities from the cfg seed (RSEED)
+    with open("%s_md.msj"%rep, "w") as repoutput:
+        repoutput.writelines(lines[:task_end+1] + ["\n"] + lines[first:])
+
+def shared_relax(ligname, args, desmond_host, SCHRODINGER, master_dir, licenses):
+    #Generate trajectory names
+    outcms, outtrj, lig_basename = trj_names(ligname)
+
+    #Check if trajectory file and directory exist
+    if trj_exists(ligname, master_dir) == True:
+        #If they do, nothing to start
+        return
+
+    #Generate relaxed system filename, kept in the ligand's md_setup directory
+    relaxed = "%s_relax-out.cms"%lig_basename
+    setup_relaxed = os.path.join(master_dir, "desmond_md", lig_basename, "md_setup", relaxed)
+
+    #Get ligand's lock
+    with relax_locks_lock:
+        lock = relax_locks.setdefault(lig_basename, threading.Lock())
+
+    #Relax each ligand once; other repetitions (of this or another MDFit process sharing the work queue) wait here
+    with lock, mdfit_work_queue.mutex("relax_%s"%lig_basename):
+        #Check if ligand was already relaxed
+        if os.path.isfile(setup_relaxed) == False:
+            #If not, write relaxation msj from this repetition's msj
+            write_relax_msj(lig_basename, ligname)
+
+            #Prepare Schrodinger's multisim command ($SCHRODINGER/utilities/multisim)
+            run_cmd = os.path.join(SCHRODINGER, "utilities", "multisim")
+
+            #Prepare relaxation command
+            command = [run_cmd, '-JOBNAME', '%s_relax'%lig_basename, '-HOST', desmond_host, '-maxjob', '1', '-cpu', '1', '-m', '%s_relax.msj'%lig_basename, '-c', '%s_md.cfg'%ligname, '-description', 'Relaxation', '%s_md.cms'%ligname, '-mode', 'umbrella', '-set', 'stage[1].set_family.md.jlaunch_opt=["-gpu"]', '-o', relaxed, '-OPLSDIR', args.oplsdir, '-lic', '%s:%s'%(licenses.feature, licenses.per_job), '-ATTACHED', '-WAIT']
+
+            #Wait until enough license tokens are free
+            queue_wait = licenses.acquire()
+
+            #Capture current step
+            logger.info("Relaxing %s once for all repetitions: %s"%(lig_basename, ' '.join(command)))
+
+            #Start timer for run time
+            start = time.time()
+
+            #Run relaxation, always returning tokens to the pool
+            try:
+                #Get shared job monitor, if the user asked for one and this host class runs on jobcontrol. Calls mdfit_backends.py
+                monitor = mdfit_backends.monitor("DESMOND")
+
+                #Check if jobs are tracked by the monitor
+                if monitor != None:
+                    #If so, submit without -WAIT and wait on the monitor
+                    monitor.run(mdfit_job_monitor.detach(command), "%s_relax"%lig_basename, limit=mdfit_watchdog.limit("DESMOND"), outputs=[relaxed])
+
+                #Jobs are run with -WAIT (or on another backend), killed at the DESMOND limit. Calls mdfit_watchdog.py
+                else:
+                    mdfit_watchdog.run_job(command, logger, "DESMOND", outputs=[relaxed])
+            finally:
+                licenses.release()
+
+            #Record queue wait and run time separately
+            licenses.record("%s_relax"%lig_basename, queue_wait, time.time() - start)
+
+            #Check that relaxation wrote the equilibrated system
+            if os.path.isfile(relaxed) == False:
+                raise RuntimeError("Relaxation wrote no system for %s (%s)"%(lig_basename, relaxed))
+
+            #Keep relaxed system with the ligand's setup files
+            shutil.copy(relaxed, setup_relaxed)
+
+        #Ligand was already relaxed
+        else:
+            #Capture current step
+            logger.info("Relaxed system found: %s"%setup_relaxed)
+
+    #Start this repetition from the relaxed system
+    shutil.copy(setup_relaxed, "%s_md.cms"%ligname)
+
+    #Run production stage only
+    write_production_msj(ligname)
+
+def write_pack_msj(packname, reps):
+    #Read msj of the first repetition (written from desmond_md_job_template.msj)
+    with open("%s_md.msj"%reps[0], "r") as template:
+        lines = template.readlines()
+
+    #Find production stage
+    first, last = production_stage(lines, reps[0])
+
+    #Make production stage a list with one setting per repetition; multisim forks one subjob per setting
+    stage = ["simulate [\n"]
+    for rep in reps:
+        stage.extend(['   {\n', '      cfg_file = "%s_md.cfg"\n'%rep, '      jobname  = "%s"\n'%rep, '      dir      = "."\n', '      compress = ""\n', '   }\n'])
+    stage.append("]\n")
+
+    #Write pack msj
+    with open("%s_md.msj"%packname, "w") as packoutput:
+        packoutput.writelines(lines[:first] + stage + lines[last+1:])
+
+def pack_command(packname, reps, args, desmond_host, SCHRODINGER, licenses):
+    #Prepare Schrodinger's multisim command ($SCHRODINGER/utilities/multisim)
+    run_cmd = os.path.join(SCHRODINGER, "utilities", "multisim")
+
+    #Prepare Desmond MD command for every repetition in the pack. All repetitions share the setup cms; each has its own cfg (seed)
+    command = [run_cmd, '-JOBNAME', packname, '-HOST', desmond_host, '-maxjob', str(len(reps)), '-cpu', '1', '-m', '%s_md.msj'%packname, '-c', '%s_md.cfg'%reps[0], '-description', 'Molecular Dynamics', '%s_md.cms'%reps[0], '-mode', 'umbrella', '-set', 'stage[1].set_family.md.jlaunch_opt=["-gpu"]', '-OPLSDIR', args.oplsdir, '-lic', '%s:%s'%(licenses.feature, licenses.per_job), '-ATTACHED', '-WAIT']
+
+    #Return command
+    return command
+
+def run_pack(reps, number, args, desmond_host, SCHRODINGER, licenses):
+    #Generate pack job name <ligand>_pack<#>
+    packname = "%s_pack%s"%(trj_names(reps[0])[2], number)
+
+    #Write pack msj
+    write_pack_msj(packname, reps)
+
+    #Prepare Desmond MD command
+    command = pack_command(packname, reps, args, desmond_host, SCHRODINGER, licenses)
+
+    #Wait until tokens for every repetition in the pack are free
+    queue_wait = licenses.acquire(len(reps))
+
+    #Capture current step
+    logger.info("Running %s repetitions in one Desmond submission: %s"%(len(reps), ' '.join(command)))
+
+    #Start timer for run time
+    start = time.time()
+
+    #Run Desmond MD, always returning tokens to the pool
+    try:
+        #Get shared job monitor, if the user asked for one and this host class runs on jobcontrol. Calls mdfit_backends.py
+        monitor = mdfit_backends.monitor("DESMOND")
+
+        #Check if jobs are tracked by the monitor
+        if monitor != None:
+            #If so, submit without -WAIT and wait on the monitor
+            monitor.run(mdfit_job_monitor.detach(command), packname, limit=mdfit_watchdog.limit("DESMOND"), members=reps, outputs=[name for rep in reps for name in trj_names(rep)[:2]])
+
+        #Jobs are run with -WAIT (or on another backend), killed at the DESMOND limit. Calls mdfit_watchdog.py
+        else:
+            result = mdfit_watchdog.run_job(command, logger, "DESMOND", members=reps, outputs=[name for rep in reps for name in trj_names(rep)[:2]])
+
+            #Keep exit status of every repetition in the pack
+            for rep in reps:
+                exit_codes[rep] = result.returncode
+    finally:
+        licenses.release(len(reps))
+
+        #Every repetition in the pack ran for the whole submission
+        for rep in reps:
+            run_times[rep] = run_times.get(rep, 0.0) + time.time() - start
+
+    #Record queue wait and run time separately
+    licenses.record(packname, queue_wait, time.time() - start)
+
+def pack_main(ligname, args, desmond_host, SCHRODINGER, master_dir, licenses):
+    #Generate trajectory names
+    outcms, outtrj, lig_basename = trj_names(ligname)
+
+    #Check if trajectory file and directory exist
+    if trj_exists(ligname, master_dir) == False:
+        #If not, get shared pack collector for this ligand
+        batcher = mdfit_batch.batcher("DESMOND_%s"%lig_basename, args.rep_pack)
+
+        #Wait for the repetition's pack to finish
+        batcher.run(ligname, lambda reps, number: run_pack(reps, number, args, desmond_host, SCHRODINGER, licenses))
+
+        #Check that the pack wrote this repetition's trajectory to scratch space
+        if os.path.isfile(outcms) == False or os.path.isdir(outtrj) == False:
+            raise RuntimeError("Desmond pack wrote no trajectory for %s"%ligname)
+
+    #Trajectory file(s) exist
+    else:
+        #Capture current step
+        logger.info("Desmond trajectory found: %s, %s"%(outcms, outtrj))
+
+    #Return trajectory file and directory names and ligand name
+    return outcms, outtrj, lig_basename
+
+def main(ligname, args, desmond_host, SCHRODINGER, master_dir, licenses):
+    #Generate trajectory names
+    outcms, outtrj, lig_basename = trj_names(ligname)
+
+    #Check if trajectory file and directory exist
+    if trj_exists(ligname, master_dir) == False:
+        #If not, prepare Desmond MD command, or restart from the checkpoint of an unfinished run
+        command = production_command(ligname, args, desmond_host, SCHRODINGER, licenses)
         
+        #Wait until enough license tokens are free
+        queue_wait = licenses.acquire()
+
         #Capture current step
         logger.info("Running Desmond: %s"%' '.join(command))
 
-        #Run Desmond MD
-        run_job(command)
+        #Start timer for run time
+        start = time.time()
+
+        #Run Desmond MD, always returning tokens to the pool. Killed at the DESMOND limit. Calls mdfit_watchdog.py
+        try:
+            exit_codes[ligname] = mdfit_watchdog.run_job(command, logger, "DESMOND", outputs=[outcms, outtrj]).returncode
+        finally:
+            licenses.release()
+            run_times[ligname] = run_times.get(ligname, 0.0) + time.time() - start
+
+        #Record queue wait and run time separately
+        licenses.record(ligname, queue_wait, time.time() - start)
 
     #Trajectory file(s) exist
     else:
@@ -60,4 +509,4 @@ def main(ligname, args, desmond_host, SCHRODINGER, master_dir):
     return outcms, outtrj, lig_basename
 
 if __name__ == '__main__':
-    main(ligname, args, desmond_host, SCHRODINGER, master_dir)
\ No newline at end of file
+    main(ligname, args, desmond_host, SCHRODINGER, master_dir, licenses)
\ No newline at end of file
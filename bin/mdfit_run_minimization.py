@@ -8,24 +8,122 @@
 #Import Python modules
 import logging
 import os
-import subprocess
+
+#Import Schrodinger modules
+from schrodinger import structure
+
+#Import MDFit modules
+import mdfit_batch
+import mdfit_job_monitor
+import mdfit_watchdog
+import mdfit_backends
 
 ###Initiate logger###
 logger = logging.getLogger(__name__)
 
-def run_job(command):
-    #Run provided command, joining list with space. Pipe stdout and sdterror to log file
-    process = subprocess.run(' '.join(command), stdout=subprocess.PIPE, \
-        stderr=subprocess.STDOUT, shell=True, text=True)
-    
-    #Iterate over sdtout and sdterror
-    for line in process.stdout.split('\n'):
-        #Ignore blank lines
-        if line != "":
-            #Ignore ExitStatus
-            if "ExitStatus" not in line:
-                #Write to log file for debugging
-                logger.debug(line)
+#Structure property used to match minimized complexes back to their ligands
+LIGAND_PROPERTY = "s_mdfit_ligand"
+
+def write_com(template_dir, comname, in_name, out_name):
+    #Read in minimization template
+    with open(os.path.join(template_dir, "bmin_template.com"), "r") as template:
+        #Put all lines in variable
+        lines = template.readlines()
+
+    #Open job file for writing
+    with open(comname, "w") as output:
+        #Iterate over all lines in template
+        for line in lines:
+            #Write line to file, replacing key strings IN_NAME and OUT_NAME (input and output filenames)
+            output.write(line.replace("IN_NAME", in_name).replace("OUT_NAME", out_name))
+
+def submit(jobname, args, bmin_host, SCHRODINGER, members=None, outputs=None):
+    #Prepare Schrodinger's bmin command ($SCHRODINGER/bmin)
+    run_cmd = os.path.join(SCHRODINGER, "bmin")
+
+    #Prepare minimization command
+    command = [run_cmd, jobname, "-OPLSDIR", args.oplsdir, "-HOST", bmin_host, "-WAIT"]
+
+    #Capture current step
+    logger.info("Running minimization: %s"%' '.join(command))
+
+    #Get shared job monitor, if the user asked for one and this host class runs on jobcontrol. Calls mdfit_backends.py
+    monitor = mdfit_backends.monitor("BMIN")
+
+    #Check if jobs are tracked by the monitor
+    if monitor != None:
+        #If so, submit without -WAIT and wait on the monitor
+        monitor.run(mdfit_job_monitor.detach(command), jobname, limit=mdfit_watchdog.limit("BMIN"), members=members, outputs=outputs)
+
+    #Jobs are run with -WAIT, or on another backend
+    else:
+        #Run minimization, killing it at the BMIN limit. Calls mdfit_watchdog.py
+        mdfit_watchdog.run_job(command, logger, "BMIN", name=jobname, members=members, outputs=outputs)
+
+def run_batch(ligands, number, args, bmin_host, SCHRODINGER, template_dir, slot):
+    #Generate batch job name and filenames
+    jobname = "mdfit_bmin_batch%s"%number
+    in_name = "%s_in.mae"%jobname
+    out_name = "%s_out.mae"%jobname
+
+    #Write every complex to one input file, tagged with its ligand name. bmin minimizes each structure in turn (BGIN/END)
+    with structure.StructureWriter(in_name) as writer:
+        for ligname in ligands:
+            complex_st = structure.StructureReader.read("%s_out_complex.mae"%ligname)
+            complex_st.property[LIGAND_PROPERTY] = ligname
+            writer.append(complex_st)
+
+    #Write batch job file
+    write_com(template_dir, "%s.com"%jobname, in_name, out_name)
+
+    #Capture current step
+    logger.info("Minimizing %s complexes in one bmin job (%s): %s"%(len(ligands), jobname, ', '.join(ligands)))
+
+    #Wait for a free BMIN slot, then minimize batch
+    with slot:
+        submit(jobname, args, bmin_host, SCHRODINGER, ligands, [out_name])
+
+    #Check if bmin wrote output
+    if os.path.isfile(out_name) == False:
+        #If not, every ligand in the batch failed
+        raise RuntimeError("bmin batch %s wrote no output (%s)"%(jobname, out_name))
+
+    #Iterate over minimized complexes, in input order
+    found = set()
+    for position, minimized in enumerate(structure.StructureReader(out_name)):
+        #Match complex to its ligand by tag, or by position if bmin dropped the tag
+        ligname = minimized.property.get(LIGAND_PROPERTY, ligands[position] if position < len(ligands) else None)
+
+        #Write per-ligand minimized complex, as a single bmin job would
+        if ligname in ligands:
+            minimized.write("%s_out_complex_min.mae"%ligname)
+            found.add(ligname)
+
+    #Check that every ligand came back
+    missing = [ligname for ligname in ligands if ligname not in found]
+    if missing != []:
+        raise RuntimeError("bmin batch %s returned no minimized complex for %s"%(jobname, ', '.join(missing)))
+
+def batched(ligname, pvcomplex, args, bmin_host, SCHRODINGER, master_dir, template_dir, slot):
+    #Generate output minimized complex filename
+    bmincomplex = "%s_out_complex_min.mae"%ligname
+
+    #Check if minimized complex exists
+    if os.path.isfile(os.path.join(master_dir, "desmond_md", ligname, "md_setup", bmincomplex)) == True:
+        #If it does, capture current step
+        logger.info("Minimized complex found: %s"%bmincomplex)
+
+        #Nothing to minimize
+        return bmincomplex
+
+    #Get shared BMIN batcher
+    batcher = mdfit_batch.batcher("BMIN", args.bmin_batch)
+
+    #Wait for the ligand's batch to be minimized
+    batcher.run(ligname, lambda ligands, number: run_batch(ligands, number, args, bmin_host, SCHRODINGER, template_dir, slot))
+
+    #Return minimized complex filename
+    return bmincomplex
 
 def main(ligname, pvcomplex, args, bmin_host, SCHRODINGER, master_dir, template_dir):
     #Generate output minimized complex filename
@@ -33,29 +131,11 @@ def main(ligname, pvcomplex, args, bmin_host, SCHRODINGER, master_dir, template_
 
     #Check if minimized complex exists
     if os.path.isfile(os.path.join(master_dir, "desmond_md", ligname, "md_setup", bmincomplex)) == False:
-        #If not, read in minimization template
-        with open(os.path.join(template_dir, "bmin_template.com"), "r") as template:
-            #Put all lines in variable
-            lines = template.readlines()
-        
-        #Open ligand-specific job file for writing
-        with open("%s_min.com"%ligname, "w") as ligoutput:
-            #Iterate over all lines in template
-            for line in lines:
-                #Write line to file, replacing key strings IN_NAME and OUT_NAME (complex filename and output filename)
-                ligoutput.write(line.replace("IN_NAME","%s_out_complex.mae"%ligname).replace("OUT_NAME","%s_out_complex_min.mae"%ligname))
-        
-        #Prepare Schrodinger's bmin command ($SCHRODINGER/bmin)
-        run_cmd = os.path.join(SCHRODINGER, "bmin")
-
-        #Prepare minimization command
-        command = [run_cmd, "%s_min"%ligname, "-OPLSDIR", args.oplsdir, "-HOST", bmin_host, "-WAIT"]
-
-        #Capture current step
-        logger.info("Running minimization: %s"%' '.join(command))
+        #If not, write ligand-specific job file from the minimization template
+        write_com(template_dir, "%s_min.com"%ligname, "%s_out_complex.mae"%ligname, bmincomplex)
 
-        #Run minimization
-        run_job(command)
+        #Minimize complex
+        submit("%s_min"%ligname, args, bmin_host, SCHRODINGER, outputs=[bmincomplex])
     
     #Minimized complex exists
     else:
@@ -0,0 +1,260 @@
+#!/ap/rhel7/bin/python3.6
+
+####################################################################
+# Corresponding Authors : Alexander Brueckner, Kaushik Lakkaraju ###
+# Contact : alexander.brueckner@bms.com, kaushik.lakkaraju@bms.com #
+####################################################################
+
+#Import Python modules
+import logging
+import os
+import glob
+import socket
+import sqlite3
+import threading
+import time
+
+#Import MDFit modules
+import mdfit_schedule
+
+###Initiate logger###
+logger = logging.getLogger(__name__)
+
+#History database filename, kept in the campaign (master) directory unless parameters.json names a shared one ("HISTORY")
+DB_NAME = "MDFit_history.db"
+
+#Host class that runs each stage (keys in the "hostnames" block of parameters.json). Other stages run locally
+STAGE_HOSTS = {
+    "setup": "MULTISIM",
+    "production": "DESMOND",
+    "event_analysis": "ANALYSIS",
+}
+
+#Fewest finished jobs needed before a stage's model is used
+MIN_HISTORY = 3
+
+#History shared by every stage
+history = None
+
+def history_path(master_dir, inst_params):
+    #Use shared history named in parameters.json, so every campaign learns from the others
+    return inst_params.get("parameters", {}).get("HISTORY", os.path.join(master_dir, DB_NAME))
+
+def history_files(path):
+    #Get history and every writer's file next to it, <history>.<owner>.db
+    return sorted(set(glob.glob("%s.*.db"%os.path.splitext(path)[0]) + ([path] if os.path.isfile(path) == True else [])))
+
+def read_rows(paths):
+    #Read finished jobs from history files, read-only: (stage, host, atoms, md_sim_time, md_traj_write_freq, elapsed)
+    rows = []
+    for path in paths:
+        conn = sqlite3.connect("file:%s?mode=ro"%path, uri=True)
+        try:
+            rows.extend(conn.execute("SELECT stage, host, atoms, md_sim_time, md_traj_write_freq, elapsed FROM history"))
+
+        #Never let one unreadable file stop the campaign
+        except sqlite3.Error as exc:
+            logger.warning("Could not read runtime history %s: %s"%(path, exc))
+        finally:
+            conn.close()
+
+    #Return rows
+    return rows
+
+def work(stage, atoms, md_sim_time, md_traj_write_freq):
+    #Check for setup, which only depends on system size
+    if stage == "setup":
+        return atoms
+
+    #Production scales with system size and simulated time
+    if stage == "production":
+        return atoms * md_sim_time
+
+    #Analysis stages scale with system size and number of frames
+    return atoms * md_sim_time / md_traj_write_freq
+
+class RuntimeHistory:
+    #SQLite record of wall time per finished stage, with the features used to predict new jobs
+    def __init__(self, path, master_dir, args, inst_params, owner=None):
+        #Generate path this process writes: the history itself, or its own file next to a history other processes share. SQLite locking cannot be trusted between hosts on NFS
+        self.path = path if owner == None else "%s.%s.db"%(os.path.splitext(path)[0], owner)
+        self.master_dir = master_dir
+        self.args = args
+        self.hostnames = inst_params.get("hostnames", {})
+
+        #Open database. Worker threads share one connection behind a lock
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=60)
+        self.lock = threading.Lock()
+
+        #Make table if this is a new history
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS history (ligand TEXT, repetition TEXT, stage TEXT, host TEXT, atoms INTEGER, md_sim_time REAL, md_traj_write_freq REAL, elapsed REAL, finished REAL)")
+
+        #Read jobs recorded by other processes once
+        self.others = read_rows([each_path for each_path in history_files(path) if each_path != self.path])
+
+        #Fitted models: (stage, host) > (intercept, slope, rows)
+        self.models = {}
+
+    def host(self, stage):
+        #Get hostname of the stage's host class, or localhost
+        return self.hostnames.get(STAGE_HOSTS.get(stage), "localhost")
+
+    def record(self, ligand, repetition, stage, elapsed):
+        #Get system size of the repetition, or of the ligand for setup
+        atoms = mdfit_schedule.system_size(self.master_dir, repetition if repetition != "" else ligand)
+
+        #Add finished stage to history
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (ligand, repetition, stage, self.host(stage), atoms, self.args.md_sim_time, self.args.md_traj_write_freq, elapsed, time.time()))
+
+            #Refit this stage's model on next use
+            self.models.pop((stage, self.host(stage)), None)
+
+    def fit(self, stage, host):
+        #Get finished jobs of this stage on this host, recorded by this process or others
+        with self.lock:
+            rows = self.conn.execute("SELECT atoms, md_sim_time, md_traj_write_freq, elapsed FROM history WHERE stage = ? AND host = ? AND atoms > 0", (stage, host)).fetchall()
+        rows += [row[2:] for row in self.others if row[0] == stage and row[1] == host and row[2] > 0]
+
+        #Generate work (x) and wall time (y) of every job
+        x = [work(stage, atoms, simtime, freq) for atoms, simtime, freq, elapsed in rows]
+        y = [elapsed for atoms, simtime, freq, elapsed in rows]
+
+        #Check if there is enough history
+        if len(rows) < MIN_HISTORY:
+            #If not, no model
+            return None
+
+        #Least-squares line: elapsed = intercept + slope * work
+        mean_x = sum(x) / len(x)
+        mean_y = sum(y) / len(y)
+        spread = sum((each_x - mean_x)**2 for each_x in x)
+
+        #Check if every job had the same work
+        if spread == 0:
+            #If so, predict the mean wall time per unit of work
+            return (0.0, sum(y) / sum(x), len(rows))
+
+        #Fit slope and intercept
+        slope = sum((each_x - mean_x)*(each_y - mean_y) for each_x, each_y in zip(x, y)) / spread
+        intercept = mean_y - slope*mean_x
+
+        #Return model
+        return (intercept, slope, len(rows))
+
+    def model(self, stage, host=None):
+        #Get (and cache) model of a stage on a host
+        host = host if host != None else self.host(stage)
+        if (stage, host) not in self.models:
+            self.models[(stage, host)] = self.fit(stage, host)
+        return self.models[(stage, host)]
+
+    def predict(self, stage, atoms, md_sim_time=None, md_traj_write_freq=None):
+        #Get model
+        model = self.model(stage)
+
+        #Check if there is a model
+        if model == None:
+            #If not, no prediction
+            return None
+
+        #Use this campaign's simulation time and write frequency by default
+        md_sim_time = md_sim_time if md_sim_time != None else self.args.md_sim_time
+        md_traj_write_freq = md_traj_write_freq if md_traj_write_freq != None else self.args.md_traj_write_freq
+
+        #Return predicted wall time (seconds), never negative
+        return max(0.0, model[0] + model[1]*work(stage, atoms, md_sim_time, md_traj_write_freq))
+
+    def close(self):
+        #Close database
+        with self.lock:
+            self.conn.close()
+
+def open_history(master_dir, args, inst_params, owner=None):
+    #Open history shared by every stage. A history named in parameters.json is shared between campaigns, so this process writes its own file next to it
+    global history
+    if owner == None and "HISTORY" in inst_params.get("parameters", {}):
+        owner = "%s.%s"%(socket.gethostname(), os.getpid())
+    history = RuntimeHistory(history_path(master_dir, inst_params), master_dir, args, inst_params, owner)
+
+    #Capture current step
+    logger.info("Runtime history: %s"%history.path)
+
+    #Return history
+    return history
+
+def current():
+    #Return shared history, or None if not opened
+    return history
+
+def close():
+    #Close shared history, if open
+    global history
+    if history != None:
+        history.close()
+        history = None
+
+def record(ligand, repetition, stage, elapsed):
+    #Add finished stage to history, if open. Never stops a stage from being recorded as finished
+    if history != None:
+        try:
+            history.record(ligand, repetition, stage, elapsed)
+        except Exception as exc:
+            logger.warning("Could not record runtime of %s %s %s: %s"%(ligand, repetition, stage, exc))
+
+def predict(stage, atoms):
+    #Predict wall time (seconds) of a stage for a system size, or None without a model
+    return history.predict(stage, atoms) if history != None else None
+
+def eta(master_dir, reps, slots):
+    #Predict production time of every repetition
+    predictions = [predict("production", mdfit_schedule.system_size(master_dir, rep)) for rep in reps]
+
+    #Check if every repetition has a prediction
+    if reps == [] or None in predictions:
+        #If not, no estimate
+        return None
+
+    #Estimate wall time by filling slots longest first
+    finish = [0.0]*max(1, slots)
+    for seconds in sorted(predictions, reverse=True):
+        finish[finish.index(min(finish))] += seconds
+
+    #Return total job time and wall time (seconds)
+    return sum(predictions), max(finish)
+
+def check_budget(master_dir, reps, slots, limit_hours):
+    #Iterate over repetitions
+    for rep in reps:
+        #Predict production time
+        seconds = predict("production", mdfit_schedule.system_size(master_dir, rep))
+
+        #Check if the job is expected to run past the Desmond limit
+        if seconds != None and seconds > limit_hours*3600:
+            #If so, warn before it is submitted
+            logger.warning("%s: --md_sim_time %s ps is predicted to take %.1f h, over the %s h Desmond limit"%(rep, history.args.md_sim_time, seconds/3600, limit_hours))
+
+    #Estimate production time of the whole set
+    estimate = eta(master_dir, reps, slots)
+
+    #Check if there is an estimate
+    if estimate != None:
+        #If so, capture current step
+        logger.info("Predicted production: %.1f GPU-hours, about %.1f h on %s Desmond slots"%(estimate[0]/3600, estimate[1]/3600, slots))
+
+def report(path):
+    #Check if history exists
+    if history_files(path) == []:
+        #If not, nothing has been recorded
+        return
+
+    #Read every writer's file, read-only, and collect wall times per stage and host
+    elapsed = {}
+    for stage, host, atoms, md_sim_time, md_traj_write_freq, seconds in read_rows(history_files(path)):
+        elapsed.setdefault((stage, host), []).append(seconds)
+
+    #Print number of jobs and mean wall time per stage and host
+    print("\n%-16s %-24s %6s %14s"%("Stage", "Host", "jobs", "mean wall (h)"))
+    for (stage, host), times in sorted(elapsed.items()):
+        print("%-16s %-24s %6s %14.2f"%(stage, host, len(times), sum(times)/len(times)/3600))
@@ -0,0 +1,82 @@
+#!/ap/rhel7/bin/python3.6
+
+####################################################################
+# Corresponding Authors : Alexander Brueckner, Kaushik Lakkaraju ###
+# Contact : alexander.brueckner@bms.com, kaushik.lakkaraju@bms.com #
+####################################################################
+
+#Import Python modules
+import logging
+import os
+import re
+
+#Import MDFit modules
+import mdfit_ligand_library
+import mdfit_runtime
+
+###Initiate logger###
+logger = logging.getLogger(__name__)
+
+#Scheduling policies: library order, longest job first (balances slots), shortest job first (early results)
+POLICIES = ("library", "lpt", "sjf")
+
+#Pattern for the atom block header of a Maestro/cms structure, m_atom[N] {
+atom_block = re.compile(r'^\s*m_atom\[(\d+)\]')
+
+def system_atoms(cms_path):
+    #Read until the first atom block; its header holds the atom count of the full system
+    with open(cms_path, 'r', errors="replace") as fp:
+        for line in fp:
+            match = atom_block.match(line)
+            if match:
+                return int(match.group(1))
+
+    #No atom block found
+    return None
+
+def ligand_cost(i):
+    #Estimate setup cost of ligand number i from its atom count in the ligand manifest
+    manifest = mdfit_ligand_library.current()
+    return manifest[i].atoms if manifest != None else 0
+
+def system_size(master_dir, rep):
+    #Get ligand basename
+    lig_basename = rep.split("_repetition")[0]
+
+    #Generate path to the ligand's simulation box
+    simbox = os.path.join(master_dir, "desmond_md", lig_basename, "md_setup", "%s_md_setup_out.cms"%lig_basename)
+
+    #Get size of the solvated system
+    if os.path.isfile(simbox) == True:
+        atoms = system_atoms(simbox)
+        if atoms != None:
+            return atoms
+
+    #Fall back to the ligand's atom count from the manifest
+    entry = mdfit_ligand_library.entry(lig_basename)
+    return entry.atoms if entry != None else 0
+
+def rep_cost(master_dir, rep):
+    #Get size of the solvated system
+    atoms = system_size(master_dir, rep)
+
+    #Estimate production cost from the runtime model, or from system size until there is enough history
+    seconds = mdfit_runtime.predict("production", atoms)
+    return round(seconds) if seconds != None else atoms
+
+def order(items, cost, policy, label, name=str):
+    #Keep library order if requested
+    if policy == "library":
+        return list(items)
+
+    #Estimate cost of each item once
+    costs = {item: cost(item) for item in items}
+
+    #Sort by estimated cost; longest first for lpt, shortest first for sjf. Ties keep library order
+    ordered = sorted(items, key=lambda item: costs[item], reverse=(policy == "lpt"))
+
+    #Capture current step
+    logger.info("%s order (%s): %s"%(label, policy, ', '.join("%s (%s)"%(name(item), costs[item]) for item in ordered)))
+
+    #Return ordered items
+    return ordered
@@ -9,28 +9,16 @@
 import logging
 import sys
 import os
-import subprocess
 
 #Import Schrodinger modules
 from schrodinger.application.desmond.packages import traj
 
+#Import MDFit modules
+import mdfit_exec
+
 ###Initiate logger###
 logger = logging.getLogger(__name__)
 
-def run_job(command):
-    #Run provided command, joining list with space. Pipe stdout and sdterror to log file
-    process = subprocess.run(' '.join(command), stdout=subprocess.PIPE, \
-        stderr=subprocess.STDOUT, shell=True, text=True)
-    
-    #Iterate over sdtout and sdterror
-    for line in process.stdout.split('\n'):
-        #Ignore blank lines
-        if line != "":
-            #Ignore ExitStatus
-            if "ExitStatus" not in line:
-                #Write to log file for debugging
-                logger.debug(line)
-
 def count_frames(trj_path):
     #Read in trajectory with Schrodinger's read_traj utilty
     tr = traj.read_traj(trj_path)
@@ -75,17 +63,22 @@ def main(SCHRODINGER, rep, master_dir, args):
 
             #Check if user wants to remove frames from end of trajectory
             if args.slice_end == None:
-                #If not, set variable to total number of frames
-                args.slice_end = total_frames
+                #If not, set variable to total number of frames. Kept local; other repetitions may differ in length
+                slice_end = total_frames
+
+            #User provided last frame
+            else:
+                #Assign to variable
+                slice_end = args.slice_end
 
             #Prepare slice command
-            trj_slice = [run_cmd, "trj_merge.py", "-s", "%s:%s:1"%(args.slice_start, args.slice_end), "-o", "%s_sliced"%basename, cms_path, trj_path]
+            trj_slice = [run_cmd, "trj_merge.py", "-s", "%s:%s:1"%(args.slice_start, slice_end), "-o", "%s_sliced"%basename, cms_path, trj_path]
 
             #Capture current step
             logger.info("Removing frames from trajectory: %s"%' '.join(trj_slice))
 
             #Run trajectory slicing
-            run_job(trj_slice)
+            mdfit_exec.run_job(trj_slice, logger)
     
         #Slice has been done before
         else:
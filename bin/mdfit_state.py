@@ -0,0 +1,302 @@
+#!/ap/rhel7/bin/python3.6
+
+####################################################################
+# Corresponding Authors : Alexander Brueckner, Kaushik Lakkaraju ###
+# Contact : alexander.brueckner@bms.com, kaushik.lakkaraju@bms.com #
+####################################################################
+
+#Import Python modules
+import logging
+import os
+import glob
+import json
+import sqlite3
+import threading
+import time
+import contextlib
+
+###Initiate logger###
+logger = logging.getLogger(__name__)
+
+#State database filename, kept in the campaign (master) directory. Each MDFit process sharing a work queue writes its own, MDFit_state.<owner>.db
+DB_NAME = "MDFit_state.db"
+
+#Stages recorded in the database, in workflow order. Setup is per ligand; everything else is per repetition
+STAGES = ("setup", "production", "slice", "event_analysis", "tabulate", "cluster")
+
+#Database shared by every stage
+state = None
+
+#Called with (ligand, repetition, stage, elapsed seconds) when a stage started by this process finishes
+finish_callbacks = []
+
+def db_path(master_dir, owner=None):
+    #Generate path to the database a process writes. SQLite locking cannot be trusted between hosts on NFS, so work queue coordinators never write the same file
+    return os.path.join(master_dir, DB_NAME if owner == None else "%s.%s.db"%(os.path.splitext(DB_NAME)[0], owner))
+
+def databases(master_dir):
+    #Get every state database of the campaign: MDFit_state.db and one per work queue coordinator
+    return sorted(glob.glob(os.path.join(master_dir, "%s*.db"%os.path.splitext(DB_NAME)[0])))
+
+def merge(master_dir):
+    #Read stages and job IDs from every state database, read-only. The latest record of each stage or job wins
+    stages = {}
+    jobs = {}
+    for path in databases(master_dir):
+        conn = sqlite3.connect("file:%s?mode=ro"%path, uri=True)
+        try:
+            #Databases from before stage fingerprints were recorded lack the column
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(stages)")]
+            fingerprint = "fingerprint" if "fingerprint" in columns else "NULL"
+
+            #Keep latest record of each stage: (ligand, repetition, stage) > (time, row)
+            for row in conn.execute("SELECT ligand, repetition, stage, status, started, finished, exit_code, error, %s FROM stages"%fingerprint):
+                when = max(row[4] or 0, row[5] or 0)
+                if row[:3] not in stages or when >= stages[row[:3]][0]:
+                    stages[row[:3]] = (when, row)
+
+            #Keep latest record of each job; a collected job is recorded without a job ID. Databases from before job IDs were recorded lack the table
+            if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'jobs'").fetchone() != None:
+                for key, jobid, submitted in conn.execute("SELECT key, jobid, submitted FROM jobs"):
+                    if key not in jobs or (submitted or 0) >= jobs[key][0]:
+                        jobs[key] = (submitted or 0, jobid, submitted or 0)
+
+        #Never let one unreadable database stop the campaign
+        except sqlite3.Error as exc:
+            logger.warning("Could not read state database %s: %s"%(path, exc))
+        finally:
+            conn.close()
+
+    #Return stage rows and uncollected jobs: key > (job ID, submitted)
+    return {key: row for key, (when, row) in stages.items()}, {key: (jobid, submitted) for key, (when, jobid, submitted) in jobs.items() if jobid != None}
+
+class StateDB:
+    #SQLite record of every (ligand, repetition, stage). Rows are cached in memory so resume planning never touches the filesystem
+    def __init__(self, master_dir, owner=None):
+        #Generate path to database: MDFit_state.db, or this work queue coordinator's own
+        self.path = db_path(master_dir, owner)
+
+        #Open database. Worker threads share one connection behind a lock
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=60)
+        self.lock = threading.Lock()
+
+        #Make table if this is a new campaign
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS stages (ligand TEXT, repetition TEXT, stage TEXT, status TEXT, inputs TEXT, outputs TEXT, started REAL, finished REAL, exit_code INTEGER, error TEXT, fingerprint TEXT, PRIMARY KEY (ligand, repetition, stage))")
+
+            #Databases from before stage fingerprints were recorded lack the column
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(stages)")]
+            if "fingerprint" not in columns:
+                self.conn.execute("ALTER TABLE stages ADD COLUMN fingerprint TEXT")
+
+            #Anything still running belongs to a previous MDFit process that did not finish. A coordinator's own database is new
+            if owner == None:
+                self.conn.execute("UPDATE stages SET status = 'interrupted' WHERE status = 'running'")
+
+            #Job IDs of submitted remote jobs that have not been collected yet, so a restarted MDFit can re-attach
+            self.conn.execute("CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, jobid TEXT, submitted REAL)")
+
+        #Start times of stages started by this process: (ligand, repetition, stage) > time
+        self.started = {}
+
+        #Read every row once, from this database and those of other processes: (ligand, repetition, stage) > (status, fingerprint)
+        stages, jobs = merge(master_dir)
+        self.rows = {}
+        for key, row in stages.items():
+            #Stages left running by other processes are interrupted too, unless they share the campaign (work queue)
+            self.rows[key] = ("interrupted" if owner == None and row[3] == "running" else row[3], row[8])
+
+        #Read recorded job IDs once: key > job ID
+        self.jobs = {key: jobid for key, (jobid, submitted) in jobs.items()}
+
+    def is_done(self, ligand, repetition, stage, fingerprint=None):
+        #Check cached status; no database or filesystem access
+        status, recorded = self.rows.get((ligand, repetition, stage), (None, None))
+
+        #Stage is done if it finished with the same inputs. Rows without a fingerprint are trusted
+        return status == "complete" and (fingerprint == None or recorded == None or recorded == fingerprint)
+
+    def is_stale(self, ligand, repetition, stage, fingerprint):
+        #Check if stage finished with different inputs or arguments than requested now
+        status, recorded = self.rows.get((ligand, repetition, stage), (None, None))
+        return status == "complete" and recorded != None and recorded != fingerprint
+
+    def completed(self, stage):
+        #Return (ligand, repetition) pairs that finished a stage
+        return [(key[0], key[1]) for key, row in list(self.rows.items()) if key[2] == stage and row[0] == "complete"]
+
+    def start(self, ligand, repetition, stage, inputs, fingerprint=None):
+        #Record stage as running
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, 'running', ?, NULL, ?, NULL, NULL, NULL, ?)", (ligand, repetition, stage, json.dumps(inputs), time.time(), fingerprint))
+            self.rows[(ligand, repetition, stage)] = ("running", fingerprint)
+            self.started[(ligand, repetition, stage)] = time.time()
+
+    def finish(self, ligand, repetition, stage, outputs, exit_code, fingerprint=None):
+        #Record stage as complete. Stages found on disk by older resume checks may not have a row yet
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO stages (ligand, repetition, stage, status) VALUES (?, ?, ?, 'running')", (ligand, repetition, stage))
+            self.conn.execute("UPDATE stages SET status = 'complete', outputs = ?, finished = ?, exit_code = ?, error = NULL, fingerprint = COALESCE(?, fingerprint) WHERE ligand = ? AND repetition = ? AND stage = ?", (json.dumps(outputs), time.time(), exit_code, fingerprint, ligand, repetition, stage))
+            self.rows[(ligand, repetition, stage)] = ("complete", fingerprint if fingerprint != None else self.rows.get((ligand, repetition, stage), (None, None))[1])
+
+            #Get wall time if the stage was started by this process
+            started = self.started.pop((ligand, repetition, stage), None)
+
+        #Return wall time, or None
+        return time.time() - started if started != None else None
+
+    def fail(self, ligand, repetition, stage, error, exit_code, status="failed"):
+        #Record stage as failed (or stalled, if killed at its wall-clock limit)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO stages (ligand, repetition, stage, status) VALUES (?, ?, ?, 'running')", (ligand, repetition, stage))
+            self.conn.execute("UPDATE stages SET status = ?, finished = ?, exit_code = ?, error = ? WHERE ligand = ? AND repetition = ? AND stage = ?", (status, time.time(), exit_code, error, ligand, repetition, stage))
+            self.rows[(ligand, repetition, stage)] = (status, self.rows.get((ligand, repetition, stage), (None, None))[1])
+            self.started.pop((ligand, repetition, stage), None)
+
+    def record_job(self, key, jobid):
+        #Record job ID of a submitted remote job
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)", (key, jobid, time.time()))
+            self.jobs[key] = jobid
+
+    def forget_job(self, key):
+        #Forget a remote job once its results are collected. Recorded without a job ID, so it also hides a record in another process's database
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO jobs VALUES (?, NULL, ?)", (key, time.time()))
+            self.jobs.pop(key, None)
+
+    def reset(self, ligand, repetition, stage):
+        #Forget a stage so it is run again
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM stages WHERE ligand = ? AND repetition = ? AND stage = ?", (ligand, repetition, stage))
+            self.rows.pop((ligand, repetition, stage), None)
+
+    def close(self):
+        #Close database
+        with self.lock:
+            self.conn.close()
+
+class StageRecord:
+    #Outputs and exit status filled in by the stage while it runs
+    def __init__(self):
+        self.outputs = []
+        self.exit_code = 0
+
+def open_state(master_dir, owner=None):
+    #Open database shared by every stage. Work queue coordinators give their owner name and write their own database
+    global state
+    state = StateDB(master_dir, owner)
+
+    #Capture current step
+    logger.info("Campaign state database: %s (%s recorded stages)"%(state.path, len(state.rows)))
+
+    #Return database
+    return state
+
+def current():
+    #Return shared database, or None if not opened
+    return state
+
+def close():
+    #Close shared database, if open
+    global state
+    if state != None:
+        state.close()
+        state = None
+
+def done(ligand, repetition, stage, fingerprint=None):
+    #Check if a stage already finished with the same inputs. Without a database, nothing is known to be done
+    return state != None and state.is_done(ligand, repetition, stage, fingerprint)
+
+def stale(ligand, repetition, stage, fingerprint):
+    #Check if a stage finished with different inputs; its outputs must be removed before it is run again
+    return state != None and state.is_stale(ligand, repetition, stage, fingerprint)
+
+def start(ligand, repetition, stage, inputs, fingerprint=None):
+    #Record stage as running, if database is open
+    if state != None:
+        state.start(ligand, repetition, stage, inputs, fingerprint)
+
+def finish(ligand, repetition, stage, outputs, exit_code=0, fingerprint=None, run_time=None):
+    #Record stage as complete, if database is open. The job's own run time, if given, replaces the stage's wall time
+    if state != None:
+        elapsed = state.finish(ligand, repetition, stage, outputs, exit_code, fingerprint)
+        if run_time != None:
+            elapsed = run_time
+
+        #Hand wall time to callbacks (e.g., runtime history)
+        if elapsed != None:
+            for callback in finish_callbacks:
+                callback(ligand, repetition, stage, elapsed)
+
+def fail(ligand, repetition, stage, exc, exit_code=None):
+    #Record stage as failed, if database is open. Keep the job's exit status, given or carried by the error. Jobs killed by the watchdog are stalled
+    if state != None:
+        state.fail(ligand, repetition, stage, str(exc), exit_code if exit_code != None else getattr(exc, "returncode", None), "stalled" if getattr(exc, "stalled", False) == True else "failed")
+
+def record_job(key, jobid):
+    #Record job ID of a submitted remote job, if database is open
+    if state != None:
+        state.record_job(key, jobid)
+
+def forget_job(key):
+    #Forget a collected remote job, if database is open
+    if state != None:
+        state.forget_job(key)
+
+def recorded_job(key):
+    #Return job ID recorded for a remote job, or None
+    return state.jobs.get(key) if state != None else None
+
+@contextlib.contextmanager
+def track(ligand, repetition, stage, inputs, fingerprint=None):
+    #Record start, finish, or failure of the enclosed stage
+    record = StageRecord()
+
+    #Record stage as running
+    start(ligand, repetition, stage, inputs, fingerprint)
+
+    #Run stage
+    try:
+        yield record
+
+    #Stage failed
+    except BaseException as exc:
+        fail(ligand, repetition, stage, exc)
+        raise
+
+    #Stage finished
+    finish(ligand, repetition, stage, record.outputs, record.exit_code, fingerprint)
+
+def report(master_dir):
+    #Check if any database exists
+    if databases(master_dir) == []:
+        #If not, nothing has been run here
+        print("No MDFit state database found in %s"%master_dir)
+        return
+
+    #Read every database read-only, merged
+    stages, jobs = merge(master_dir)
+
+    #Count stages by status
+    counts = {}
+    for ligand, repetition, stage, status, started, finished, exit_code, error, fingerprint in stages.values():
+        counts.setdefault(stage, {})[status] = counts.get(stage, {}).get(status, 0) + 1
+
+    #Print one line per stage, in workflow order
+    print("%-16s %9s %9s %9s %9s %12s"%("Stage", "complete", "running", "failed", "stalled", "interrupted"))
+    for stage in STAGES:
+        statuses = counts.get(stage, {})
+        print("%-16s %9s %9s %9s %9s %12s"%(stage, statuses.get("complete", 0), statuses.get("running", 0), statuses.get("failed", 0), statuses.get("stalled", 0), statuses.get("interrupted", 0)))
+
+    #Print every failed or running stage
+    for ligand, repetition, stage, status, started, finished, exit_code, error, fingerprint in sorted(row for row in stages.values() if row[3] != "complete"):
+        #Generate elapsed time for running stages
+        elapsed = " (%.1f h)"%((time.time() - started)/3600) if status == "running" and started != None else ""
+
+        #Print stage details
+        print("%s %s %s: %s%s exit=%s %s"%(ligand, repetition, stage, status, elapsed, exit_code, error if error != None else ""))
+
+    #Print remote jobs a restarted MDFit will re-attach to
+    for key, (jobid, submitted) in sorted(jobs.items(), key=lambda job: job[1][1]):
+        print("%s: remote job %s, submitted %.1f h ago"%(key, jobid, (time.time() - submitted)/3600))
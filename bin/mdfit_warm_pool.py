@@ -0,0 +1,434 @@
+#!/ap/rhel7/bin/python3.6
+
+####################################################################
+# Corresponding Authors : Alexander Brueckner, Kaushik Lakkaraju ###
+# Contact : alexander.brueckner@bms.com, kaushik.lakkaraju@bms.com #
+####################################################################
+
+#Import Python modules
+import logging
+import sys
+import os
+import glob
+import json
+import queue
+import runpy
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import traceback
+
+#Import MDFit modules
+import mdfit_exec
+import mdfit_watchdog
+import mdfit_job_monitor
+
+###Initiate logger###
+logger = logging.getLogger(__name__)
+
+#Short $SCHRODINGER/run scripts that are run in a warm worker
+WARM_SCRIPTS = ("event_analysis.py", "pv_convert.py")
+
+#$SCHRODINGER/utilities programs and the scripts behind them
+WARM_UTILITIES = {
+    "structconvert": "structconvert.py",
+    "structcat": "structcat.py",
+    "structsubset": "structsubset.py",
+    "proplister": "proplister.py",
+}
+
+#Modules imported once when a worker starts
+PRELOAD = ("schrodinger.structure", "schrodinger.structutils.analyze")
+
+#Longest wait for a worker to finish its imports (seconds)
+STARTUP_TIMEOUT = 300
+
+#Longest wait for one call without a host class limit (seconds). A worker that takes longer is killed and replaced
+CALL_TIMEOUT = 3600
+
+#Pool shared by every stage
+pool = None
+
+class WarmWorker:
+    #One long-lived process started under the Schrodinger Python. Requests and replies are JSON lines over its stdin and stdout
+    def __init__(self, SCHRODINGER, number):
+        #Keep worker number for logging
+        self.number = number
+
+        #Start timer for worker startup
+        start = time.time()
+
+        #Start worker process ($SCHRODINGER/run python3 mdfit_warm_pool.py). It leads its own process group so it can be killed with its children
+        self.process = subprocess.Popen([os.path.join(SCHRODINGER, "run"), "python3", "-u", os.path.abspath(__file__)], \
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1, start_new_session=True)
+
+        #Read replies in the background so every wait on the worker can time out
+        self.replies = queue.Queue()
+        threading.Thread(target=self.read_loop, name="MDFitWarmWorker%s"%number, daemon=True).start()
+
+        #Wait for the worker to finish its imports
+        try:
+            reply = self.receive(STARTUP_TIMEOUT)
+        except queue.Empty:
+            reply = None
+
+        #Get startup time; this is what every call through the pool no longer pays
+        self.startup = time.time() - start
+
+        #Check if worker started
+        if reply == None or reply.get("ready") != True:
+            #If not, stop it
+            self.stop()
+            raise RuntimeError("Warm worker %s did not start"%number)
+
+    def send(self, request):
+        #Write one request per line
+        self.process.stdin.write(json.dumps(request) + "\n")
+        self.process.stdin.flush()
+
+    def read_loop(self):
+        #Queue every reply line; None once the worker's output closes
+        for line in self.process.stdout:
+            self.replies.put(line)
+        self.replies.put(None)
+
+    def receive(self, timeout=None):
+        #Wait for one reply. Returns None if the worker died; raises queue.Empty if it took longer than timeout
+        line = self.replies.get(timeout=timeout)
+        return json.loads(line) if line != None else None
+
+    def alive(self):
+        #Check if worker process is still running
+        return self.process.poll() == None
+
+    def kill(self):
+        #Stop worker and every process it started
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        self.process.wait()
+
+    def stop(self):
+        #Ask worker to exit, then make sure it does
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except Exception:
+            self.kill()
+
+class WarmPool:
+    #Fixed set of warm workers handed out to one caller at a time
+    def __init__(self, SCHRODINGER, size):
+        #Keep Schrodinger path to replace workers that die
+        self.SCHRODINGER = SCHRODINGER
+
+        #Start workers and queue their slots as idle. A slot whose worker could not be restarted holds None
+        self.idle = queue.Queue()
+        self.workers = []
+        for number in range(size):
+            self.workers.append(WarmWorker(SCHRODINGER, number))
+            self.idle.put(number)
+
+        #Scripts the workers could not find; these always run as subprocesses
+        self.missing = set()
+
+        #Per-script call count and latency: script > [calls, seconds]
+        self.latency = {}
+        self.lock = threading.Lock()
+
+    def script(self, command):
+        #Get script a command would run in a warm worker, or None if it must run as a subprocess
+        name = os.path.basename(command[0])
+
+        #Check for $SCHRODINGER/run <script.py>
+        if name == "run" and len(command) > 1 and command[1] in WARM_SCRIPTS:
+            script, argv = command[1], command[2:]
+
+        #Check for $SCHRODINGER/utilities/<program>
+        elif os.path.basename(os.path.dirname(command[0])) == "utilities" and name in WARM_UTILITIES:
+            script, argv = WARM_UTILITIES[name], command[1:]
+
+        #Command is not a short utility
+        else:
+            return None, None
+
+        #Scripts the workers could not find run as subprocesses
+        if script in self.missing:
+            return None, None
+
+        #Return script and its arguments
+        return script, argv
+
+    def record(self, script, elapsed):
+        #Add call to the latency table
+        with self.lock:
+            calls = self.latency.setdefault(script, [0, 0.0])
+            calls[0] += 1
+            calls[1] += elapsed
+
+    def run(self, command, joblogger, cwd=None, limit=None):
+        #Get script to run in-process
+        script, argv = self.script(command)
+
+        #Check if command can be run in a warm worker
+        if script == None:
+            #If not, run as a subprocess
+            return mdfit_exec.run_job(command, joblogger, cwd, timeout=limit)
+
+        #Start timer; latency includes waiting for an idle worker
+        start = time.time()
+
+        #Wait for an idle slot
+        number = self.idle.get()
+        worker = self.workers[number]
+
+        #Check if the slot lost its worker
+        if worker == None:
+            #If so, try to start a new one; run as a subprocess if that fails too
+            worker = self.restart(None, number)
+            if worker == None:
+                self.idle.put(number)
+                return mdfit_exec.run_job(command, joblogger, cwd, timeout=limit)
+
+        #Run script in the worker, from the caller's directory. Wait no longer than the call's limit
+        try:
+            worker.send({"script": script, "argv": argv, "cwd": cwd if cwd != None else os.getcwd()})
+            reply = worker.receive(limit if limit != None else CALL_TIMEOUT)
+
+        #Worker died while the request was sent
+        except (BrokenPipeError, OSError):
+            reply = None
+
+        #Worker ran past the limit
+        except queue.Empty:
+            #Kill it with everything it started and put a new worker (or an empty slot) back
+            joblogger.warning("Timed out after %.1f s in warm worker, killing: %s"%(time.time() - start, script))
+            worker.kill()
+            self.restart(worker, number)
+            self.idle.put(number)
+
+            #Return like a timed-out subprocess
+            return mdfit_exec.JobResult(command, -signal.SIGKILL, time.time() - start, True, False)
+
+        #Check if worker died
+        if reply == None:
+            #If so, replace it (or leave the slot empty) and run the command as a subprocess
+            self.restart(worker, number)
+            self.idle.put(number)
+            joblogger.warning("Warm worker died running %s; running as a subprocess"%script)
+            return mdfit_exec.run_job(command, joblogger, cwd, timeout=limit)
+
+        #Give slot back
+        self.idle.put(number)
+
+        #Check if the worker could not find the script
+        if reply.get("missing") == True:
+            #If so, remember and run as a subprocess
+            with self.lock:
+                self.missing.add(script)
+            logger.info("%s not found by warm workers; running it as a subprocess"%script)
+            return mdfit_exec.run_job(command, joblogger, cwd, timeout=limit)
+
+        #Get elapsed time
+        elapsed = time.time() - start
+
+        #Write script output to log file for debugging
+        for line in reply["output"].splitlines():
+            if line.strip() != "":
+                joblogger.debug(line.rstrip())
+
+        #Document exit status and timing
+        joblogger.debug("Exit status %s after %.2f s (warm pool): %s"%(reply["returncode"], elapsed, script))
+
+        #Add call to the latency table
+        self.record(script, elapsed)
+
+        #Return exit status and timing
+        return mdfit_exec.JobResult(command, reply["returncode"], elapsed, False, False)
+
+    def restart(self, worker, number):
+        #Stop dead or stuck worker, if any, and start a new one in its slot
+        if worker != None:
+            worker.stop()
+
+        #Start no new worker if MDFit is stopping
+        if mdfit_exec.stopping.is_set():
+            with self.lock:
+                self.workers[number] = None
+            return None
+
+        #Start new worker. Returns None if it cannot start; its slot then runs calls as subprocesses
+        try:
+            new_worker = WarmWorker(self.SCHRODINGER, number)
+        except Exception as exc:
+            logger.warning("Could not restart warm worker %s: %s"%(number, exc))
+            new_worker = None
+
+        #Keep new worker in the slot, or leave it empty
+        with self.lock:
+            self.workers[number] = new_worker
+
+        #Return new worker, or None
+        return new_worker
+
+    def report(self):
+        #Get mean worker startup time, the cost of each cold call that the pool avoids
+        running = [worker for worker in self.workers if worker != None]
+        startup = sum(worker.startup for worker in running) / len(running) if running != [] else 0.0
+
+        #Capture per-script latency
+        logger.info("Warm pool: %s workers, mean startup %.2f s"%(len(self.workers), startup))
+        for script, (calls, seconds) in sorted(self.latency.items()):
+            logger.info("Warm pool: %s, %s calls, mean latency %.2f s, about %.0f s of startup avoided"%(script, calls, seconds / calls, calls * startup))
+
+    def stop(self):
+        #Report latency, then stop every worker
+        self.report()
+        for worker in self.workers:
+            if worker != None:
+                worker.stop()
+
+    def terminate(self):
+        #Kill every worker and whatever call it is running, without waiting for them to finish
+        with self.lock:
+            workers = [worker for worker in self.workers if worker != None]
+        for worker in workers:
+            worker.kill()
+
+def start(SCHRODINGER, size):
+    #Start pool shared by every stage
+    global pool
+    pool = WarmPool(SCHRODINGER, size)
+
+    #Capture current step
+    logger.info("Started %s warm Schrodinger workers"%size)
+
+    #Return pool
+    return pool
+
+def current():
+    #Return shared pool, or None if not started
+    return pool
+
+def stop():
+    #Stop shared pool, if started
+    global pool
+    if pool != None:
+        pool.stop()
+        pool = None
+
+def terminate():
+    #Kill workers of shared pool, if started; stop() still reports and clears it
+    if pool != None:
+        pool.terminate()
+
+def run_job(command, joblogger, cwd=None, hostclass=None):
+    #Get wall-clock limit of the host class the call counts against, if any. Calls mdfit_watchdog.py
+    limit = mdfit_watchdog.limit(hostclass) if hostclass != None else None
+
+    #Run short utilities in a warm worker when the pool is started; everything else (and every call without a pool) runs as a subprocess
+    if pool != None:
+        result = pool.run(command, joblogger, cwd, limit)
+    else:
+        result = mdfit_exec.run_job(command, joblogger, cwd, timeout=limit)
+
+    #Check if call ran past the host class limit
+    if result.timed_out == True and limit != None:
+        #If so, mark it as stalled like any other job killed at its limit
+        raise mdfit_job_monitor.JobStalled(mdfit_watchdog.jobname(command), "local", "%g"%(limit/3600), result.returncode)
+
+    #Return exit status and timing
+    return result
+
+def find_script(script):
+    #Search the Python path and Schrodinger script directories, as $SCHRODINGER/run does
+    SCHRODINGER = os.environ.get("SCHRODINGER", "")
+    directories = sys.path + glob.glob(os.path.join(SCHRODINGER, "mmshare-v*", "python", "scripts")) + glob.glob(os.path.join(SCHRODINGER, "mmshare-v*", "python", "common"))
+
+    #Return first match
+    for directory in directories:
+        path = os.path.join(directory, script)
+        if os.path.isfile(path) == True:
+            return path
+
+    #Script not found
+    return None
+
+def serve():
+    #Keep a private copy of stdout for replies; script output is redirected per request
+    replies = os.fdopen(os.dup(1), 'w')
+    stderr_fd = os.dup(2)
+
+    #Import commonly used modules once
+    for module in PRELOAD:
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+
+    #Tell the pool the worker is ready
+    replies.write(json.dumps({"ready": True}) + "\n")
+    replies.flush()
+
+    #Cache script paths: script > path
+    paths = {}
+
+    #Handle one request per line until the pool closes stdin
+    for line in sys.stdin:
+        #Read request
+        request = json.loads(line)
+
+        #Find script once
+        if request["script"] not in paths:
+            paths[request["script"]] = find_script(request["script"])
+        path = paths[request["script"]]
+
+        #Check if script was found
+        if path == None:
+            #If not, the pool runs it as a subprocess
+            replies.write(json.dumps({"missing": True}) + "\n")
+            replies.flush()
+            continue
+
+        #Send script output (including output from compiled code) to a temporary file
+        with tempfile.TemporaryFile() as output:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(output.fileno(), 1)
+            os.dup2(output.fileno(), 2)
+
+            #Run script as __main__ from the caller's directory
+            try:
+                os.chdir(request["cwd"])
+                sys.argv = [path] + request["argv"]
+                runpy.run_path(path, run_name="__main__")
+                returncode = 0
+
+            #Script called sys.exit()
+            except SystemExit as exc:
+                returncode = exc.code if isinstance(exc.code, int) else (0 if exc.code == None else 1)
+
+            #Script raised an error
+            except BaseException:
+                traceback.print_exc()
+                returncode = 1
+
+            #Restore stdout and stderr
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(stderr_fd, 1)
+            os.dup2(stderr_fd, 2)
+
+            #Read script output
+            output.seek(0)
+            text = output.read().decode(errors="replace")
+
+        #Reply with exit status and output
+        replies.write(json.dumps({"returncode": returncode, "output": text}) + "\n")
+        replies.flush()
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,45 @@
+#!/ap/rhel7/bin/python3.6
+
+####################################################################
+# Corresponding Authors : Alexander Brueckner, Kaushik Lakkaraju ###
+# Contact : alexander.brueckner@bms.com, kaushik.lakkaraju@bms.com #
+####################################################################
+
+#Import Python modules
+import logging
+import os
+
+#Import MDFit modules
+import mdfit_resources
+import mdfit_backends
+import mdfit_daemon
+
+###Initiate logger###
+logger = logging.getLogger(__name__)
+
+#Wall-clock limit of each host class (seconds). Empty until configured; jobs without a limit run until they finish
+limits = {}
+
+def configure(inst_params):
+    #Get limit of every host class from json file, or the README guidance. Calls mdfit_resources.py
+    for hostclass in mdfit_resources.RUNTIME_LIMITS:
+        limits[hostclass] = mdfit_resources.runtime_limit(inst_params, hostclass)*3600
+
+    #Capture current step
+    logger.info("Wall-clock limits per host class (h): %s"%{hostclass: seconds/3600 for hostclass, seconds in limits.items()})
+
+def limit(hostclass):
+    #Return limit of a host class (seconds), or None if not configured
+    return limits.get(hostclass)
+
+def jobname(command):
+    #Get -JOBNAME of a command, or the program name
+    if "-JOBNAME" in command[:-1]:
+        return command[command.index("-JOBNAME") + 1]
+    return os.path.basename(command[0])
+
+def run_job(command, joblogger, hostclass, cwd=None, name=None, members=None, outputs=None):
+    #Wait for a slot of the host class in the budget shared with other campaigns, if the campaign joined the MDFit daemon. Calls mdfit_daemon.py
+    with mdfit_daemon.slot(hostclass):
+        #Run job on its host class's backend (local, jobcontrol, or slurm), killed at the host class limit. Calls mdfit_backends.py
+        return mdfit_backends.backend(hostclass).run(command, joblogger, limit(hostclass), cwd, name if name != None else jobname(command), members, outputs)
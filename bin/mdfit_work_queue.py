@@ -0,0 +1,459 @@
+#!/ap/rhel7/bin/python3.6
+
+####################################################################
+# Corresponding Authors : Alexander Brueckner, Kaushik Lakkaraju ###
+# Contact : alexander.brueckner@bms.com, kaushik.lakkaraju@bms.com #
+####################################################################
+
+#Import Python modules
+import logging
+import sys
+import os
+import json
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import contextlib
+
+###Initiate logger###
+logger = logging.getLogger(__name__)
+
+#Queue directory, kept in the campaign (master) directory
+QUEUE_DIR = "MDFit_queue"
+
+#Stages of a work item, in workflow order. Combine runs once, after every other item is finished
+STAGES = ("setup", "production", "analysis", "combine")
+
+#Seconds between looks at the queue while nothing can be claimed
+POLL = 30
+
+#Seconds a listing of the done, failed and lease directories is reused. The claims and checks of one poll share a listing
+LISTING_AGE = 2
+
+#Queue shared by every stage, if the user asked for one
+queue = None
+
+class WorkQueue:
+    #Work items on a shared filesystem. Every state change is an exclusive file create or an atomic rename, so it is safe between login nodes
+    def __init__(self, master_dir, lease=None):
+        #Generate queue directories: items (one file per item), leases (held items), done and failed (finished items)
+        self.path = os.path.join(master_dir, QUEUE_DIR)
+        self.dirs = {name: os.path.join(self.path, name) for name in ("items", "leases", "done", "failed")}
+        for directory in self.dirs.values():
+            os.makedirs(directory, exist_ok=True)
+
+        #Seconds a claimed item stays leased without renewal. Without a lease, the queue is only read (e.g., MDFit.py status)
+        self.lease = lease
+
+        #Name of this coordinator: host and process
+        self.owner = "%s.%s"%(socket.gethostname(), os.getpid())
+
+        #Set by initialize(): True if this coordinator filled the queue
+        self.first = False
+
+        #Items leased by this coordinator
+        self.held = set()
+        self.lock = threading.Lock()
+
+        #Items read so far; an item never changes after it is added: name > item
+        self.cache = {}
+
+        #Last listing of the done, failed and lease directories: (time, directory > names), or None
+        self.listed = None
+
+        #Renew leases in one background thread until stopped
+        self.stopped = threading.Event()
+        if lease != None:
+            self.thread = threading.Thread(target=self.renew_loop, name="MDFitLeases", daemon=True)
+            self.thread.start()
+
+    def key(self, stage, ligand, repetition=""):
+        #Generate item name <stage>__<ligand>__<repetition>
+        return "%s__%s__%s"%(stage, ligand, repetition)
+
+    def write(self, path, data):
+        #Write file next to its final name and rename it into place; readers never see a partial file
+        temp = "%s.%s.tmp"%(path, self.owner)
+        with open(temp, 'w') as fp:
+            json.dump(data, fp)
+        os.replace(temp, path)
+
+    def read(self, path):
+        #Read item or lease file. Returns None if it was removed or is being replaced
+        try:
+            with open(path, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def add(self, stage, ligand, repetition="", number=0):
+        #Generate path to item
+        path = os.path.join(self.dirs["items"], self.key(stage, ligand, repetition))
+
+        #Check if another coordinator already added it
+        if os.path.isfile(path) == True:
+            #If so, nothing to do
+            return
+
+        #Add item. Number keeps library (or schedule) order when items are claimed
+        self.write(path, {"stage": stage, "ligand": ligand, "repetition": repetition, "number": number})
+
+    def items(self, stage=None):
+        #List item names (of a stage) once; only items added since the last call are read
+        for name in os.listdir(self.dirs["items"]):
+            if name not in self.cache and name.endswith(".tmp") == False:
+                item = self.read(os.path.join(self.dirs["items"], name))
+                if item != None:
+                    self.cache[name] = item
+
+        #Return every item (of the stage), in claim order
+        items = [item for item in list(self.cache.values()) if stage == None or item["stage"] == stage]
+        return sorted(items, key=lambda item: (STAGES.index(item["stage"]), item["number"], item["ligand"], item["repetition"]))
+
+    def listing(self):
+        #List done, failed and leased items, one directory read each, reused for LISTING_AGE seconds
+        with self.lock:
+            if self.listed != None and time.time() - self.listed[0] < LISTING_AGE:
+                return self.listed[1]
+
+        #List directories
+        listed = {name: set(os.listdir(self.dirs[name])) for name in ("done", "failed", "leases")}
+        with self.lock:
+            self.listed = (time.time(), listed)
+
+        #Return listing
+        return listed
+
+    def changed(self):
+        #Drop listing after this coordinator finishes an item, so its next look sees the change
+        with self.lock:
+            self.listed = None
+
+    def status(self, item):
+        #Get name of item
+        key = self.key(item["stage"], item["ligand"], item["repetition"])
+
+        #Check finished items first
+        listed = self.listing()
+        if key in listed["done"]:
+            return "done"
+        if key in listed["failed"]:
+            return "failed"
+
+        #Check lease; only items with a lease file are read
+        if key not in listed["leases"]:
+            return "open"
+        lease = self.read(os.path.join(self.dirs["leases"], key))
+        if lease == None:
+            return "open"
+        return "leased" if lease["expires"] > time.time() else "expired"
+
+    def closed(self, key):
+        #Check on disk (not the listing) if an item is done or failed
+        return os.path.isfile(os.path.join(self.dirs["done"], key)) == True or os.path.isfile(os.path.join(self.dirs["failed"], key)) == True
+
+    def finished(self, stage=None):
+        #Check if every item (of a stage) is done or failed
+        return all(self.status(item) in ("done", "failed") for item in self.items(stage))
+
+    def active(self):
+        #Check if any item is held by a live coordinator; finishing it may add new items
+        return any(self.status(item) == "leased" for item in self.items())
+
+    def acquire(self, key):
+        #Generate path to lease
+        path = os.path.join(self.dirs["leases"], key)
+
+        #Check if an expired lease is in the way
+        lease = self.read(path)
+        if lease != None and lease["expires"] <= time.time():
+            #If so, break it. Only one coordinator's rename can succeed
+            broken = "%s.%s.expired"%(path, self.owner)
+            try:
+                os.rename(path, broken)
+            except OSError:
+                return False
+
+            #Check that the lease moved aside is the expired one; its owner may have renewed it, or another coordinator replaced it, in between
+            if self.read(broken) != lease:
+                #If not, put it back (never over a newer lease) and leave the item to its owner
+                try:
+                    os.link(broken, path)
+                except OSError:
+                    pass
+                os.remove(broken)
+                return False
+
+            #Capture current step and remove broken lease
+            logger.warning("Lease on %s held by %s expired; taking it over"%(key, lease["owner"]))
+            os.remove(broken)
+
+        #Create lease; fails if another coordinator holds it
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+        #Write owner and expiry time
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({"owner": self.owner, "expires": time.time() + self.lease}, fp)
+
+        #Remember held lease for renewal
+        with self.lock:
+            self.held.add(key)
+
+        #Lease acquired
+        return True
+
+    def release(self, key):
+        #Stop renewing lease
+        with self.lock:
+            self.held.discard(key)
+
+        #Remove lease if this coordinator still holds it
+        path = os.path.join(self.dirs["leases"], key)
+        lease = self.read(path)
+        if lease != None and lease["owner"] == self.owner:
+            os.remove(path)
+
+    def claim(self, stage, limit=None):
+        #Iterate over items of the stage
+        for item in self.items(stage):
+            #Get name of item
+            key = self.key(item["stage"], item["ligand"], item["repetition"])
+
+            #Skip items that are finished or held by a live coordinator
+            if self.status(item) not in ("open", "expired"):
+                continue
+
+            #Combine waits until every other item is finished
+            if stage == "combine" and any(self.finished(each_stage) == False for each_stage in STAGES[:-1]):
+                return None
+
+            #Try leasing item
+            if self.acquire(key) == True:
+                #Check again, on disk, that it was not finished while the lease was taken
+                if self.closed(key) == True:
+                    self.release(key)
+                    continue
+
+                #Capture current step
+                logger.info("Claimed %s (%s)"%(key, self.owner))
+
+                #Return claimed item
+                return item
+
+        #Nothing to claim
+        return None
+
+    def complete(self, item):
+        #Mark item as done, then give up its lease
+        key = self.key(item["stage"], item["ligand"], item["repetition"])
+        self.write(os.path.join(self.dirs["done"], key), {"owner": self.owner, "finished": time.time()})
+        self.release(key)
+        self.changed()
+
+    def fail(self, item, exc):
+        #Mark item as failed, then give up its lease
+        key = self.key(item["stage"], item["ligand"], item["repetition"])
+        self.write(os.path.join(self.dirs["failed"], key), {"owner": self.owner, "finished": time.time(), "error": str(exc)})
+        self.release(key)
+        self.changed()
+
+    def renew_loop(self):
+        #Renew every held lease three times per lease period
+        while not self.stopped.wait(self.lease/3):
+            #Get snapshot of held leases
+            with self.lock:
+                keys = list(self.held)
+
+            #Push expiry time forward. Never let a bad renewal stop the loop
+            for key in keys:
+                try:
+                    #Check that no other coordinator took the item over (e.g., after this one stalled past its lease)
+                    lease = self.read(os.path.join(self.dirs["leases"], key))
+                    if lease != None and lease["owner"] != self.owner:
+                        #If one did, stop renewing
+                        logger.warning("Lease on %s was taken over by %s"%(key, lease["owner"]))
+                        with self.lock:
+                            self.held.discard(key)
+                        continue
+
+                    #Renew lease
+                    self.write(os.path.join(self.dirs["leases"], key), {"owner": self.owner, "expires": time.time() + self.lease})
+                except Exception as exc:
+                    logger.warning("Could not renew lease on %s: %s"%(key, exc))
+
+    @contextlib.contextmanager
+    def mutex(self, name):
+        #Hold a queue-wide lock (e.g., for steps that cannot control their output filenames)
+        key = "mutex__%s"%name
+        while self.acquire(key) == False:
+            time.sleep(1)
+
+        #Run enclosed step, always giving the lock back
+        try:
+            yield
+        finally:
+            self.release(key)
+
+    def initialize(self):
+        #Generate path to the ready marker, written once the queue is filled
+        ready = os.path.join(self.path, "ready")
+
+        #Wait until the queue is filled, or this coordinator is the one to fill it
+        while os.path.isfile(ready) == False:
+            #Try leasing initialization. If its coordinator dies, the lease expires and another one takes over
+            if self.acquire("initialize") == True:
+                #Check again that the queue was not filled while the lease was taken
+                if os.path.isfile(ready) == True:
+                    self.release("initialize")
+                    break
+
+                #This coordinator fills the queue (e.g., runs FFBuilder and adds every ligand)
+                self.first = True
+                return True
+
+            #Another coordinator is filling the queue
+            time.sleep(5)
+
+        #Queue was filled by another coordinator
+        self.first = False
+        return False
+
+    def ready(self):
+        #Mark queue as filled, then let go of initialization
+        self.write(os.path.join(self.path, "ready"), {"owner": self.owner, "finished": time.time()})
+        self.release("initialize")
+
+    def stop(self):
+        #Stop renewing leases and give back every item still held, so other coordinators can take them at once
+        self.stopped.set()
+        with self.lock:
+            keys = list(self.held)
+        for key in keys:
+            self.release(key)
+
+def open_queue(master_dir, lease):
+    #Open queue shared by every stage
+    global queue
+    queue = WorkQueue(master_dir, lease)
+
+    #Capture current step
+    logger.info("Work queue: %s (coordinator %s, %s s leases)"%(queue.path, queue.owner, lease))
+
+    #Return queue
+    return queue
+
+def current():
+    #Return shared queue, or None if not opened
+    return queue
+
+def close():
+    #Close shared queue, if open
+    global queue
+    if queue != None:
+        queue.stop()
+        queue = None
+
+@contextlib.contextmanager
+def mutex(name):
+    #Hold a queue-wide lock if the queue is open; otherwise, nothing to share
+    if queue == None:
+        yield
+    else:
+        with queue.mutex(name):
+            yield
+
+def report(master_dir):
+    #Check if this campaign has a queue
+    if os.path.isdir(os.path.join(master_dir, QUEUE_DIR, "items")) == False:
+        #If not, nothing to report
+        return
+
+    #Read queue without leasing anything
+    work = WorkQueue(master_dir)
+
+    #Count items by stage and status
+    counts = {}
+    for item in work.items():
+        counts.setdefault(item["stage"], {}).setdefault(work.status(item), 0)
+        counts[item["stage"]][work.status(item)] += 1
+
+    #Print one line per stage
+    print("\n%-16s %9s %9s %9s %9s %9s"%("Queue", "open", "leased", "expired", "done", "failed"))
+    for stage in STAGES:
+        statuses = counts.get(stage, {})
+        print("%-16s %9s %9s %9s %9s %9s"%(stage, statuses.get("open", 0), statuses.get("leased", 0), statuses.get("expired", 0), statuses.get("done", 0), statuses.get("failed", 0)))
+
+def demo_coordinator(master_dir, items, seconds):
+    #Open queue with short leases
+    work = WorkQueue(master_dir, 5)
+
+    #Check if this coordinator fills the queue
+    if work.initialize() == True:
+        #If so, add one setup item per dummy ligand, plus the final combine
+        for number in range(items):
+            work.add("setup", "ligand%s"%number, "", number)
+        work.add("combine", "all", "", 0)
+
+        #Let the other coordinators start
+        work.ready()
+
+    #Drain queue; every item sleeps and appends its name to a shared log
+    while True:
+        #Claim next item, later stages first
+        item = None
+        for stage in ("combine", "analysis", "production", "setup"):
+            item = work.claim(stage)
+            if item != None:
+                break
+
+        #Check if anything was claimed
+        if item == None:
+            #If not, stop once every item is finished; otherwise, wait for other coordinators
+            if work.finished() == True:
+                break
+            time.sleep(0.2)
+            continue
+
+        #Run dummy item and record who ran it
+        time.sleep(seconds)
+        with open(os.path.join(master_dir, "ran"), 'a') as fp:
+            fp.write("%s %s\n"%(work.key(item["stage"], item["ligand"], item["repetition"]), work.owner))
+
+        #Add next stage of the item, as the real coordinator does
+        if item["stage"] == "setup":
+            work.add("production", item["ligand"], "%s_repetition1"%item["ligand"], item["number"])
+
+        #Mark item as done
+        work.complete(item)
+
+    #Stop renewing leases
+    work.stop()
+
+def demo(items, coordinators):
+    #Make campaign directory
+    master_dir = tempfile.mkdtemp(prefix="mdfit_queue_")
+
+    #Launch coordinators as separate processes
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "coordinator", master_dir, str(items)]) for each in range(coordinators)]
+    for process in processes:
+        process.wait()
+
+    #Count how often each item ran
+    with open(os.path.join(master_dir, "ran"), 'r') as fp:
+        ran = [line.split()[0] for line in fp]
+
+    #Print result; every item must run exactly once
+    print("%s coordinators ran %s items (%s distinct, %s expected) in %s"%(coordinators, len(ran), len(set(ran)), 2*items + 1, master_dir))
+    return len(ran) == len(set(ran)) == 2*items + 1
+
+if __name__ == '__main__':
+    #Local check of the queue without Schrodinger: python mdfit_work_queue.py demo [items] [coordinators]
+    if sys.argv[1:2] == ["coordinator"]:
+        demo_coordinator(sys.argv[2], int(sys.argv[3]), 0.05)
+    else:
+        sys.exit(0 if demo(int(sys.argv[2]) if len(sys.argv) > 2 else 20, int(sys.argv[3]) if len(sys.argv) > 3 else 4) else 1)